@@ -0,0 +1,105 @@
+import sys
+import time
+import numpy as np
+import pandas as pd
+from reservoir.parsers.drugs.parse_drug_combos import BLOCK_COLUMNS, assemble_combo_blocks
+
+"""
+Compares the original per block assembly of the combo measurements (groupby.apply
+building a one row dataframe per block, then a python set per block to find doubled
+matrices) with the vectorised one, on synthetic blocks.
+
+    python benchmarks/bench_block_assembly.py [number of blocks]
+
+DrugComb v1.5 has ~740k blocks, the original assembly is slow enough that the
+default runs on a smaller set.
+"""
+
+
+def get_concentration_pairs(rows):
+    """ The original parser, one dataframe per block
+    """
+    pairs = list(rows.apply(lambda row: tuple([row["conc_r"], row["conc_c"]]), axis=1))
+    inhibitions = list(rows["inhibition"])
+
+    return pd.DataFrame(
+        [
+            {
+                "drug_row_recover_id": rows.iloc[0]["drug_row_recover_id"],
+                "drug_row_smiles": rows.iloc[0]["drug_row_smiles"],
+                "drug_col_recover_id": rows.iloc[0]["drug_col_recover_id"],
+                "drug_col_smiles": rows.iloc[0]["drug_col_smiles"],
+                "cell_line_name": rows.iloc[0]["cell_line_name"],
+                "pairs": pairs,
+                "inhibitions": inhibitions,
+            }
+        ]
+    )
+
+
+def assemble_with_groupby(combo_therapy):
+    combo_blocks = combo_therapy.groupby("block_id").apply(get_concentration_pairs)
+    combo_blocks = combo_blocks.reset_index()[["block_id"] + BLOCK_COLUMNS + ["pairs", "inhibitions"]]
+
+    doubled = combo_blocks.pairs.apply(lambda cp: len(set(tuple(p) for p in cp)) != len(cp))
+    combo_blocks.loc[doubled, "pairs"] = combo_blocks.loc[doubled, "pairs"].apply(lambda c: c[::2])
+    combo_blocks.loc[doubled, "inhibitions"] = combo_blocks.loc[doubled, "inhibitions"].apply(
+        lambda c: c[::2]
+    )
+
+    return combo_blocks
+
+
+def synthetic_combos(number_of_blocks, seed=0):
+    """ Combo measurements of random 3x3 to 5x5 blocks (DrugComb is mostly 4x4),
+    5% of them with the matrix measured twice, in shuffled order
+    """
+
+    rng = np.random.default_rng(seed)
+    grid_sizes = rng.integers(3, 6, size=number_of_blocks)
+    repeats = np.where(rng.random(number_of_blocks) < 0.05, 2, 1)
+    sizes = grid_sizes ** 2 * repeats
+
+    block_ids = np.repeat(np.arange(number_of_blocks), sizes)
+    grid_positions = np.concatenate(
+        [np.tile(np.arange(g * g), r) for g, r in zip(grid_sizes, repeats)]
+    )
+    grid = np.repeat(grid_sizes, sizes)
+    drugs = rng.integers(0, 5000, size=(number_of_blocks, 2))
+
+    combo_therapy = pd.DataFrame(
+        {
+            "block_id": block_ids,
+            "drug_row_recover_id": [f"RE-MOL-{d:010d}" for d in drugs[block_ids, 0]],
+            "drug_row_smiles": [f"C{d}" for d in drugs[block_ids, 0]],
+            "drug_col_recover_id": [f"RE-MOL-{d:010d}" for d in drugs[block_ids, 1]],
+            "drug_col_smiles": [f"N{d}" for d in drugs[block_ids, 1]],
+            "cell_line_name": [f"CL{b % 100}" for b in block_ids],
+            "conc_r": np.round(0.1 * 3.0 ** (grid_positions // grid), 4),
+            "conc_c": np.round(0.1 * 3.0 ** (grid_positions % grid), 4),
+            "inhibition": np.round(rng.normal(30, 30, size=len(block_ids)), 3),
+        }
+    )
+
+    # measurements arrive grouped by block, but blocks are not sorted
+    order = rng.permutation(number_of_blocks)
+    return combo_therapy.set_index("block_id").loc[order].reset_index()
+
+
+if __name__ == "__main__":
+    number_of_blocks = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    combo_therapy = synthetic_combos(number_of_blocks)
+    print(f"{number_of_blocks} blocks, {len(combo_therapy)} combo measurements")
+
+    start = time.perf_counter()
+    reference = assemble_with_groupby(combo_therapy)
+    groupby_time = time.perf_counter() - start
+    print(f"groupby.apply: {groupby_time:.1f}s")
+
+    start = time.perf_counter()
+    assembled = assemble_combo_blocks(combo_therapy)
+    vectorised_time = time.perf_counter() - start
+    print(f"vectorised: {vectorised_time:.2f}s")
+
+    assert reference.equals(assembled), "results differ"
+    print(f"same {len(assembled)} blocks, {groupby_time / vectorised_time:.0f}x faster")
@@ -0,0 +1,56 @@
+import sys
+import time
+import numpy as np
+import pandas as pd
+from reservoir.parsers.proteins import protein_mapper
+
+"""
+Compares resolve_gene_ids with the per element mappers applied to a column, on ids
+drawn from the human protein tables (plus some unknown ones) as the parsers see them:
+millions of rows with many repeats.
+
+    python benchmarks/bench_gene_resolution.py [rows]
+
+Exits with an error when the results differ.
+"""
+
+
+def sample_ids(values, rows, seed=0):
+    rng = np.random.default_rng(seed)
+    values = np.asarray(list(values) + [f"UNKNOWN{i}" for i in range(100)], dtype=object)
+    return pd.Series(values[rng.integers(0, len(values), rows)])
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    references = protein_mapper.load_references()
+    human_proteins = references["human_proteins"]
+    protein_mapper.load_gene_indexes()
+
+    cases = [
+        (
+            "symbol",
+            protein_mapper.hgnc_normalize,
+            list(human_proteins["gene_hgnc_id"]) + list(references["gene_alias_dictionary"]),
+        ),
+        ("uniprot", protein_mapper.uniprot_to_hgnc, human_proteins["uniprot_id"].dropna()),
+        ("ensembl_gene", protein_mapper.ensembl_to_hgnc, human_proteins["gene_ensembl_id"].dropna()),
+    ]
+
+    for id_type, mapper, values in cases:
+        ids = sample_ids(values, rows)
+
+        start = time.perf_counter()
+        expected = ids.apply(mapper)
+        apply_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        resolved = protein_mapper.resolve_gene_ids(ids, id_type)["gene_hgnc_id"]
+        resolve_time = time.perf_counter() - start
+
+        assert expected.fillna("").equals(resolved.fillna("")), f"different {id_type} results"
+        print(
+            f"{id_type}: apply {apply_time:.2f}s, resolve_gene_ids {resolve_time:.2f}s "
+            f"({apply_time / resolve_time:.1f}x)"
+        )
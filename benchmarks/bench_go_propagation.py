@@ -0,0 +1,93 @@
+import time
+import pandas as pd
+import networkx as nx
+import reservoir as rsv
+from reservoir.parsers.proteins import go_dag
+from reservoir.parsers.proteins.parse_gene_ontology import read_go_annotations
+
+"""
+Compares the GO annotation propagation done with networkx, one leaf annotation at a
+time, with the compiled DAG on the real GAF and obo files.
+
+    python benchmarks/bench_go_propagation.py
+"""
+
+
+def propagate_with_networkx(go_annotations, go_graph):
+    """ The original parser: nx.descendants for each leaf annotation
+    """
+
+    # calculate the distance from the three different roots
+    distances = []
+    for aspect, root in go_dag.ROOTS.items():
+        distances.append(
+            pd.DataFrame(
+                [
+                    {"go_id": source, "distance_from_root": distance, "aspect": aspect}
+                    for source, distance in dict(
+                        nx.single_target_shortest_path_length(go_graph, target=root)
+                    ).items()
+                    if go_graph.nodes[source]["namespace"] == aspect
+                ]
+            )
+        )
+    distance_df = pd.concat(distances)
+
+    # add descendant annotations
+    descendant_annotations = []
+    for i, leaf_row in go_annotations.iterrows():
+        if leaf_row["go_id"] in go_graph.nodes:
+            for parent_go_id in nx.descendants(go_graph, leaf_row["go_id"]):
+                descendant_annotations.append(
+                    {
+                        "gene_hgnc_id": leaf_row["gene_hgnc_id"],
+                        "go_id": parent_go_id,
+                        "evidence": leaf_row["evidence"],
+                        "evidence_category": leaf_row["evidence_category"],
+                    }
+                )
+    descendant_annotations = pd.DataFrame(descendant_annotations)
+    full_annotations = pd.concat([go_annotations, descendant_annotations]).drop_duplicates()
+
+    # add distances and aspects
+    full_annotations = full_annotations.merge(distance_df, how="left")
+    full_annotations["distance_from_root"] = full_annotations["distance_from_root"].fillna(-1)
+    return full_annotations.astype({"distance_from_root": "int32"})
+
+
+def canonical(annotations):
+    """ Sorted rows, to compare results independently of their order
+    """
+
+    columns = ["gene_hgnc_id", "go_id", "evidence", "evidence_category"]
+    annotations = annotations.fillna({"aspect": ""})
+    return annotations.sort_values(columns).reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    obo_path = rsv.RESERVOIR_DATA_FOLDER + go_dag.GO_OBO_FILE
+    go_annotations = read_go_annotations()
+    print(f"{len(go_annotations)} leaf annotations")
+
+    start = time.perf_counter()
+    go_graph = go_dag.read_go_graph(obo_path)
+    reference = propagate_with_networkx(go_annotations, go_graph)
+    networkx_time = time.perf_counter() - start
+    print(f"networkx: {networkx_time:.1f}s")
+
+    start = time.perf_counter()
+    dag = go_dag.compile_go_dag(go_dag.read_go_graph(obo_path))
+    compile_time = time.perf_counter() - start
+    start = time.perf_counter()
+    compiled = go_dag.propagate_annotations(go_annotations, dag)
+    propagate_time = time.perf_counter() - start
+    print(f"compiled DAG: {compile_time:.1f}s to compile, {propagate_time:.1f}s to propagate")
+
+    start = time.perf_counter()
+    go_dag.load_go_dag()
+    rsv.cache_clear()
+    go_dag.load_go_dag()
+    print(f"compiled DAG from the on disk cache: {time.perf_counter() - start:.2f}s")
+
+    assert canonical(reference).equals(canonical(compiled)), "results differ"
+    print(f"same {len(compiled)} annotations, {networkx_time / (compile_time + propagate_time):.1f}x faster")
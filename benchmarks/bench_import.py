@@ -0,0 +1,63 @@
+import os
+import sys
+import json
+import subprocess
+
+"""
+Times `import reservoir` in a fresh interpreter and checks that it stays cheap: it
+has to finish within a fixed budget, without opening anything in the data folder and
+without importing RDKit.
+
+    python benchmarks/bench_import.py [budget in seconds]
+
+Exits with an error when one of the checks fails.
+"""
+
+DEFAULT_BUDGET = 1.0
+RUNS = 5
+
+# runs in the fresh interpreter, an audit hook records every file opened
+PROBE = """
+import os, sys, json, time
+opened = []
+sys.addaudithook(lambda event, args: opened.append(str(args[0])) if event == "open" else None)
+start = time.perf_counter()
+import reservoir
+elapsed = time.perf_counter() - start
+data_folder = os.path.realpath(reservoir.RESERVOIR_DATA_FOLDER)
+print(json.dumps({
+    "seconds": elapsed,
+    "data_files": [p for p in opened if os.path.realpath(p).startswith(data_folder)],
+    "rdkit": "rdkit" in sys.modules,
+}))
+"""
+
+
+def probe():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE],
+        cwd=root,
+        env=dict(os.environ, PYTHONPATH=root + os.pathsep + os.environ.get("PYTHONPATH", "")),
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+
+    return json.loads(output.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_BUDGET
+
+    results = [probe() for _ in range(RUNS)]
+    seconds = sorted(result["seconds"] for result in results)
+    print(f"import reservoir: best {seconds[0]:.3f}s, median {seconds[len(seconds) // 2]:.3f}s")
+
+    data_files = sorted(set(path for result in results for path in result["data_files"]))
+    assert len(data_files) == 0, f"import reservoir opened data files: {data_files}"
+    assert not any(result["rdkit"] for result in results), "import reservoir imported rdkit"
+    assert seconds[len(seconds) // 2] < budget, (
+        f"import reservoir took {seconds[len(seconds) // 2]:.3f}s, the budget is {budget}s"
+    )
+    print(f"ok, under the {budget}s budget without touching the data folder")
@@ -0,0 +1,60 @@
+import sys
+import time
+import numpy as np
+from reservoir.parsers.drugs import molecule_tools
+from reservoir.parsers.drugs.similarity_index import SimilarityIndex
+
+"""
+Compares the top k search of the similarity index with a full scan of the library,
+on random fingerprints with a spread of bit counts similar to the drugs' Morgan ones.
+
+    python benchmarks/bench_similarity_search.py [library size] [queries]
+
+Exits with an error when the results differ.
+"""
+
+
+class RandomStore:
+    def __init__(self, size, seed=0):
+        rng = np.random.default_rng(seed)
+        bits = np.zeros((size, molecule_tools.MORGAN_BITS), dtype=bool)
+        counts = rng.integers(10, 120, size)
+        for i, count in enumerate(counts):
+            bits[i, rng.choice(molecule_tools.MORGAN_BITS, count, replace=False)] = True
+
+        self.recover_ids = np.arange(size)
+        self.fingerprints = np.packbits(bits, axis=1, bitorder="little").view(np.uint64)
+        self.valid = np.ones(size, dtype=bool)
+        self.counts = molecule_tools.popcount(self.fingerprints)
+
+
+def full_scan(query, store, k, min_tanimoto):
+    similarities = molecule_tools.tanimoto_one_to_many(query, store.fingerprints, store.counts)
+    rows = np.flatnonzero(similarities >= min_tanimoto)
+    rows = rows[np.argsort(-similarities[rows], kind="stable")][:k]
+    return similarities[rows]
+
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    n_queries = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    store = RandomStore(size)
+    index = SimilarityIndex(store)
+    queries = store.fingerprints[np.random.default_rng(1).choice(size, n_queries)]
+
+    for k, min_tanimoto in [(10, 0.0), (10, 0.3), (100, 0.0)]:
+        start = time.perf_counter()
+        expected = [full_scan(query, store, k, min_tanimoto) for query in queries]
+        scan_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        found = [index.search(query, k=k, min_tanimoto=min_tanimoto)[1] for query in queries]
+        index_time = time.perf_counter() - start
+
+        for a, b in zip(expected, found):
+            assert np.allclose(a, b), "the index and the full scan found different similarities"
+        print(
+            f"k={k} min_tanimoto={min_tanimoto}: full scan {scan_time:.2f}s, "
+            f"index {index_time:.2f}s ({scan_time / index_time:.1f}x)"
+        )
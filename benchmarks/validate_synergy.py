@@ -0,0 +1,194 @@
+import sys
+import time
+import numpy as np
+import pandas as pd
+import reservoir as rsv
+from reservoir import dose_response, synergy
+
+"""
+Checks the synergy scores computed from the dose response data, and exits with an error
+when one of them is off.
+
+    python benchmarks/validate_synergy.py [number of blocks] [processes]
+
+Synthetic blocks with known scores are always checked, so a regression is caught without
+the drug combo data. Then the scores of a random sample of number_of_blocks blocks are
+compared with the DrugComb scores shipped in the combos files, 0 blocks skips it.
+
+DrugComb fits its curves with drc in R, so Loewe and ZIP are not expected to match
+exactly, Bliss and HSA should be close for blocks with a single replicate.
+"""
+
+# largest absolute error allowed on the synthetic blocks
+SYNTHETIC_MAX_ERRORS = {"bliss": 1e-3, "hsa": 1e-3, "loewe": 1e-2, "zip": 1e-2}
+
+# minimum spearman correlation and largest median absolute difference with the shipped scores
+SHIPPED_THRESHOLDS = {
+    "bliss": (0.95, 1.0),
+    "hsa": (0.95, 1.0),
+    "loewe": (0.8, 5.0),
+    "zip": (0.8, 5.0),
+}
+
+
+def _logistic(concentrations, ic50, hill):
+    """ Increasing curve from 0 to 100, 0 at the zero dose
+    """
+
+    concentrations = np.asarray(concentrations, dtype=np.float64)
+    safe = np.where(concentrations > 0, concentrations, 1.0)
+    return np.where(concentrations > 0, 100 / (1 + (ic50 / safe) ** hill), 0.0)
+
+
+def synthetic_blocks(number_of_blocks=300, seed=0):
+    """ Blocks whose scores are known, a third of each kind:
+
+        bliss: Bliss independent drugs, all of the Bliss and ZIP scores are 0
+        shifted: the same with the combinations 5 points above, the Bliss scores are 5
+        sham: a drug combined with itself, all of the Loewe scores are 0
+
+    The HSA score of every block is computed from its matrix.
+
+    Returns:
+        measurements with one row per dose pair, and the expected scores of each block
+        (NaN when unknown)
+    """
+
+    rng = np.random.default_rng(seed)
+    measurements = []
+    expected = []
+    for block_id in range(number_of_blocks):
+        kind = ["bliss", "shifted", "sham"][block_id % 3]
+        # enough doses around the ic50 for the fits of the mono therapies to be exact
+        row_doses = np.r_[0, 10 ** np.linspace(-2, 1, rng.integers(5, 8))]
+        col_doses = np.r_[0, 10 ** np.linspace(-2, 1, rng.integers(5, 8))]
+        row_curve = (10 ** rng.uniform(-1.5, 0.5), rng.uniform(0.7, 2.5))
+        col_curve = (
+            row_curve if kind == "sham" else (10 ** rng.uniform(-1.5, 0.5), rng.uniform(0.7, 2.5))
+        )
+
+        row_monos = _logistic(row_doses, *row_curve)
+        col_monos = _logistic(col_doses, *col_curve)
+        if kind == "sham":
+            matrix = _logistic(row_doses[:, None] + col_doses[None, :], *row_curve)
+        else:
+            matrix = (
+                row_monos[:, None]
+                + col_monos[None, :]
+                - row_monos[:, None] * col_monos[None, :] / 100
+            )
+        if kind == "shifted":
+            matrix[1:, 1:] += 5
+
+        combinations = matrix[1:, 1:]
+        expected.append(
+            {
+                "block_id": block_id,
+                "kind": kind,
+                "synergy_bliss": {"bliss": 0.0, "shifted": 5.0}.get(kind, np.nan),
+                "synergy_hsa": np.mean(
+                    combinations - np.maximum(row_monos[1:, None], col_monos[None, 1:])
+                ),
+                "synergy_loewe": 0.0 if kind == "sham" else np.nan,
+                "synergy_zip": 0.0 if kind == "bliss" else np.nan,
+            }
+        )
+        for i, row_dose in enumerate(row_doses):
+            for j, col_dose in enumerate(col_doses):
+                measurements.append((block_id, row_dose, col_dose, matrix[i, j]))
+
+    measurements = pd.DataFrame(
+        measurements, columns=["block_id", "conc_r", "conc_c", "inhibition"]
+    )
+    return measurements, pd.DataFrame(expected)
+
+
+def check_synthetic(processes=1):
+    """ Largest error of each method on the synthetic blocks
+
+    Returns:
+        dataframe with the blocks checked, the largest error and whether it passes
+    """
+
+    measurements, expected = synthetic_blocks()
+    doses = dose_response.dose_response_matrices_from_frame(measurements)
+    computed = synergy.compute_synergy(doses, processes=processes)
+
+    merged = computed.merge(expected, on="block_id", suffixes=("", "_expected"))
+    rows = []
+    for method in synergy.METHODS:
+        both = merged[["synergy_" + method, "synergy_" + method + "_expected"]]
+        both = both.loc[both.iloc[:, 1].notnull()]
+        error = (both.iloc[:, 0] - both.iloc[:, 1]).abs().fillna(np.inf).max()
+        rows.append(
+            {
+                "method": method,
+                "blocks": len(both),
+                "max_abs_error": error,
+                "passed": error <= SYNTHETIC_MAX_ERRORS[method],
+            }
+        )
+
+    return pd.DataFrame(rows).set_index("method")
+
+
+def compare(computed, shipped):
+    """ Correlation and absolute differences of each method, and whether they pass
+    SHIPPED_THRESHOLDS
+    """
+
+    merged = computed.merge(shipped, on="block_id", suffixes=("", "_shipped"))
+    rows = []
+    for method in synergy.METHODS:
+        both = merged[["synergy_" + method, "synergy_" + method + "_shipped"]].dropna()
+        difference = (both.iloc[:, 0] - both.iloc[:, 1]).abs()
+        spearman = both.iloc[:, 0].corr(both.iloc[:, 1], method="spearman")
+        min_spearman, max_median_difference = SHIPPED_THRESHOLDS[method]
+        rows.append(
+            {
+                "method": method,
+                "blocks": len(both),
+                "pearson": both.iloc[:, 0].corr(both.iloc[:, 1]),
+                "spearman": spearman,
+                "mean_abs_difference": difference.mean(),
+                "median_abs_difference": difference.median(),
+                "passed": spearman >= min_spearman
+                and difference.median() <= max_median_difference,
+            }
+        )
+
+    return pd.DataFrame(rows).set_index("method")
+
+
+if __name__ == "__main__":
+    number_of_blocks = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+
+    results = check_synthetic(processes=processes)
+    print("Synthetic blocks")
+    print(results.round(6).to_string())
+    passed = bool(results["passed"].all())
+
+    if number_of_blocks > 0:
+        shipped = rsv.get_drug_combo_data_combos(qc_filtering="high")
+        shipped = shipped[["block_id"] + ["synergy_" + method for method in synergy.METHODS]]
+        rng = np.random.default_rng(0)
+        block_ids = rng.choice(
+            shipped["block_id"].to_numpy(),
+            size=min(number_of_blocks, len(shipped)),
+            replace=False,
+        )
+
+        doses = rsv.get_dose_response_matrices(block_ids=block_ids, qc_filtering="high")
+        start = time.perf_counter()
+        computed = synergy.compute_synergy(doses, processes=processes)
+        elapsed = time.perf_counter() - start
+        print(f"{len(computed)} blocks scored in {elapsed:.1f}s with {processes} processes")
+
+        results = compare(computed, shipped)
+        print(results.round(3).to_string())
+        passed = passed and bool(results["passed"].all())
+
+    if not passed:
+        print("Synergy validation failed")
+        sys.exit(1)
@@ -1,10 +1,37 @@
+import importlib
 import reservoir
 
 RESERVOIR_DATA_FOLDER = reservoir.__path__[0] + "/data"
 from reservoir.api import *
-from reservoir.parsers.drugs.molecule_mapper import map_drugs
-from reservoir.parsers.proteins.protein_mapper import (
-    hgnc_normalize,
-    map_covid_protein,
-)
-from reservoir.parsers.drugs.molecule_tools import *
+from reservoir.cache import cache_clear, cache_info, cache_resize
+from reservoir.identifiers import get_gene_dictionary, get_drug_dictionary
+
+# the mappers read their reference tables and RDKit is slow to import, so they are only
+# imported the first time one of these is used
+_LAZY_ATTRIBUTES = {
+    "map_drugs": "reservoir.parsers.drugs.molecule_mapper",
+    "hgnc_normalize": "reservoir.parsers.proteins.protein_mapper",
+    "map_covid_protein": "reservoir.parsers.proteins.protein_mapper",
+    "resolve_gene_ids": "reservoir.parsers.proteins.protein_mapper",
+    "fingerprint_similarity_from_fingerprint": "reservoir.parsers.drugs.molecule_tools",
+    "fingerprint_similarity_from_smiles": "reservoir.parsers.drugs.molecule_tools",
+    "get_fingerprint_store": "reservoir.parsers.drugs.molecule_tools",
+    "tanimoto_one_to_many": "reservoir.parsers.drugs.molecule_tools",
+    "tanimoto_many_to_many": "reservoir.parsers.drugs.molecule_tools",
+    "get_similarity_index": "reservoir.parsers.drugs.similarity_index",
+    "build_similarity_matrix": "reservoir.parsers.drugs.similarity_matrix",
+    "get_drug_features": "reservoir.parsers.drugs.drug_features",
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+        globals()[name] = value
+        return value
+
+    raise AttributeError(f"module 'reservoir' has no attribute '{name}'")
+
+
+def __dir__():
+    return sorted(set(globals()).union(_LAZY_ATTRIBUTES))
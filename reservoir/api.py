@@ -1,29 +1,41 @@
 import reservoir as rsv
 import pandas as pd
 import os
+import itertools
 import numpy as np
+from reservoir import storage, block_store, dose_response, synergy, mono_fits, identifiers
+from reservoir.disk_cache import DiskCache
+from reservoir.cache import dataset_cache, copy_of
+from reservoir.ppi_index import get_ppi_index
+from reservoir.parsers.drugs import combo_qc
 
 
-def get_ppis(ppi_file, gene_hgnc_ids=set([])):
+def get_ppis(ppi_file, gene_hgnc_ids=set([]), columns=None, id_format="string"):
     """ Returns a specific ppi file
+
+    Args:
+        ppi_file: one of the files in available_ppis()
+        gene_hgnc_ids: keep only interactions involving one of these genes
+        columns: list of columns to read, all of them if None
+        id_format: "string" for the gene ids, "categorical" for pandas Categoricals or
+            "codes" for their int32 codes, see reservoir.identifiers
     """
 
     if type(gene_hgnc_ids) not in [type([]), type(set([]))]:
         raise Exception("Gene HGCN ids need to be provided in a list or set")
 
-    # get ppis
-    ppis = pd.read_csv(f"{rsv.RESERVOIR_DATA_FOLDER}/parsed/ppi/{ppi_file}")
-
     if len(gene_hgnc_ids) > 0:
-        # filtering by gene hgcn ids
-        gene_hgnc_ids = set(gene_hgnc_ids)
-        ppis = ppis.loc[
-            ppis.apply(
-                lambda row: row["gene_1_hgnc_id"] in gene_hgnc_ids
-                or row["gene_2_hgnc_id"] in gene_hgnc_ids,
-                axis=1,
-            )
-        ]
+        # filtering by gene hgcn ids using the adjacency index of the file
+        return identifiers.format_id_columns(
+            get_ppi_index(ppi_file).incident_edges(gene_hgnc_ids, columns=columns), id_format
+        )
+
+    # get ppis
+    ppis = storage.read_table(
+        f"{rsv.RESERVOIR_DATA_FOLDER}/parsed/ppi/{ppi_file}",
+        columns=columns,
+        id_format=id_format,
+    )
 
     return ppis
 
@@ -41,20 +53,32 @@ def available_ppis():
     return csv_files
 
 
-def get_dtis(dti_file, recover_ids=set([])):
+def get_dtis(dti_file, recover_ids=set([]), columns=None, id_format="string"):
     """ Returns a specific dti file
+
+    Args:
+        dti_file: one of the files in available_dtis()
+        recover_ids: keep only interactions for these drugs
+        columns: list of columns to read, all of them if None
+        id_format: "string" for the drug and gene ids, "categorical" for pandas Categoricals
+            or "codes" for their int32 codes, see reservoir.identifiers
     """
 
     if type(recover_ids) not in [type([]), type(set([]))]:
         raise Exception("Recover IDs need to be provided in a list or set")
 
-    # get dtis
-    dtis = pd.read_csv(f"{rsv.RESERVOIR_DATA_FOLDER}/parsed/dti/{dti_file}")
-
+    # filtering by recover ids, pushed down into the scan
+    filters = None
     if len(recover_ids) > 0:
-        # filtering by recover ids
-        recover_ids = set(recover_ids)
-        dtis = dtis.loc[dtis.recover_id.apply(lambda re_id: re_id in recover_ids)]
+        filters = [("recover_id", "in", set(recover_ids))]
+
+    # get dtis
+    dtis = storage.read_table(
+        f"{rsv.RESERVOIR_DATA_FOLDER}/parsed/dti/{dti_file}",
+        columns=columns,
+        filters=filters,
+        id_format=id_format,
+    )
 
     return dtis
 
@@ -72,53 +96,79 @@ def available_dtis():
     return csv_files
 
 
-from reservoir.parsers.drugs import molecule_mapper
-
-
-def get_drugs(filter=set([])):
+def get_drugs(filter=set([]), columns=None):
     """Returns the drugs in the Recover database with names, smiles and relation ids
     """
 
     if type(filter) not in [type([]), type(set([]))]:
         raise Exception("Recover IDs need to be provided in a list or set")
 
-    recover_drugs = pd.read_csv(
-        f"{rsv.RESERVOIR_DATA_FOLDER}/parsed/drugs/recover_drugs.csv"
-    )
-
+    # filtering by recover ids, pushed down into the scan
+    filters = None
     if len(filter) > 0:
-        # filtering by recover ids
-        filter = set(filter)
-        recover_drugs = recover_drugs.loc[
-            recover_drugs.recover_id.apply(lambda re_id: re_id in filter)
-        ]
+        filters = [("recover_id", "in", set(filter))]
+
+    recover_drugs = storage.read_table(
+        f"{rsv.RESERVOIR_DATA_FOLDER}/parsed/drugs/recover_drugs.csv",
+        columns=columns,
+        filters=filters,
+    )
 
     return recover_drugs
 
 
-def get_proteins():
+def get_proteins(columns=None):
     """Returns all of the available human proteins in the Relation database
     """
 
-    return pd.read_csv(
-        f"{rsv.RESERVOIR_DATA_FOLDER}/parsed/proteins/human_proteins.csv"
+    return storage.read_table(
+        f"{rsv.RESERVOIR_DATA_FOLDER}/parsed/proteins/human_proteins.csv",
+        columns=columns,
     )
 
 
-def get_covid_proteins():
+def get_covid_proteins(columns=None):
     """ Returns all of the covid proteins
     """
 
-    return pd.read_csv(
-        f"{rsv.RESERVOIR_DATA_FOLDER}/parsed/proteins/covid_proteins.csv"
+    return storage.read_table(
+        f"{rsv.RESERVOIR_DATA_FOLDER}/parsed/proteins/covid_proteins.csv",
+        columns=columns,
     )
 
 
-def get_gene_ontology_evidence_categories():
+def _use_lazy_gene_ontology(lazy):
+    """ Decides if GO annotations are expanded at query time from the leaf annotations
+
+    By default the fully propagated table is used when it exists and isn't older than
+    the leaf annotations, i.e. it was made by the last parse
+    """
+
+    if lazy is None:
+        full_path = f"{rsv.RESERVOIR_DATA_FOLDER}/parsed/proteins/gene_ontology.csv"
+        leaf_path = f"{rsv.RESERVOIR_DATA_FOLDER}/parsed/proteins/gene_ontology_leaf.csv"
+        if not os.path.exists(storage.table_path(full_path)):
+            return True
+
+        # the parser writes the leaf csv before the full one, the parquet copies are
+        # exported later so only the csv files are compared
+        if os.path.exists(full_path) and os.path.exists(leaf_path):
+            return os.path.getmtime(full_path) < os.path.getmtime(leaf_path)
+
+        return False
+
+    return lazy
+
+
+def get_gene_ontology_evidence_categories(lazy=None):
     """ Get the types of evidence for the GO annotations
     """
 
-    go = pd.read_csv(f"{rsv.RESERVOIR_DATA_FOLDER}/parsed/proteins/gene_ontology.csv")
+    go_file = "gene_ontology_leaf.csv" if _use_lazy_gene_ontology(lazy) else "gene_ontology.csv"
+    go = storage.read_table(
+        f"{rsv.RESERVOIR_DATA_FOLDER}/parsed/proteins/{go_file}",
+        columns=["evidence_category"],
+    )
     return list(go["evidence_category"].unique())
 
 
@@ -128,6 +178,9 @@ def get_gene_ontology(
     evidence_category=None,
     aspect=None,
     max_distance_from_root=None,
+    columns=None,
+    lazy=None,
+    id_format="string",
 ):
     """
     Returns gene ontology annotations. These can be filtered by genes or by aspect
@@ -138,6 +191,12 @@ def get_gene_ontology(
         aspect: "cellular_component" or "biological_process" or "molecular_function"
         max_distance_from_root: int indicate max hops from root
         evidence_category: string filter for the type of evidence for the annotation. sugest using "experimental evidence"
+        columns: list of columns to read, all of them if None
+        lazy: if True, expand the leaf annotations to their ancestors only for this query
+            instead of reading the fully propagated table. By default this is only done
+            when the propagated table doesn't exist
+        id_format: "string" for the gene ids, "categorical" for pandas Categoricals or
+            "codes" for their int32 codes, see reservoir.identifiers
     """
 
     if type(gene_hgnc_ids) not in [type([]), type(set([]))]:
@@ -146,101 +205,215 @@ def get_gene_ontology(
     if type(go_ids) not in [type([]), type(set([]))]:
         raise Exception("Gene HGCN ids need to be provided in a list or set")
 
-    go = pd.read_csv(f"{rsv.RESERVOIR_DATA_FOLDER}/parsed/proteins/gene_ontology.csv")
+    if _use_lazy_gene_ontology(lazy):
+        return identifiers.format_id_columns(
+            _expand_gene_ontology(
+                gene_hgnc_ids, go_ids, evidence_category, aspect, max_distance_from_root, columns
+            ),
+            id_format,
+        )
 
     # get rid of roots and also non-connected components (-1)
-    go = go.loc[go.distance_from_root > 0]
+    filters = [("distance_from_root", ">", 0)]
 
     # apply gene filter if present
     if len(gene_hgnc_ids) > 0:
-        go = go.loc[
-            go.gene_hgnc_id.apply(lambda gene_hgnc_id: gene_hgnc_id in gene_hgnc_ids)
-        ]
+        filters.append(("gene_hgnc_id", "in", set(gene_hgnc_ids)))
 
     # apply go term filter if present
     if len(go_ids) > 0:
-        go = go.loc[go.go_id.isin(go_ids)]
+        filters.append(("go_id", "in", set(go_ids)))
 
     # apply aspect filter if present
     if aspect != None:
-        go = go.loc[go.aspect == aspect]
+        filters.append(("aspect", "==", aspect))
 
     # apply max_distance_from_root id present
     if not max_distance_from_root is None:
-        go = go.loc[go.distance_from_root <= max_distance_from_root]
+        filters.append(("distance_from_root", "<=", max_distance_from_root))
 
     # apply evidence category filter if present
     if not evidence_category is None:
-        go = go.loc[go.evidence_category == evidence_category]
+        filters.append(("evidence_category", "==", evidence_category))
+
+    # the filters are pushed down into the scan
+    go = storage.read_table(
+        f"{rsv.RESERVOIR_DATA_FOLDER}/parsed/proteins/gene_ontology.csv",
+        columns=columns,
+        filters=filters,
+        id_format=id_format,
+    )
+
+    return go
+
+
+def _expand_gene_ontology(
+    gene_hgnc_ids, go_ids, evidence_category, aspect, max_distance_from_root, columns
+):
+    """ Gene ontology annotations built at query time from the leaf annotations
+    """
+
+    from reservoir.parsers.proteins import go_dag
+
+    # gene and evidence filters are pushed down into the scan of the leaf annotations
+    filters = []
+    if len(gene_hgnc_ids) > 0:
+        filters.append(("gene_hgnc_id", "in", set(gene_hgnc_ids)))
+    if not evidence_category is None:
+        filters.append(("evidence_category", "==", evidence_category))
+
+    leaf_annotations = storage.read_table(
+        f"{rsv.RESERVOIR_DATA_FOLDER}/parsed/proteins/gene_ontology_leaf.csv",
+        filters=filters,
+    )
+
+    go = go_dag.expand_annotations(
+        leaf_annotations,
+        go_dag.load_go_dag(),
+        go_ids=go_ids,
+        aspect=aspect,
+        max_distance_from_root=max_distance_from_root,
+    )
+
+    if columns is not None:
+        go = go[list(columns)]
 
     return go
 
 
-def get_gene_onotology_embeddings(distance_from_root=2, evidence_category=None):
+def get_gene_onotology_embeddings(
+    distance_from_root=2, evidence_category=None, output="dataframe"
+):
     """
     Create embeddings for proteins based on whether a protein has a label or not
 
     Args:
         distance_from_root: int indicating at which distance from the root we should make the embeddings
         evidence_category: string filter for the type of evidence for the annotation. suggest using "experimental evidence"
+        output: "dataframe" for a dataframe with one embedding array per gene,
+            "sparse" for a (scipy csr_matrix, genes, terms) tuple or
+            "dense" for a (float32 numpy array, genes, terms) tuple.
+            The rows of the matrices follow the order of get_proteins()
     """
 
+    if output not in ["dataframe", "sparse", "dense"]:
+        raise ValueError(f"Unknown output {output}, use dataframe, sparse or dense")
+
     # get human proteins
-    human_proteins = rsv.get_proteins()
+    human_proteins = rsv.get_proteins(columns=["gene_hgnc_id"])
 
     # extract the required go annotations
-    go = rsv.get_gene_ontology(evidence_category=evidence_category)
+    go = rsv.get_gene_ontology(
+        evidence_category=evidence_category,
+        max_distance_from_root=distance_from_root,
+        columns=["gene_hgnc_id", "go_id", "distance_from_root"],
+    )
     go = go.loc[go.distance_from_root == distance_from_root]
+    go = go[["gene_hgnc_id", "go_id"]].drop_duplicates()
 
-    # creates embedding by checking each unique term if it's present
-    def create_go_embedding(terms_for_gene, unique_terms):
-        terms_for_gene = set(terms_for_gene["go_id"])
-        return np.array([1 if term in terms_for_gene else 0 for term in unique_terms])
-
-    # identify all terms and then create embedding from annotations
+    # identify all terms and genes, annotated genes missing from the proteins go last
     unique_terms = go["go_id"].unique()
-    embeddings = (
-        go.groupby("gene_hgnc_id")
-        .apply(lambda rows: create_go_embedding(rows, unique_terms))
-        .reset_index()
-        .rename(columns={0: "embedding"})
+    genes = pd.Index(human_proteins["gene_hgnc_id"]).drop_duplicates()
+    genes = genes.append(
+        pd.Index(go["gene_hgnc_id"].unique()).difference(genes).sort_values()
     )
 
-    # some proteins do not have annotations. create embeddings with all 0s
-    missing_proteins = set(human_proteins["gene_hgnc_id"]).difference(
-        set(embeddings["gene_hgnc_id"])
-    )
-    missing_proteins_embeddings = pd.DataFrame(
+    # position of each annotation in the embedding matrix
+    rows = genes.get_indexer(go["gene_hgnc_id"])
+    columns = pd.Index(unique_terms).get_indexer(go["go_id"])
+
+    if output == "sparse":
+        from scipy import sparse
+
+        embeddings = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, columns)),
+            shape=(len(genes), len(unique_terms)),
+        )
+        return embeddings, genes.to_numpy(), unique_terms
+
+    embeddings = np.zeros((len(genes), len(unique_terms)), dtype=np.float32)
+    embeddings[rows, columns] = 1
+
+    if output == "dense":
+        return embeddings, genes.to_numpy(), unique_terms
+
+    # annotated genes first, sorted, and then the proteins without annotations
+    annotated = np.zeros(len(genes), dtype=bool)
+    annotated[rows] = True
+    order = np.concatenate(
         [
-            {"gene_hgnc_id": gene, "embedding": np.array([0] * len(unique_terms))}
-            for gene in missing_proteins
+            np.flatnonzero(annotated)[np.argsort(genes[annotated], kind="stable")],
+            np.flatnonzero(~annotated),
         ]
     )
+    embedding_rows = embeddings.astype(int)
+
+    annotated_embeddings = pd.DataFrame(
+        {
+            "gene_hgnc_id": genes[order[: annotated.sum()]],
+            "embedding": list(embedding_rows[order[: annotated.sum()]]),
+        }
+    )
+    missing_proteins_embeddings = pd.DataFrame(
+        {
+            "gene_hgnc_id": genes[order[annotated.sum():]],
+            "embedding": list(embedding_rows[order[annotated.sum():]]),
+        }
+    )
 
-    return pd.concat([embeddings, missing_proteins_embeddings])
+    return pd.concat([annotated_embeddings, missing_proteins_embeddings])
 
 
 def get_block_mask(
         qc_filtering='high',
+        min_std=None,
+        mean_range=None,
+        min_grid=None,
+        min_combo_measurements=None,
 ):
     """
     Returns a DrugComb dataframe mask according to quality control level.
+    When the block statistics are available the mask is evaluated from them, and
+    any of the thresholds can be changed. Thresholds that are not given come
+    from the qc_filtering preset.
 
     Args:
         qc_filtering: Quality control filter leve. One of "high", "medium", or "off".
+        min_std: minimum standard deviation of the combo inhibitions (exclusive)
+        mean_range: (low, high) range for the mean combo inhibition, low included
+        min_grid: minimum number of distinct concentrations of each drug in the combo matrix
+        min_combo_measurements: minimum number of measurements in the combo matrix
     """
     path = "/parsed/drug_combos/"
 
+    stats_file = rsv.RESERVOIR_DATA_FOLDER + path + "block_stats.csv"
+    thresholds = combo_qc.qc_thresholds(
+        qc_filtering,
+        min_std=min_std,
+        mean_range=mean_range,
+        min_grid=min_grid,
+        min_combo_measurements=min_combo_measurements,
+    )
+
+    if os.path.exists(storage.table_path(stats_file)):
+        return combo_qc.block_mask(storage.read_table(stats_file), **thresholds)
+
+    # the preset masks were computed with the preset thresholds only
+    if thresholds != combo_qc.qc_thresholds(qc_filtering):
+        raise Exception(
+            "Custom quality control thresholds need block_stats.csv, run the drug combos parser again"
+        )
+
     if qc_filtering == 'high':
-        block_mask = pd.read_csv(
+        block_mask = storage.read_table(
             rsv.RESERVOIR_DATA_FOLDER + path + "block_mask_hq.csv",
         )
     elif qc_filtering == 'medium':
-        block_mask = pd.read_csv(
+        block_mask = storage.read_table(
             rsv.RESERVOIR_DATA_FOLDER + path + "block_mask.csv",
         )
     elif qc_filtering == 'off':
-        block_mask = pd.read_csv(
+        block_mask = storage.read_table(
             rsv.RESERVOIR_DATA_FOLDER + path + "block_mask_hq.csv",
         )
         block_mask['mask'] = True
@@ -255,18 +428,43 @@ def get_specific_drug_combo_blocks(
         study_name=None,
         cell_line_name=None,
         qc_filtering='high',
+        columns=None,
 ):
     """ Used to pre-select combo blocks by metadata.
     Various types of heuristics were used to determine the quality of a block.
     The parameter qc_filtering determines how many blocks are filtered out
     according to these heuristics. Options are 'high' 'medium' 'off'
+    The metadata filters are pushed down into the scan, columns selects what to read.
     """
 
     path = "/parsed/drug_combos/"
 
+    filters = []
+
+    if not mono_row_measurements is None:
+        filters.append(("mono_row_measurements", "==", mono_row_measurements))
+
+    if not mono_col_measurements is None:
+        filters.append(("mono_col_measurements", "==", mono_col_measurements))
+
+    if not combo_measurements is None:
+        filters.append(("combo_measurements", "==", combo_measurements))
+
+    if not study_name is None:
+        filters.append(("study_name", "==", study_name))
+
+    if not cell_line_name is None:
+        filters.append(("cell_line_name", "==", cell_line_name))
 
-    dc_summary_data = pd.read_csv(
+    # the block id is always needed to apply the mask
+    read_columns = columns
+    if columns is not None and "block_id" not in columns:
+        read_columns = ["block_id"] + list(columns)
+
+    dc_summary_data = storage.read_table(
         rsv.RESERVOIR_DATA_FOLDER + path + "summary_data.csv",
+        columns=read_columns,
+        filters=filters,
         low_memory=False,
     )
     dc_block_mask = get_block_mask(qc_filtering=qc_filtering)
@@ -277,97 +475,403 @@ def get_specific_drug_combo_blocks(
 
     summary_data = dc_summary_data
 
-    if not mono_row_measurements is None:
-        summary_data = summary_data.loc[
-            summary_data["mono_row_measurements"] == mono_row_measurements
-            ]
+    if columns is not None:
+        summary_data = summary_data[list(columns)]
 
-    if not mono_col_measurements is None:
-        summary_data = summary_data.loc[
-            summary_data["mono_col_measurements"] == mono_col_measurements
-            ]
+    return summary_data
 
-    if not combo_measurements is None:
-        summary_data = summary_data.loc[
-            summary_data["combo_measurements"] == combo_measurements
-            ]
 
-    if not study_name is None:
-        summary_data = summary_data.loc[summary_data["study_name"] == study_name]
+def _selected_block_ids(block_ids, qc_filtering):
+    """ Ids of the blocks that pass quality control, restricted to block_ids if given
+    """
 
-    if not cell_line_name is None:
-        summary_data = summary_data.loc[
-            summary_data["cell_line_name"] == cell_line_name
-            ]
+    dc_block_mask = get_block_mask(qc_filtering=qc_filtering)
+    selected_block_ids = dc_block_mask.loc[dc_block_mask["mask"].astype(bool), "block_id"]
+    if not block_ids is None:
+        selected_block_ids = selected_block_ids.loc[selected_block_ids.isin(set(block_ids))]
+
+    return selected_block_ids
+
+
+def _get_block_store(json_path):
+    """ Returns the block store of a parsed json file
+    """
+
+    store_path = block_store.store_path(json_path)
+    return dataset_cache.load(
+        store_path, "block_store", lambda: block_store.BlockStore(store_path)
+    )
+
+
+def _current_block_store(json_path):
+    """ Returns the block store of a parsed json file, None if there is none or if it was
+    made from another version of the json file
+    """
+
+    if not os.path.exists(block_store.store_path(json_path)):
+        return None
+
+    store = _get_block_store(json_path)
+    return store if store.matches(json_path) else None
 
-    return summary_data
+
+def _read_drug_combo_blocks(json_path, block_ids, qc_filtering, as_arrays):
+    """ Reads the blocks of a drug combo file that pass quality control
+
+    Without as_arrays the json file is read, and the blocks are in file order with lists
+    in the ragged columns. With it the blocks are sorted by block_id with float32 arrays,
+    read from the block store when it is up to date.
+    """
+
+    store = _current_block_store(json_path) if as_arrays else None
+    if store is not None:
+        return store.get(_selected_block_ids(block_ids, qc_filtering))
+
+    # filtered without copying the cached file, only the selected blocks are copied
+    data = dataset_cache.load(
+        json_path, "json", lambda: pd.read_json(json_path), copy=False
+    )
+    dc_block_mask = get_block_mask(qc_filtering=qc_filtering)
+
+    # use mask to filter out low quality blocks
+    dc_block_mask = dc_block_mask.set_index('block_id').squeeze().reindex(data.block_id)
+    data = data.loc[dc_block_mask.values, :]
+
+    if not block_ids is None:
+        data = data.loc[data.block_id.isin(set(block_ids))]
+
+    if as_arrays:
+        return block_store.as_block_arrays(data)
+
+    return copy_of(data)
 
 
 def get_drug_combo_data_monos(
         block_ids=None,
         qc_filtering='high',
+        as_arrays=False,
 ):
     """Get mono therapy data.
     Various types of heuristics were used to determine the quality of a block.
     The parameter qc_filtering determines how many blocks are filtered out
     according to these heuristics. Options are 'high' 'medium' 'off'
+    With as_arrays the blocks are sorted by block_id and the concentrations and
+    inhibitions are float32 arrays, and when the block store is up to date only
+    the requested blocks are read.
     """
 
     path = "/parsed/drug_combos/"
 
-    dc_mono_data = pd.read_json(
-        rsv.RESERVOIR_DATA_FOLDER + path + "mono_therapy.json"
-    )
-    dc_block_mask = get_block_mask(qc_filtering=qc_filtering)
-
-    # use mask to filter out low quality blocks
-    dc_block_mask = dc_block_mask.set_index('block_id').squeeze().reindex(dc_mono_data.block_id)
-    dc_mono_data = dc_mono_data.loc[dc_block_mask.values, :]
-
-    mono_data = dc_mono_data
-
-    if not block_ids is None:
-        mono_data = mono_data.loc[mono_data.block_id.isin(set(block_ids))]
-
-    return mono_data
+    mono_file = rsv.RESERVOIR_DATA_FOLDER + path + "mono_therapy.json"
+    return _read_drug_combo_blocks(mono_file, block_ids, qc_filtering, as_arrays)
 
 
 def get_drug_combo_data_combos(
         block_ids=None,
         qc_filtering='high',
+        as_arrays=False,
 ):
     """ Get combination therapy data.
     Various types of heuristics were used to determine the quality of a block.
     The parameter qc_filtering determines how many blocks are filtered out
     according to these heuristics. Options are 'high' 'medium' 'off'.
+    With as_arrays the blocks are sorted by block_id and the concentration pairs
+    and inhibitions are float32 arrays, and when the block store is up to date
+    only the requested blocks are read.
+    """
+
+    path = "/parsed/drug_combos/"
+
+    combo_file = rsv.RESERVOIR_DATA_FOLDER + path + "combos.json"
+    return _read_drug_combo_blocks(combo_file, block_ids, qc_filtering, as_arrays)
+
+
+def _drug_combo_block_reader(json_path, as_arrays):
+    """ Returns the columns and block ids of a drug combo file, and a function reading
+    some of its blocks (with some of its columns) in the order of the given ids
+
+    With as_arrays the blocks are read from the block store, which has to be up to date,
+    otherwise from the json file held in the cache
+    """
+
+    if as_arrays:
+        store = _current_block_store(json_path)
+        if store is None:
+            raise Exception(
+                f"The block store of {json_path} is missing or out of date, write it with "
+                "python reservoir/parsers/drugs/export_block_store.py"
+            )
+        return store.columns, store.block_ids, lambda ids, columns: store.get(ids, columns)
+
+    # only the blocks of each batch are copied out of the cached file
+    data = dataset_cache.load(json_path, "json", lambda: pd.read_json(json_path), copy=False)
+    block_index = pd.Index(data["block_id"])
+
+    def read(ids, columns):
+        positions = block_index.get_indexer(ids)
+        return copy_of(data.iloc[positions[positions >= 0]][columns])
+
+    return list(data.columns), data["block_id"].to_numpy(), read
+
+
+def iter_drug_combo_blocks(
+        batch_size=1000,
+        qc_filtering='high',
+        columns=None,
+        block_ids=None,
+        as_arrays=False,
+):
+    """ Iterates over the drug combo blocks in batches, in block order.
+    Each batch has the combo data of get_drug_combo_data_combos for batch_size blocks,
+    joined with the mono therapy concentrations and inhibitions of the same blocks.
+    Blocks are filtered with the same quality control as get_drug_combo_data_combos.
+
+    Without as_arrays the ragged columns are lists, as in get_drug_combo_data_combos, and
+    the json files are parsed and kept in the cache. With as_arrays they are float32
+    arrays read from the block stores, and only one batch is in memory at a time. The
+    block stores then need to be up to date, see export_block_store.py
+
+    Args:
+        batch_size: number of blocks per batch
+        qc_filtering: Quality control filter level. One of "high", "medium", or "off"
+        columns: list of combo and mono columns to return, all of them if None
+        block_ids: iterate only over these blocks
+        as_arrays: read the block stores, see get_drug_combo_data_combos
     """
 
     path = "/parsed/drug_combos/"
 
-    dc_combo_data = pd.read_json(
-        rsv.RESERVOIR_DATA_FOLDER + path + "combos.json"
+    if batch_size < 1:
+        raise ValueError("batch_size needs to be at least 1")
+
+    combo_columns, combo_block_ids, read_combos = _drug_combo_block_reader(
+        rsv.RESERVOIR_DATA_FOLDER + path + "combos.json", as_arrays
     )
-    dc_block_mask = get_block_mask(qc_filtering=qc_filtering)
+    mono_columns, _, read_monos = _drug_combo_block_reader(
+        rsv.RESERVOIR_DATA_FOLDER + path + "mono_therapy.json", as_arrays
+    )
+    # the drugs and cell line are the same in both files
+    mono_columns = [c for c in mono_columns if c not in combo_columns]
+
+    all_columns = combo_columns + mono_columns
+    if columns is None:
+        columns = all_columns
+    columns = list(columns)
+    missing_columns = set(columns).difference(all_columns)
+    if len(missing_columns) > 0:
+        raise Exception(f"Columns {sorted(missing_columns)} are not in the drug combo data")
+
+    read_combo_columns = ["block_id"] + [
+        c for c in combo_columns if c in columns and c != "block_id"
+    ]
+    read_mono_columns = ["block_id"] + [c for c in mono_columns if c in columns]
 
-    # use mask to filter out low quality blocks
-    dc_block_mask = dc_block_mask.set_index('block_id').squeeze().reindex(dc_combo_data.block_id)
-    dc_combo_data = dc_combo_data.loc[dc_block_mask.values, :]
+    selected_block_ids = _selected_block_ids(block_ids, qc_filtering).to_numpy()
+    selected_block_ids = np.sort(
+        selected_block_ids[np.isin(selected_block_ids, combo_block_ids)]
+    )
 
-    combo_data = dc_combo_data
+    for start in range(0, len(selected_block_ids), batch_size):
+        batch_block_ids = selected_block_ids[start:start + batch_size]
 
+        combos = read_combos(batch_block_ids, read_combo_columns)
+        if len(read_mono_columns) > 1:
+            monos = read_monos(batch_block_ids, read_mono_columns)
+            combos = combos.join(monos.set_index("block_id"), on="block_id")
 
-    if not block_ids is None:
-        combo_data = combo_data.loc[combo_data.block_id.isin(set(block_ids))]
+        yield combos[columns]
 
-    return combo_data
 
+def _read_ragged_values(json_path, block_ids, columns):
+    """ Flat values and offsets of some ragged columns of a drug combo file
+
+    Returns:
+        the ids of the blocks found, sorted, and for each column the values of
+        these blocks concatenated and the offsets of each block
+    """
 
-def get_cell_line_features(cell_line_names):
+    store = _current_block_store(json_path)
+    if store is not None:
+        rows = store.rows(block_ids)
+        return store.block_ids[rows], {
+            column: store.ragged_values(column, rows) for column in columns
+        }
+
+    data = dataset_cache.load(json_path, "json", lambda: pd.read_json(json_path), copy=False)
+    data = data.loc[data["block_id"].isin(set(block_ids))].sort_values("block_id")
+
+    ragged_values = {}
+    for column in columns:
+        lengths = data[column].apply(len).to_numpy(dtype=np.int64)
+        values = np.array(list(itertools.chain.from_iterable(data[column])), dtype=np.float32)
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        ragged_values[column] = (values, offsets)
+
+    return data["block_id"].to_numpy(), ragged_values
+
+
+def get_dose_response_matrices(
+        block_ids=None,
+        qc_filtering='high',
+        pad_value=np.nan,
+):
+    """ Dose response matrices of the drug combo blocks, as padded float32 tensors.
+    Index 0 of both concentration axes is the zero dose: the first column holds the mono
+    therapy of the row drug, the first row the mono therapy of the col drug and the
+    rest the combination matrix.
+    Blocks are filtered with the same quality control as get_drug_combo_data_combos.
+
+    Args:
+        block_ids: blocks to return, all of them if None
+        qc_filtering: Quality control filter level. One of "high", "medium", or "off"
+        pad_value: value of the cells without a measurement
+
+    Returns:
+        DoseResponseMatrices with
+            block_ids: (n_blocks,) sorted ids of the blocks
+            matrices: (n_blocks, max_row_conc + 1, max_col_conc + 1) inhibitions
+            row_concentrations: (n_blocks, max_row_conc + 1) NaN padded
+            col_concentrations: (n_blocks, max_col_conc + 1) NaN padded
+            mask: boolean array of the measured cells of the matrices
+    """
+
+    path = "/parsed/drug_combos/"
+
+    selected_block_ids = _selected_block_ids(block_ids, qc_filtering).to_numpy()
+
+    combo_block_ids, combos = _read_ragged_values(
+        rsv.RESERVOIR_DATA_FOLDER + path + "combos.json",
+        selected_block_ids,
+        ["concentration_pairs", "inhibitions"],
+    )
+    mono_block_ids, monos = _read_ragged_values(
+        rsv.RESERVOIR_DATA_FOLDER + path + "mono_therapy.json",
+        combo_block_ids,
+        ["conc_r", "inhibition_r", "conc_c", "inhibition_c"],
+    )
+
+    # block position of every measurement
+    def blocks_of(offsets, positions):
+        return np.repeat(positions, np.diff(offsets))
+
+    combo_positions = np.arange(len(combo_block_ids))
+    mono_positions = np.searchsorted(combo_block_ids, mono_block_ids)
+
+    pairs, pair_offsets = combos["concentration_pairs"]
+    pairs = pairs.reshape(-1, 2)
+    conc_r, conc_r_offsets = monos["conc_r"]
+    conc_c, conc_c_offsets = monos["conc_c"]
+
+    return dose_response.build_dose_response_matrices(
+        combo_block_ids,
+        blocks=np.concatenate([
+            blocks_of(pair_offsets, combo_positions),
+            blocks_of(conc_r_offsets, mono_positions),
+            blocks_of(conc_c_offsets, mono_positions),
+        ]),
+        row_concentrations=np.concatenate([pairs[:, 0], conc_r, np.zeros(len(conc_c))]),
+        col_concentrations=np.concatenate([pairs[:, 1], np.zeros(len(conc_r)), conc_c]),
+        inhibitions=np.concatenate([
+            combos["inhibitions"][0], monos["inhibition_r"][0], monos["inhibition_c"][0]
+        ]),
+        pad_value=pad_value,
+    )
+
+
+def get_synergy_scores(
+        block_ids=None,
+        qc_filtering='high',
+        methods=None,
+        processes=1,
+        use_cache=True,
+):
+    """ Synergy scores computed from the dose response data of the drug combo blocks,
+    instead of the ones copied from the DrugComb summary in the combos files.
+    Scores are stored in a disk cache keyed by the content of each block, so they are
+    only computed again for blocks whose measurements changed.
+    To score other measurements, e.g. in house data, use
+    synergy.compute_synergy(dose_response.dose_response_matrices_from_frame(data))
+
+    Args:
+        block_ids: blocks to score, all of them if None
+        qc_filtering: Quality control filter level. One of "high", "medium", or "off"
+        methods: list of methods among "bliss", "hsa", "loewe" and "zip", all of them if None
+        processes: number of processes used to fit the dose response curves
+        use_cache: whether to use the disk cache of the scores
+
+    Returns:
+        dataframe with block_id and a synergy_<method> column per method
+    """
+
+    return synergy.compute_synergy(
+        get_dose_response_matrices(block_ids=block_ids, qc_filtering=qc_filtering),
+        methods=synergy.METHODS if methods is None else methods,
+        processes=processes,
+        cache=DiskCache("synergy") if use_cache else None,
+    )
+
+
+def get_mono_therapy_fits(
+        block_ids=None,
+        qc_filtering='high',
+        processes=1,
+        use_cache=True,
+):
+    """ 4 parameter logistic fits of the mono therapy curves of the drug combo blocks,
+    one row per block and side ("row" or "col" drug).
+    Fits are stored in a disk cache keyed by block, side and measurements, so they are
+    only computed again for new or changed curves.
+
+    Args:
+        block_ids: blocks to fit, all of them if None
+        qc_filtering: Quality control filter level. One of "high", "medium", or "off"
+        processes: number of processes used for the fits
+        use_cache: whether to use the disk cache of the fits
+
+    Returns:
+        dataframe with block_id, side, recover_id, cell_line_name, bottom, emax, ic50,
+        hill, sse, r_squared and measurements
+    """
+
+    return mono_fits.fit_mono_therapies(
+        get_drug_combo_data_monos(block_ids=block_ids, qc_filtering=qc_filtering),
+        processes=processes,
+        cache=DiskCache("mono_fits") if use_cache else None,
+    )
+
+
+def _read_cell_line_table(file_name, cell_line_ids, columns):
+    """ Reads one of the cell line tables only for some cell lines and features
+    """
+
+    csv_path = rsv.RESERVOIR_DATA_FOLDER + "/parsed/cell_lines/" + file_name
+
+    # keep the requested features that exist in this table
+    if columns is not None:
+        available_columns = set(storage.read_columns(csv_path))
+        columns = ["cell_line_id"] + [
+            column
+            for column in columns
+            if column in available_columns and column != "cell_line_id"
+        ]
+
+    return storage.read_table(
+        csv_path,
+        columns=columns,
+        filters=[("cell_line_id", "in", cell_line_ids)],
+    )
+
+
+def get_cell_line_features(cell_line_names, columns=None):
     """ Get gene expression, mutation, and copy number variation features for some cell lines
+
+    Args:
+        cell_line_names: list of cell line names
+        columns: list of features (e.g. gene hgnc ids) to read, all of them if None
     """
 
     # get mapper
-    cell_id_mapper = pd.read_csv(rsv.RESERVOIR_DATA_FOLDER + "/parsed/cell_lines/cell_line_aliases.csv")
+    cell_id_mapper = storage.read_table(rsv.RESERVOIR_DATA_FOLDER + "/parsed/cell_lines/cell_line_aliases.csv")
     cell_id_mapper = dict(zip(cell_id_mapper["alias"], cell_id_mapper["cell_line_id"]))
 
     # clean and try to map to id
@@ -382,10 +886,11 @@ def get_cell_line_features(cell_line_names):
         )
 
     mapped_cell_lines = pd.DataFrame(mapped_cell_lines)
+    cell_line_ids = set(mapped_cell_lines["cell_line_id"]) if len(mapped_cell_lines) > 0 else set()
 
     # get expression data
-    cell_line_gene_expression = pd.read_csv(
-        rsv.RESERVOIR_DATA_FOLDER + "/parsed/cell_lines/cell_line_gene_expression.csv"
+    cell_line_gene_expression = _read_cell_line_table(
+        "cell_line_gene_expression.csv", cell_line_ids, columns
     )
     # add back the name of the requested cell line
     cell_line_gene_expression = mapped_cell_lines[["cell_line_name", "cell_line_id"]].merge(
@@ -396,8 +901,8 @@ def get_cell_line_features(cell_line_names):
     cell_lst = cell_line_gene_expression.index.tolist()
 
     # get mutation data
-    cell_line_gene_mutation = pd.read_csv(
-        rsv.RESERVOIR_DATA_FOLDER + "/parsed/cell_lines/cell_line_gene_mutation.csv"
+    cell_line_gene_mutation = _read_cell_line_table(
+        "cell_line_gene_mutation.csv", cell_line_ids, columns
     )
     # add back the name of the requested cell line
     cell_line_gene_mutation = mapped_cell_lines[["cell_line_name", "cell_line_id"]].merge(
@@ -407,8 +912,8 @@ def get_cell_line_features(cell_line_names):
     cell_line_gene_mutation = cell_line_gene_mutation.set_index("cell_line_name").loc[cell_lst]
 
     # get copy number data
-    cell_line_gene_cn = pd.read_csv(
-        rsv.RESERVOIR_DATA_FOLDER + "/parsed/cell_lines/cell_line_gene_copy_number.csv"
+    cell_line_gene_cn = _read_cell_line_table(
+        "cell_line_gene_copy_number.csv", cell_line_ids, columns
     )
     # add back the name of the requested cell line
     cell_line_gene_cn = mapped_cell_lines[["cell_line_name", "cell_line_id"]].merge(
@@ -418,8 +923,8 @@ def get_cell_line_features(cell_line_names):
     cell_line_gene_cn = cell_line_gene_cn.set_index("cell_line_name").loc[cell_lst]
 
     # get cell metadata
-    cell_line_metadata = pd.read_csv(
-        rsv.RESERVOIR_DATA_FOLDER + "/parsed/cell_lines/cell_line_metadata.csv"
+    cell_line_metadata = _read_cell_line_table(
+        "cell_line_metadata.csv", cell_line_ids, None
     )
     # add back the name of the requested cell line
     cell_line_metadata = mapped_cell_lines[["cell_line_name", "cell_line_id"]].merge(
@@ -445,6 +950,6 @@ def get_inhouse_data(experiment_round):
     file_name = "oncology_combos_round" + str(experiment_round) + ".csv"
     parsed_file = rsv.RESERVOIR_DATA_FOLDER + folder + file_name
 
-    combo_data = pd.read_csv(parsed_file)
+    combo_data = storage.read_table(parsed_file)
 
     return combo_data
@@ -0,0 +1,25 @@
+import numpy as np
+
+
+def csr_positions(indptr, rows):
+    """ Positions in the CSR arrays of all of the entries of some rows
+    """
+
+    starts = indptr[rows]
+    counts = indptr[rows + 1] - starts
+    shifts = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+
+    return np.arange(counts.sum()) + shifts
+
+
+def csr_from_lists(lists):
+    """ Flattens a list of integer lists into CSR indptr and indices arrays
+    """
+
+    lengths = np.fromiter((len(values) for values in lists), dtype=np.int64, count=len(lists))
+    indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    indices = np.fromiter(
+        (value for values in lists for value in values), dtype=np.int64, count=indptr[-1]
+    )
+
+    return indptr, indices
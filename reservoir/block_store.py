@@ -0,0 +1,257 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+from reservoir.array_tools import csr_positions
+from reservoir.cache import file_signature
+
+"""
+Random access storage for the drug combo blocks.
+
+Every block has a few scalar fields and a few ragged arrays (concentration pairs,
+inhibitions...). The scalar fields are stored as a small dataframe sorted by block_id,
+and each ragged column as one flat float32 array of values plus an int64 offsets array
+with one entry per block, both memory mapped. Reading some blocks only touches their
+rows of the flat arrays and doesn't need any json decoding.
+
+The layout records the signature of the json file the store was made from, a store
+that doesn't match its json file anymore is stale and isn't used by the api.
+"""
+
+VALUE_DTYPE = np.float32
+LAYOUT_FILE = "layout.json"
+FRAME_FILE = "frame.pickle"
+
+
+def store_path(json_path):
+    """ Returns the location of the block store of a parsed json file
+    """
+
+    return os.path.splitext(json_path)[0] + ".blocks"
+
+
+def is_ragged(column):
+    """ Columns holding a list of values per block
+    """
+
+    for value in column:
+        if isinstance(value, (list, tuple, np.ndarray)):
+            return True
+        if not pd.isnull(value):
+            return False
+
+    return False
+
+
+def _json_signature(signature):
+    return [list(entry) for entry in signature]
+
+
+def write_block_store(frame, path, source_path=None):
+    """ Writes the blocks of a dataframe with one row per block
+
+    Missing values in the ragged columns are stored as empty arrays.
+
+    Args:
+        frame: dataframe with a block_id column
+        path: folder of the block store
+        source_path: json file the frame was read from, or written to. Its signature
+            is stored to detect a store made from another version of the file
+    """
+
+    if "block_id" not in frame.columns:
+        raise Exception("The block store needs a block_id column")
+
+    if frame["block_id"].duplicated().any():
+        raise Exception("Block ids need to be unique to build a block store")
+
+    frame = frame.sort_values("block_id", kind="stable")
+    ragged_columns = [c for c in frame.columns if is_ragged(frame[c])]
+
+    tmp_path = path + ".tmp"
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    value_shapes = {}
+    for column in ragged_columns:
+        arrays = [
+            np.asarray(value, dtype=VALUE_DTYPE)
+            if isinstance(value, (list, tuple, np.ndarray))
+            else np.empty(0, dtype=VALUE_DTYPE)
+            for value in frame[column]
+        ]
+
+        # inner shape of each entry, e.g. (2,) for concentration pairs
+        value_shape = next((a.shape[1:] for a in arrays if a.size > 0), ())
+        arrays = [a.reshape((-1,) + value_shape) for a in arrays]
+        value_shapes[column] = list(value_shape)
+
+        lengths = np.fromiter((len(a) for a in arrays), dtype=np.int64, count=len(arrays))
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        values = (
+            np.concatenate(arrays)
+            if len(arrays) > 0
+            else np.empty((0,) + value_shape, dtype=VALUE_DTYPE)
+        )
+
+        np.save(os.path.join(tmp_path, f"{column}.offsets.npy"), offsets)
+        np.save(os.path.join(tmp_path, f"{column}.values.npy"), values)
+
+    np.save(
+        os.path.join(tmp_path, "block_ids.npy"),
+        frame["block_id"].to_numpy(dtype=np.int64),
+    )
+    frame.drop(columns=ragged_columns).to_pickle(os.path.join(tmp_path, FRAME_FILE))
+
+    with open(os.path.join(tmp_path, LAYOUT_FILE), "w") as f:
+        json.dump(
+            {
+                "columns": list(frame.columns),
+                "ragged_columns": value_shapes,
+                "source_signature": (
+                    None if source_path is None else _json_signature(file_signature(source_path))
+                ),
+            },
+            f,
+        )
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+    return path
+
+
+class BlockStore:
+    """ Memory mapped blocks of a parsed drug combo file, see write_block_store
+    """
+
+    cache_shared = True
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(os.path.join(path, LAYOUT_FILE)) as f:
+            layout = json.load(f)
+        self.columns = layout["columns"]
+        self.value_shapes = {
+            column: tuple(shape) for column, shape in layout["ragged_columns"].items()
+        }
+        self.source_signature = layout.get("source_signature")
+
+        self.block_ids = np.load(os.path.join(path, "block_ids.npy"))
+        self.frame = pd.read_pickle(os.path.join(path, FRAME_FILE))
+        self.offsets = {}
+        self.values = {}
+        for column in self.value_shapes:
+            self.offsets[column] = np.load(os.path.join(path, f"{column}.offsets.npy"))
+            self.values[column] = np.load(
+                os.path.join(path, f"{column}.values.npy"), mmap_mode="r"
+            )
+
+    def __sizeof__(self):
+        # the values are memory mapped and not counted
+        return (
+            int(self.frame.memory_usage(deep=True).sum())
+            + self.block_ids.nbytes
+            + sum(offsets.nbytes for offsets in self.offsets.values())
+        )
+
+    def matches(self, json_path):
+        """ Whether the store was made from the current version of a json file
+        """
+
+        return (
+            self.source_signature is not None
+            and os.path.exists(json_path)
+            and self.source_signature == _json_signature(file_signature(json_path))
+        )
+
+    @property
+    def ragged_columns(self):
+        return list(self.value_shapes)
+
+    @property
+    def number_of_blocks(self):
+        return len(self.block_ids)
+
+    def rows(self, block_ids):
+        """ Rows of some blocks in the store, blocks that are not in the store are ignored
+        """
+
+        block_ids = np.unique(np.asarray(list(block_ids), dtype=np.int64))
+        if self.number_of_blocks == 0:
+            return np.array([], dtype=np.int64)
+
+        rows = np.minimum(np.searchsorted(self.block_ids, block_ids), self.number_of_blocks - 1)
+        return rows[self.block_ids[rows] == block_ids]
+
+    def ragged_values(self, column, rows):
+        """ Values of a ragged column for some rows, as flat values and offsets
+        """
+
+        offsets = self.offsets[column]
+        rows = np.asarray(rows, dtype=np.int64)
+        lengths = offsets[rows + 1] - offsets[rows]
+        values = np.asarray(self.values[column][csr_positions(offsets, rows)])
+
+        return values, np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+    def get(self, block_ids=None, columns=None):
+        """ Returns some blocks as a dataframe with one row per block, sorted by block_id
+
+        Ragged columns hold one float32 array per block.
+
+        Args:
+            block_ids: blocks to read, all of them if None
+            columns: list of columns to read, all of them if None
+        """
+
+        if block_ids is None:
+            rows = np.arange(self.number_of_blocks)
+        else:
+            rows = self.rows(block_ids)
+
+        columns = self.columns if columns is None else list(columns)
+        missing_columns = set(columns).difference(self.columns)
+        if len(missing_columns) > 0:
+            raise Exception(f"Columns {sorted(missing_columns)} are not in the block store")
+
+        blocks = self.frame.iloc[rows][
+            [column for column in columns if column not in self.value_shapes]
+        ].copy()
+        for column in columns:
+            if column in self.value_shapes:
+                values, offsets = self.ragged_values(column, rows)
+                # fromiter keeps one array per block even when they all have the same length
+                blocks[column] = np.fromiter(
+                    np.split(values, offsets[1:-1]) if len(rows) > 0 else [],
+                    dtype=object,
+                    count=len(rows),
+                )
+
+        return blocks[columns]
+
+
+def as_block_arrays(frame):
+    """ A dataframe read from a json file in the format of BlockStore.get: sorted by
+    block_id, with one float32 array per block in the ragged columns
+    """
+
+    frame = frame.sort_values("block_id", kind="stable").copy()
+    for column in frame.columns:
+        if is_ragged(frame[column]):
+            frame[column] = np.fromiter(
+                (
+                    np.asarray(value, dtype=VALUE_DTYPE)
+                    if isinstance(value, (list, tuple, np.ndarray))
+                    else np.empty(0, dtype=VALUE_DTYPE)
+                    for value in frame[column]
+                ),
+                dtype=object,
+                count=len(frame),
+            )
+
+    return frame
@@ -0,0 +1,231 @@
+import os
+import sys
+import copy
+import pickle
+import threading
+from collections import OrderedDict, namedtuple
+import numpy as np
+import pandas as pd
+
+# budget for the in-memory cache of parsed tables, 0 disables the cache
+DEFAULT_MAX_BYTES = int(os.environ.get("RESERVOIR_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "entries", "currsize", "maxsize"])
+CacheEntry = namedtuple("CacheEntry", ["signature", "value", "size"])
+
+
+def file_signature(path):
+    """ Identifies the version of a file (or a partitioned folder) by mtime and size
+    """
+
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return ((stat.st_mtime_ns, stat.st_size),)
+
+    signature = []
+    for root, _, files in sorted(os.walk(path)):
+        for file in sorted(files):
+            stat = os.stat(os.path.join(root, file))
+            signature.append((file, stat.st_mtime_ns, stat.st_size))
+
+    return tuple(signature)
+
+
+def size_of(value):
+    """ Approximate memory used by a cached value
+    """
+
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(value.memory_usage(deep=True).sum())
+
+    if isinstance(value, pd.Index):
+        return int(value.memory_usage(deep=True))
+
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(size_of(item) for item in value)
+
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(size_of(item) for item in value.values())
+
+    return sys.getsizeof(value)
+
+
+def _holds_containers(values):
+    """ Whether an object column holds lists, arrays... (e.g. the inhibitions of each block)
+    instead of strings, judging by its first non missing value
+    """
+
+    for value in values:
+        if isinstance(value, (list, tuple, dict, set, np.ndarray)):
+            return True
+        if not pd.isnull(value):
+            return False
+
+    return False
+
+
+def _copy_objects(values):
+    """ Copy of an object array that also copies the containers it holds
+    """
+
+    # much faster than copy.deepcopy for many small lists
+    return pickle.loads(pickle.dumps(values, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def copy_of(value):
+    """ Copy returned to callers so that they can't modify the cached value
+
+    pandas and numpy copies don't copy the python objects in the cells, so object columns
+    holding containers are copied deeply. Read only structures (e.g. compiled indexes) set
+    cache_shared and are not copied
+    """
+
+    if getattr(value, "cache_shared", False):
+        return value
+
+    if isinstance(value, pd.DataFrame):
+        value = value.copy()
+        for column in value.columns[value.dtypes == object]:
+            if _holds_containers(value[column].to_numpy()):
+                value[column] = _copy_objects(value[column].to_numpy())
+        return value
+
+    if isinstance(value, pd.Series):
+        if value.dtype == object and _holds_containers(value.to_numpy()):
+            return pd.Series(_copy_objects(value.to_numpy()), index=value.index.copy(), name=value.name)
+        return value.copy()
+
+    if isinstance(value, np.ndarray):
+        if value.dtype == object and _holds_containers(value.ravel()):
+            return _copy_objects(value)
+        return value.copy()
+
+    if isinstance(value, pd.Index):
+        return value.copy()
+
+    return copy.deepcopy(value)
+
+
+class DatasetCache:
+    """ LRU cache of loaded datasets bounded by their size in bytes
+
+    Entries are keyed by the path of the file they were loaded from and by how they
+    were loaded (columns, filters...). An entry is invalidated as soon as the mtime or
+    size of its file changes.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._currsize = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.RLock()
+
+    def load(self, path, key, loader, copy=True):
+        """ Returns a copy of the cached value or calls loader to build it
+
+        Args:
+            path: the file the value is loaded from
+            key: hashable description of how the file is loaded
+            loader: function without arguments returning the value
+            copy: False returns the cached value itself, for internal reads that only
+                select part of it and copy that part. It must not be modified
+        """
+
+        signature = file_signature(path)
+        cache_key = (path, key)
+
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None and entry.signature == signature:
+                self._hits += 1
+                self._entries.move_to_end(cache_key)
+                return copy_of(entry.value) if copy else entry.value
+
+            # the file changed, everything loaded from it is stale
+            if entry is not None:
+                self._invalidate(path)
+
+            self._misses += 1
+
+        value = loader()
+        size = size_of(value)
+
+        with self._lock:
+            if size <= self.max_bytes:
+                if cache_key in self._entries:
+                    self._currsize -= self._entries.pop(cache_key).size
+                self._entries[cache_key] = CacheEntry(signature, value, size)
+                self._currsize += size
+                self._evict()
+
+        return copy_of(value) if copy else value
+
+    def _invalidate(self, path):
+        """ Drops all of the entries loaded from a file
+        """
+
+        for cache_key in [k for k in self._entries if k[0] == path]:
+            self._currsize -= self._entries.pop(cache_key).size
+
+    def _evict(self):
+        """ Drops the least recently used entries until the cache fits in its budget
+        """
+
+        while self._currsize > self.max_bytes and len(self._entries) > 0:
+            _, entry = self._entries.popitem(last=False)
+            self._currsize -= entry.size
+
+    def clear(self):
+        """ Drops all of the entries and resets the statistics
+        """
+
+        with self._lock:
+            self._entries.clear()
+            self._currsize = 0
+            self._hits = 0
+            self._misses = 0
+
+    def info(self):
+        """ Returns the cache statistics
+        """
+
+        with self._lock:
+            return CacheInfo(
+                hits=self._hits,
+                misses=self._misses,
+                entries=len(self._entries),
+                currsize=self._currsize,
+                maxsize=self.max_bytes,
+            )
+
+
+# shared by all of the api readers
+dataset_cache = DatasetCache()
+
+
+def cache_clear():
+    """ Empties the process wide dataset cache
+    """
+
+    dataset_cache.clear()
+
+
+def cache_info():
+    """ Returns hits, misses, number of entries, bytes used and byte budget of the dataset cache
+    """
+
+    return dataset_cache.info()
+
+
+def cache_resize(max_bytes):
+    """ Changes the byte budget of the dataset cache, evicting entries if needed
+    """
+
+    with dataset_cache._lock:
+        dataset_cache.max_bytes = max_bytes
+        dataset_cache._evict()
@@ -0,0 +1,110 @@
+import os
+import pickle
+import sqlite3
+import threading
+
+"""
+Persistent key value cache for results that are slow to compute (synergy scores, fits...).
+
+Each cache is a sqlite file in RESERVOIR_CACHE_DIR (~/.cache/reservoir by default).
+Keys are strings that identify the inputs of a computation, e.g. a hash of the data of
+a block and the version of the method, so stale results are never returned and the
+cache never needs to be invalidated by hand.
+"""
+
+DEFAULT_CACHE_FOLDER = os.path.join(os.path.expanduser("~"), ".cache", "reservoir")
+
+# sqlite limits the number of parameters of a query
+BATCH_SIZE = 500
+
+
+def cache_folder():
+    """ Folder of the disk caches, can be changed with the RESERVOIR_CACHE_DIR variable
+    """
+
+    return os.environ.get("RESERVOIR_CACHE_DIR", DEFAULT_CACHE_FOLDER)
+
+
+class DiskCache:
+    """ Pickled values stored in a sqlite file, safe to use from several threads and processes
+    """
+
+    def __init__(self, name, folder=None):
+        self.path = os.path.join(folder or cache_folder(), f"{name}.sqlite")
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+
+    def _connect(self):
+        # connections can't be shared with forked processes
+        if self._connection is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB)"
+            )
+            connection.commit()
+            self._connection = connection
+            self._pid = os.getpid()
+
+        return self._connection
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+
+    def __len__(self):
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def get_many(self, keys):
+        """ Returns a dictionary with the values of the keys that are in the cache
+        """
+
+        keys = list(keys)
+        values = {}
+        with self._lock:
+            connection = self._connect()
+            for start in range(0, len(keys), BATCH_SIZE):
+                batch = keys[start:start + BATCH_SIZE]
+                rows = connection.execute(
+                    f"SELECT key, value FROM entries WHERE key IN ({','.join('?' * len(batch))})",
+                    batch,
+                )
+                for key, value in rows:
+                    values[key] = pickle.loads(value)
+
+        return values
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, items):
+        """ Stores the values of a dictionary, in one transaction
+        """
+
+        rows = [
+            (key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+            for key, value in items.items()
+        ]
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO entries (key, value) VALUES (?, ?)", rows
+                )
+
+    def clear(self):
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute("DELETE FROM entries")
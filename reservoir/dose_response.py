@@ -0,0 +1,321 @@
+import warnings
+from collections import namedtuple
+import numpy as np
+
+"""
+Dose response matrices of the drug combo blocks.
+
+Each block is a grid with the row drug concentrations on the first axis and the col
+drug concentrations on the second one. Index 0 of both axes is the zero dose, so the
+first column holds the mono therapy of the row drug, the first row the mono therapy
+of the col drug, and the rest of the grid the combinations.
+"""
+
+DoseResponseMatrices = namedtuple(
+    "DoseResponseMatrices",
+    ["block_ids", "matrices", "row_concentrations", "col_concentrations", "mask"],
+)
+
+
+def concentration_axis(blocks, concentrations, number_of_blocks):
+    """ Sorted distinct concentrations of every block, starting with the zero dose
+
+    Args:
+        blocks: block position of each measurement
+        concentrations: concentration of each measurement
+        number_of_blocks: number of blocks
+
+    Returns:
+        position of each measurement on the axis of its block, and the axes as a
+        (number_of_blocks, axis size) array padded with NaN
+    """
+
+    blocks = np.concatenate([np.arange(number_of_blocks), blocks])
+    concentrations = np.concatenate([np.zeros(number_of_blocks), concentrations])
+
+    order = np.lexsort((concentrations, blocks))
+    sorted_blocks = blocks[order]
+    sorted_concentrations = concentrations[order]
+
+    is_new = np.ones(len(order), dtype=bool)
+    is_new[1:] = (sorted_blocks[1:] != sorted_blocks[:-1]) | (
+        sorted_concentrations[1:] != sorted_concentrations[:-1]
+    )
+    groups = np.cumsum(is_new) - 1
+
+    # every block has at least the zero dose, which comes first
+    block_starts = np.searchsorted(sorted_blocks, np.arange(number_of_blocks))
+    ranks = groups - groups[block_starts][sorted_blocks]
+
+    positions = np.empty(len(order), dtype=np.int64)
+    positions[order] = ranks
+
+    axis_size = int(ranks.max()) + 1 if len(ranks) > 0 else 1
+    axes = np.full((number_of_blocks, axis_size), np.nan, dtype=np.float32)
+    axes[sorted_blocks[is_new], ranks[is_new]] = sorted_concentrations[is_new]
+
+    return positions[number_of_blocks:], axes
+
+
+def build_dose_response_matrices(
+    block_ids, blocks, row_concentrations, col_concentrations, inhibitions, pad_value=np.nan
+):
+    """ Puts the measurements of some blocks on padded dose grids
+
+    Measurements with a missing concentration or inhibition are ignored, repeated
+    measurements of the same pair of concentrations are averaged.
+
+    Args:
+        block_ids: ids of the blocks, in the order of the output
+        blocks: position in block_ids of each measurement
+        row_concentrations: row drug concentration of each measurement, 0 for the col mono therapy
+        col_concentrations: col drug concentration of each measurement, 0 for the row mono therapy
+        inhibitions: inhibition of each measurement
+        pad_value: value of the grid cells without a measurement
+
+    Returns:
+        DoseResponseMatrices with float32 matrices of shape (blocks, rows, cols), the
+        concentrations of each axis (NaN padded) and the mask of measured cells
+    """
+
+    number_of_blocks = len(block_ids)
+    blocks = np.asarray(blocks, dtype=np.int64)
+    row_concentrations = np.asarray(row_concentrations, dtype=np.float64)
+    col_concentrations = np.asarray(col_concentrations, dtype=np.float64)
+    inhibitions = np.asarray(inhibitions, dtype=np.float64)
+
+    valid = ~(np.isnan(row_concentrations) | np.isnan(col_concentrations) | np.isnan(inhibitions))
+    blocks = blocks[valid]
+    inhibitions = inhibitions[valid]
+
+    rows, row_axes = concentration_axis(blocks, row_concentrations[valid], number_of_blocks)
+    cols, col_axes = concentration_axis(blocks, col_concentrations[valid], number_of_blocks)
+
+    shape = (number_of_blocks, row_axes.shape[1], col_axes.shape[1])
+    sums = np.zeros(shape)
+    counts = np.zeros(shape, dtype=np.int64)
+    np.add.at(sums, (blocks, rows, cols), inhibitions)
+    np.add.at(counts, (blocks, rows, cols), 1)
+
+    mask = counts > 0
+    matrices = np.full(shape, pad_value, dtype=np.float32)
+    matrices[mask] = sums[mask] / counts[mask]
+
+    return DoseResponseMatrices(
+        block_ids=np.asarray(block_ids),
+        matrices=matrices,
+        row_concentrations=row_axes,
+        col_concentrations=col_axes,
+        mask=mask,
+    )
+
+
+def dose_response_matrices_from_frame(
+    measurements,
+    block_column="block_id",
+    row_concentration_column="conc_r",
+    col_concentration_column="conc_c",
+    inhibition_column="inhibition",
+    pad_value=np.nan,
+):
+    """ Dose response matrices from a table with one row per measurement, e.g. in house
+    experiments. Mono therapies are the rows with a zero concentration of the other drug
+    """
+
+    block_ids, blocks = np.unique(measurements[block_column].to_numpy(), return_inverse=True)
+
+    return build_dose_response_matrices(
+        block_ids,
+        blocks,
+        measurements[row_concentration_column].to_numpy(dtype=np.float64),
+        measurements[col_concentration_column].to_numpy(dtype=np.float64),
+        measurements[inhibition_column].to_numpy(dtype=np.float64),
+        pad_value=pad_value,
+    )
+
+
+# 4 parameter logistic curves, parameters are (bottom, top, log ic50, hill)
+PARAMETERS = ["bottom", "top", "log_ic50", "hill"]
+HILL_RANGE = (0.1, 10.0)
+
+
+def logistic(concentrations, parameters):
+    """ Response of 4 parameter logistic curves, the zero dose gives the bottom
+
+    Args:
+        concentrations: (curves, points) array
+        parameters: (curves, 4) array of bottom, top, log ic50 and hill
+    """
+
+    response, _ = _logistic_and_jacobian(concentrations, parameters, jacobian=False)
+    return response
+
+
+def _logistic_and_jacobian(concentrations, parameters, jacobian=True):
+    bottom, top, log_ic50, hill = [parameters[:, [i]] for i in range(4)]
+
+    dosed = concentrations > 0
+    log_concentrations = np.log(np.where(dosed, concentrations, 1.0))
+    exponent = np.clip(hill * (log_ic50 - log_concentrations), -50, 50)
+
+    # fraction of the way from bottom to top
+    fraction = np.where(dosed, 1.0 / (1.0 + np.exp(exponent)), 0.0)
+    response = bottom + (top - bottom) * fraction
+
+    if not jacobian:
+        return response, None
+
+    slope = fraction * (1.0 - fraction) * (top - bottom)
+    derivatives = np.stack(
+        [
+            1.0 - fraction,
+            fraction,
+            -slope * hill,
+            -slope * (log_ic50 - log_concentrations),
+        ],
+        axis=-1,
+    )
+
+    return response, derivatives
+
+
+def initial_parameters(concentrations, responses, mask):
+    """ Starting point for fitting curves: observed range, median dose and a hill of 1
+    """
+
+    observed = np.where(mask, responses, np.nan)
+    with np.errstate(invalid="ignore"), warnings.catch_warnings():
+        # all-nan rows of empty curves
+        warnings.simplefilter("ignore", RuntimeWarning)
+        bottom = np.nanmin(observed, axis=1)
+        top = np.nanmax(observed, axis=1)
+        dosed = np.where(mask & (concentrations > 0), concentrations, np.nan)
+        log_ic50 = np.log(np.nanmedian(dosed, axis=1))
+
+    return np.nan_to_num(
+        np.stack([bottom, top, log_ic50, np.ones(len(bottom))], axis=1)
+    )
+
+
+def fit_logistic(
+    concentrations,
+    responses,
+    mask=None,
+    initial=None,
+    fixed=None,
+    iterations=100,
+    tolerance=1e-8,
+):
+    """ Fits many 4 parameter logistic curves at once with Levenberg-Marquardt
+
+    All of the curves are updated together with batched linear algebra, each one with
+    its own damping. Hill slopes are kept in HILL_RANGE and log ic50s within a few
+    orders of magnitude of the tested doses.
+
+    Args:
+        concentrations: (curves, points) array, zero doses are allowed
+        responses: (curves, points) array
+        mask: (curves, points) boolean array of the points to use, all of them if None
+        initial: (curves, 4) starting parameters, see initial_parameters
+        fixed: (curves, 4) boolean array of the parameters to keep at their initial value
+        iterations: maximum number of iterations
+        tolerance: relative decrease of the squared error below which a curve stops
+
+    Returns:
+        (curves, 4) fitted parameters and (curves,) sum of squared residuals
+    """
+
+    concentrations = np.asarray(concentrations, dtype=np.float64)
+    responses = np.asarray(responses, dtype=np.float64)
+    if mask is None:
+        mask = ~np.isnan(responses)
+    mask = mask & ~np.isnan(responses) & ~np.isnan(concentrations)
+    concentrations = np.where(mask, concentrations, 0.0)
+    responses = np.where(mask, responses, 0.0)
+
+    if initial is None:
+        initial = initial_parameters(concentrations, responses, mask)
+    parameters = np.array(initial, dtype=np.float64)
+    free = np.ones(parameters.shape, dtype=bool) if fixed is None else ~np.asarray(fixed)
+
+    # keep the ic50 close to the tested doses
+    dosed = np.where(mask & (concentrations > 0), concentrations, np.nan)
+    with np.errstate(invalid="ignore"), warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        log_ic50_range = (
+            np.nan_to_num(np.log(np.nanmin(dosed, axis=1)), nan=0.0) - 5,
+            np.nan_to_num(np.log(np.nanmax(dosed, axis=1)), nan=0.0) + 5,
+        )
+
+    def clip(parameters, curves=slice(None)):
+        low, high = log_ic50_range
+        parameters[:, 2] = np.clip(parameters[:, 2], low[curves], high[curves])
+        parameters[:, 3] = np.clip(parameters[:, 3], *HILL_RANGE)
+        return parameters
+
+    parameters = clip(parameters)
+    error = squared_error(concentrations, responses, mask, parameters)
+    damping = np.full(len(parameters), 1e-3)
+    active = np.ones(len(parameters), dtype=bool)
+    identity = np.eye(4)
+
+    for _ in range(iterations):
+        if not active.any():
+            break
+
+        current = parameters[active]
+        response, jacobian = _logistic_and_jacobian(concentrations[active], current)
+        residuals = (responses[active] - response) * mask[active]
+        jacobian = jacobian * mask[active][:, :, None] * free[active][:, None, :]
+
+        normal = np.einsum("cpi,cpj->cij", jacobian, jacobian)
+        gradient = np.einsum("cpi,cp->ci", jacobian, residuals)
+
+        # damped normal equations, fixed parameters get an identity row so they don't move
+        scale = np.einsum("cii->ci", normal) + 1e-12
+        system = normal + (damping[active][:, None] * scale)[:, :, None] * identity
+        system = system + (~free[active])[:, :, None] * identity
+        step = np.linalg.solve(system, gradient[:, :, None])[:, :, 0]
+
+        candidate = clip(current + step, active)
+        candidate_error = squared_error(
+            concentrations[active], responses[active], mask[active], candidate
+        )
+        improved = candidate_error < error[active]
+
+        indexes = np.flatnonzero(active)
+        parameters[indexes[improved]] = candidate[improved]
+        converged = improved & (
+            error[active] - candidate_error <= tolerance * (error[active] + 1e-12)
+        )
+        error[indexes[improved]] = candidate_error[improved]
+        damping[indexes] = np.where(improved, damping[indexes] / 3, damping[indexes] * 3)
+
+        # stop curves that converged or can't improve anymore
+        active[indexes[converged | (damping[indexes] > 1e10)]] = False
+
+    return parameters, error
+
+
+def squared_error(concentrations, responses, mask, parameters):
+    """ Sum of the squared residuals of the masked points of each curve
+    """
+
+    response = logistic(concentrations, parameters)
+    return (((responses - response) * mask) ** 2).sum(axis=1)
+
+
+def inverse_logistic(responses, parameters):
+    """ Concentrations giving some responses, NaN outside of the range of the curves
+
+    Args:
+        responses: (curves, points) array
+        parameters: (curves, 4) array of bottom, top, log ic50 and hill
+    """
+
+    bottom, top, log_ic50, hill = [parameters[:, [i]] for i in range(4)]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ratio = (responses - bottom) / (top - responses)
+        concentrations = np.exp(log_ic50 + np.log(ratio) / hill)
+
+    return np.where(ratio > 0, concentrations, np.nan)
@@ -0,0 +1,264 @@
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+import reservoir as rsv
+from reservoir import storage
+from reservoir.cache import dataset_cache, file_signature
+
+"""
+Integer ids of the genes and drugs, shared by all of the parsed tables.
+
+The gene of code i is the i-th gene of human_proteins.csv, the same order as get_proteins()
+and the PPI index nodes, and the drug of code i is the i-th drug of recover_drugs.csv. The
+parquet copies of the PPI, DTI and GO tables store their gene and drug columns as int32
+codes, -1 for missing or unknown ids, and read_table turns them back into strings,
+pandas Categoricals or leaves the codes, see ID_FORMATS. Codes are returned as nullable
+Int32 columns with pd.NA for the missing and unknown ids.
+"""
+
+# columns holding gene or drug ids, and the dictionary they are encoded with
+ID_COLUMNS = {
+    "gene_hgnc_id": "gene",
+    "gene_1_hgnc_id": "gene",
+    "gene_2_hgnc_id": "gene",
+    "recover_id": "drug",
+}
+
+ID_FORMATS = ["string", "categorical", "codes"]
+
+CODE_DTYPE = np.int32
+
+DICTIONARY_SOURCES = {
+    "gene": ("parsed/proteins/human_proteins.csv", "gene_hgnc_id"),
+    "drug": ("parsed/drugs/recover_drugs.csv", "recover_id"),
+}
+
+
+class IdentifierDictionary:
+    """ Maps ids to their position in a reference table and back
+    """
+
+    cache_shared = True
+
+    def __init__(self, values):
+        self.values = np.asarray(
+            pd.unique(pd.Series(values, dtype=object).dropna()), dtype=object
+        )
+        self.index = pd.Index(self.values)
+
+        # codes are only valid for the dictionary they were made with
+        self.signature = hashlib.sha1("\n".join(map(str, self.values)).encode()).hexdigest()
+
+    def __len__(self):
+        return len(self.values)
+
+    def __sizeof__(self):
+        return self.values.nbytes + self.index.memory_usage()
+
+    def encode(self, ids):
+        """ Codes of some ids, -1 for missing and unknown ones
+        """
+
+        if isinstance(ids, pd.Categorical) or isinstance(
+            getattr(ids, "dtype", None), pd.CategoricalDtype
+        ):
+            # only the categories need a lookup
+            ids = pd.Categorical(ids)
+            category_codes = np.append(self.index.get_indexer(ids.categories), -1)
+            return category_codes[ids.codes].astype(CODE_DTYPE)
+
+        return self.index.get_indexer(pd.Index(ids, dtype=object)).astype(CODE_DTYPE)
+
+    def decode(self, codes):
+        """ Ids of some codes, None for -1 and pd.NA
+        """
+
+        codes = raw_codes(codes)
+        return np.append(self.values, None)[np.where(codes >= 0, codes, len(self.values))]
+
+    def categorical(self, codes):
+        """ Categorical with all of the ids of the dictionary as categories
+        """
+
+        return pd.Categorical.from_codes(
+            raw_codes(codes),
+            dtype=pd.CategoricalDtype(self.index, ordered=False),
+            validate=False,
+        )
+
+
+def raw_codes(codes):
+    """ int32 codes with -1 for the missing ones, from numpy or nullable integer codes
+    """
+
+    if isinstance(codes, np.ndarray) and codes.dtype != object:
+        return codes.astype(CODE_DTYPE, copy=False)
+
+    return pd.Series(codes).to_numpy(dtype=CODE_DTYPE, na_value=-1)
+
+
+def nullable_codes(codes):
+    """ Int32 array of codes, pd.NA for -1
+    """
+
+    codes = raw_codes(codes)
+    return pd.arrays.IntegerArray(codes, codes < 0)
+
+
+def get_dictionary(kind):
+    """ Returns the "gene" or "drug" dictionary
+    """
+
+    if kind not in DICTIONARY_SOURCES:
+        raise ValueError(
+            f"Unknown dictionary {kind}, the options are {list(DICTIONARY_SOURCES)}"
+        )
+
+    relative_path, column = DICTIONARY_SOURCES[kind]
+    csv_path = f"{rsv.RESERVOIR_DATA_FOLDER}/{relative_path}"
+
+    return dataset_cache.load(
+        storage.table_path(csv_path),
+        ("identifier_dictionary", column),
+        lambda: IdentifierDictionary(storage.read_table(csv_path, columns=[column])[column]),
+    )
+
+
+def get_gene_dictionary():
+    return get_dictionary("gene")
+
+
+def get_drug_dictionary():
+    return get_dictionary("drug")
+
+
+def dictionary_signatures(csv_path):
+    """ Signatures of the tables the dictionaries are made from, part of the cache keys
+    of the tables read with them. Empty for these tables themselves
+    """
+
+    signatures = []
+    for relative_path, _ in DICTIONARY_SOURCES.values():
+        source_path = f"{rsv.RESERVOIR_DATA_FOLDER}/{relative_path}"
+        if os.path.normpath(source_path) == os.path.normpath(csv_path):
+            return ()
+
+        source_path = storage.table_path(source_path)
+        signatures.append(file_signature(source_path) if os.path.exists(source_path) else None)
+
+    return tuple(signatures)
+
+
+def check_id_format(id_format):
+    if id_format not in ID_FORMATS:
+        raise ValueError(f"Unknown id_format {id_format}, the options are {ID_FORMATS}")
+
+
+def encode_id_columns(frame):
+    """ Replaces the id columns of a table by their codes, for the parquet copies
+
+    Columns with ids that aren't in their dictionary are kept as strings, so that
+    no id is lost.
+
+    Returns:
+        the encoded table and a dictionary with the encoded columns and the signature
+        of their dictionary
+    """
+
+    frame = frame.copy()
+    encoded = {}
+    for column, kind in ID_COLUMNS.items():
+        if column not in frame.columns:
+            continue
+
+        dictionary = get_dictionary(kind)
+        codes = dictionary.encode(frame[column])
+        if ((codes < 0) & frame[column].notnull().to_numpy()).any():
+            continue
+
+        frame[column] = codes
+        encoded[column] = {"dictionary": kind, "signature": dictionary.signature}
+
+    return frame, encoded
+
+
+def encode_filters(filters, encoded):
+    """ Rewrites the normalized filters on encoded columns with codes
+
+    Args:
+        filters: normalized filters, see storage.normalize_filters
+        encoded: the encoded columns of the table, see encode_id_columns
+    """
+
+    if not filters:
+        return filters
+
+    rewritten = []
+    for conjunction in filters:
+        rewritten_conjunction = []
+        for column, op, value in conjunction:
+            if column in encoded:
+                dictionary = get_dictionary(encoded[column]["dictionary"])
+                if op in ["in", "not in"]:
+                    codes = dictionary.encode(list(value))
+                    value = [int(code) for code in codes[codes >= 0]]
+                elif op in ["==", "=", "!="]:
+                    # unknown ids can't match anything, -2 isn't a code
+                    code = int(dictionary.encode([value])[0])
+                    value = code if code >= 0 else -2
+                else:
+                    raise ValueError(f"Only equality filters can be used on {column}")
+            rewritten_conjunction.append((column, op, value))
+        rewritten.append(rewritten_conjunction)
+
+    return rewritten
+
+
+def check_signatures(encoded, path):
+    """ Makes sure the codes of a table were made with the current dictionaries
+    """
+
+    for column, encoding in encoded.items():
+        if get_dictionary(encoding["dictionary"]).signature != encoding["signature"]:
+            raise Exception(
+                f"The {column} codes of {path} were made with another version of the "
+                f"{encoding['dictionary']} dictionary, export the parquet copy again"
+            )
+
+
+def format_id_columns(frame, id_format, encoded=()):
+    """ Converts the id columns of a table to id_format
+
+    Args:
+        frame: table whose id columns are strings, or codes for the columns in encoded
+        id_format: "string", "categorical" or "codes"
+        encoded: columns holding codes
+
+    With "codes" the id columns are nullable Int32, missing and unknown ids are pd.NA.
+    pandas merges match missing keys with each other, so drop them before joining on codes.
+    """
+
+    check_id_format(id_format)
+    columns = [c for c in frame.columns if c in ID_COLUMNS]
+    if len(columns) == 0 or (id_format == "string" and len(encoded) == 0):
+        return frame
+
+    frame = frame.copy()
+    for column in columns:
+        dictionary = get_dictionary(ID_COLUMNS[column])
+        if column in encoded:
+            codes = raw_codes(frame[column])
+        elif id_format == "string":
+            continue
+        else:
+            codes = dictionary.encode(frame[column])
+
+        if id_format == "string":
+            frame[column] = dictionary.decode(codes)
+        elif id_format == "categorical":
+            frame[column] = dictionary.categorical(codes)
+        else:
+            frame[column] = nullable_codes(codes)
+
+    return frame
@@ -0,0 +1,253 @@
+import hashlib
+import warnings
+import multiprocessing
+import numpy as np
+import pandas as pd
+from reservoir import dose_response
+
+"""
+4 parameter logistic fits of the mono therapy curves of the drug combo blocks.
+
+Each block has two curves, one per side (the row drug and the col drug). Curves are
+padded into arrays and fitted in batches with dose_response.fit_logistic. The same
+drug is usually measured many times on the same cell line, so the curve of each
+(drug, cell line) with the most measurements is fitted first and its parameters are
+used as the starting point of the other curves of the same pair.
+"""
+
+# part of the cache keys, increase it when a change modifies the fits
+FIT_VERSION = 1
+
+# drug, concentrations and inhibitions columns of each side in mono_therapy.json
+SIDES = {
+    "row": ("drug_row_recover_id", "conc_r", "inhibition_r"),
+    "col": ("drug_col_recover_id", "conc_c", "inhibition_c"),
+}
+
+DEFAULT_CHUNK_SIZE = 20000
+
+
+def pad_curves(concentrations, inhibitions):
+    """ Puts ragged curves into NaN padded (curves, max points) arrays
+
+    Args:
+        concentrations: list of the concentration arrays of each curve
+        inhibitions: list of the inhibition arrays of each curve, same lengths
+
+    Returns:
+        padded concentrations, padded inhibitions and the mask of the measured points
+    """
+
+    lengths = np.fromiter(
+        (len(values) for values in concentrations), dtype=np.int64, count=len(concentrations)
+    )
+    width = int(lengths.max(initial=1))
+    mask = np.arange(width) < lengths[:, None]
+
+    padded_concentrations = np.full(mask.shape, np.nan)
+    padded_inhibitions = np.full(mask.shape, np.nan)
+    if lengths.sum() > 0:
+        padded_concentrations[mask] = np.concatenate(
+            [np.asarray(values, dtype=np.float64) for values in concentrations]
+        )
+        padded_inhibitions[mask] = np.concatenate(
+            [np.asarray(values, dtype=np.float64) for values in inhibitions]
+        )
+
+    # missing inhibitions are not used by the fits
+    mask &= ~np.isnan(padded_concentrations) & ~np.isnan(padded_inhibitions)
+
+    return padded_concentrations, padded_inhibitions, mask
+
+
+def mono_curves(mono_data):
+    """ One row per block and side of mono therapy data
+
+    Returns:
+        dataframe with block_id, side, recover_id and cell_line_name, and the padded
+        concentrations, inhibitions and mask of the curves (see pad_curves)
+    """
+
+    frames = []
+    concentrations = []
+    inhibitions = []
+    for side, (drug_column, concentration_column, inhibition_column) in SIDES.items():
+        frames.append(
+            pd.DataFrame(
+                {
+                    "block_id": mono_data["block_id"].to_numpy(),
+                    "side": side,
+                    "recover_id": mono_data[drug_column].to_numpy(),
+                    "cell_line_name": mono_data["cell_line_name"].to_numpy(),
+                }
+            )
+        )
+        concentrations.extend(mono_data[concentration_column])
+        inhibitions.extend(mono_data[inhibition_column])
+
+    curves = pd.concat(frames, ignore_index=True)
+    return (curves,) + pad_curves(concentrations, inhibitions)
+
+
+def warm_start_fits(concentrations, inhibitions, mask, groups):
+    """ Fits curves, starting each one from the fit of the largest curve of its group
+
+    The starting point of a curve is its group's parameters or the default one of
+    dose_response.initial_parameters, whichever fits the curve better.
+
+    Args:
+        concentrations, inhibitions, mask: padded curves, see pad_curves
+        groups: group of each curve, e.g. codes of (drug, cell line)
+
+    Returns:
+        (curves, 4) parameters and (curves,) sums of squared residuals
+    """
+
+    groups = np.asarray(groups)
+    default_initial = dose_response.initial_parameters(concentrations, inhibitions, mask)
+
+    # the curve with the most measurements of each group is fitted first
+    measurements = mask.sum(axis=1)
+    order = np.lexsort((-measurements, groups))
+    is_seed = np.ones(len(order), dtype=bool)
+    is_seed[1:] = groups[order[1:]] != groups[order[:-1]]
+    seeds = order[is_seed]
+    seed_parameters, _ = dose_response.fit_logistic(
+        concentrations[seeds], inhibitions[seeds], mask[seeds], initial=default_initial[seeds]
+    )
+
+    # seeds are sorted by group
+    warm_initial = seed_parameters[np.searchsorted(groups[seeds], groups)]
+
+    masked_concentrations = np.where(mask, concentrations, 0.0)
+    masked_inhibitions = np.where(mask, inhibitions, 0.0)
+    use_warm = dose_response.squared_error(
+        masked_concentrations, masked_inhibitions, mask, warm_initial
+    ) < dose_response.squared_error(
+        masked_concentrations, masked_inhibitions, mask, default_initial
+    )
+    initial = np.where(use_warm[:, None], warm_initial, default_initial)
+    initial[seeds] = seed_parameters
+
+    return dose_response.fit_logistic(concentrations, inhibitions, mask, initial=initial)
+
+
+def curve_keys(curves, concentrations, inhibitions, mask):
+    """ Cache keys of the curves, from their block, side and measurements
+    """
+
+    keys = []
+    for i, (block_id, side) in enumerate(zip(curves["block_id"], curves["side"])):
+        content = hashlib.sha1()
+        content.update(concentrations[i][mask[i]].tobytes())
+        content.update(inhibitions[i][mask[i]].tobytes())
+        keys.append(f"{block_id}:{side}:{content.hexdigest()}:{FIT_VERSION}")
+
+    return keys
+
+
+def _fit_chunk(arguments):
+    concentrations, inhibitions, mask, groups = arguments
+    return warm_start_fits(concentrations, inhibitions, mask, groups)
+
+
+def _chunks(groups, chunk_size):
+    """ Positions of the curves of each chunk, the curves of a group stay together
+    """
+
+    order = np.argsort(groups, kind="stable")
+    sorted_groups = groups[order]
+    group_starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+
+    chunks = []
+    start = 0
+    while start < len(order):
+        # first group start after start + chunk_size
+        end_index = np.searchsorted(group_starts, start + chunk_size)
+        end = group_starts[end_index] if end_index < len(group_starts) else len(order)
+        chunks.append(order[start:end])
+        start = end
+
+    return chunks
+
+
+def fit_mono_therapies(
+    mono_data,
+    processes=1,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    cache=None,
+):
+    """ Fits the mono therapy curves of both sides of some blocks
+
+    Args:
+        mono_data: mono therapy data, as returned by get_drug_combo_data_monos
+        processes: number of worker processes, 1 to fit in this process
+        chunk_size: approximate number of curves fitted together
+        cache: DiskCache of the fitted parameters, or None to fit everything
+
+    Returns:
+        dataframe with block_id, side, recover_id, cell_line_name and the fit of each
+        curve: bottom and emax (inhibitions at zero and infinite dose), ic50, hill,
+        sse and r_squared of the fit and the number of measurements
+    """
+
+    curves, concentrations, inhibitions, mask = mono_curves(mono_data)
+    number_of_curves = len(curves)
+    parameters = np.full((number_of_curves, 4), np.nan)
+    errors = np.full(number_of_curves, np.nan)
+
+    if cache is not None:
+        keys = curve_keys(curves, concentrations, inhibitions, mask)
+        cached = cache.get_many(keys)
+        for i, key in enumerate(keys):
+            if key in cached:
+                parameters[i], errors[i] = cached[key]
+        missing = np.flatnonzero([key not in cached for key in keys])
+    else:
+        missing = np.arange(number_of_curves)
+
+    if len(missing) > 0:
+        groups = pd.MultiIndex.from_frame(
+            curves.iloc[missing][["recover_id", "cell_line_name"]].astype(str)
+        ).factorize()[0]
+        local_chunks = _chunks(groups, chunk_size)
+        chunks = [missing[chunk] for chunk in local_chunks]
+        arguments = [
+            (concentrations[chunk], inhibitions[chunk], mask[chunk], groups[local_chunk])
+            for chunk, local_chunk in zip(chunks, local_chunks)
+        ]
+
+        if processes > 1 and len(chunks) > 1:
+            with multiprocessing.Pool(processes) as pool:
+                results = pool.map(_fit_chunk, arguments)
+        else:
+            results = [_fit_chunk(argument) for argument in arguments]
+
+        for chunk, (chunk_parameters, chunk_errors) in zip(chunks, results):
+            parameters[chunk] = chunk_parameters
+            errors[chunk] = chunk_errors
+
+        if cache is not None:
+            cache.set_many({keys[i]: (parameters[i], errors[i]) for i in missing})
+
+    measurements = mask.sum(axis=1)
+    observed = np.where(mask, inhibitions, np.nan)
+    with np.errstate(invalid="ignore", divide="ignore"), warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        total = np.nansum((observed - np.nanmean(observed, axis=1, keepdims=True)) ** 2, axis=1)
+        r_squared = 1 - errors / total
+
+    # curves without measurements have no fit
+    parameters[measurements == 0] = np.nan
+    errors[measurements == 0] = np.nan
+
+    fits = curves.copy()
+    fits["bottom"] = parameters[:, 0]
+    fits["emax"] = parameters[:, 1]
+    fits["ic50"] = np.exp(parameters[:, 2])
+    fits["hill"] = parameters[:, 3]
+    fits["sse"] = errors
+    fits["r_squared"] = np.where(measurements > 0, r_squared, np.nan)
+    fits["measurements"] = measurements
+
+    return fits
@@ -4,6 +4,7 @@ import pandas as pd
 import pickle
 import networkx as nx
 import itertools
+from reservoir.parsers.proteins import protein_mapper
 
 
 from create_cell_line_db import clean_cell_line_name
@@ -28,7 +29,9 @@ ccce = pd.read_csv(
     rsv.RESERVOIR_DATA_FOLDER + "/raw/cell_lines/E-MTAB-2770-query-results.tpms.tsv",
     sep="\t",
 )
-ccce["gene_hgnc_id"] = ccce["Gene Name"].apply(rsv.hgnc_normalize)
+ccce["gene_hgnc_id"] = protein_mapper.resolve_gene_ids(ccce["Gene Name"], "symbol")[
+    "gene_hgnc_id"
+]
 ccce = ccce.loc[~ccce["gene_hgnc_id"].isna()]
 ccce = ccce[ccce.columns[2:]]
 
@@ -0,0 +1,160 @@
+import numpy as np
+import pandas as pd
+
+"""
+Quality control of the drug combo blocks.
+
+The parser stores a few statistics per block (block_stats.csv) and the masks are
+evaluated from them when they are requested, so the thresholds can be changed
+without parsing the blocks again.
+"""
+
+# named threshold configurations, these were the hard coded block_mask.csv and block_mask_hq.csv
+QC_PRESETS = {
+    "high": {
+        "min_std": 0.05,
+        "mean_range": (-5, 95),
+        "min_grid": 3,
+        "min_combo_measurements": 9,
+    },
+    "medium": {
+        "min_std": 0.05,
+        "mean_range": (-15, 100),
+        "min_grid": 3,
+        "min_combo_measurements": 9,
+    },
+    "off": {},
+}
+
+
+def compute_block_stats(combo_data):
+    """ Statistics of the combination matrix of every block
+
+    Blocks without measurements get missing statistics, as do blocks with a missing
+    inhibition.
+
+    Args:
+        combo_data: dataframe with block_id, concentration_pairs and inhibitions
+    """
+
+    lengths = combo_data["inhibitions"].apply(len).to_numpy(dtype=np.int64)
+    number_of_blocks = len(lengths)
+    blocks = np.repeat(np.arange(number_of_blocks), lengths)
+
+    inhibitions = np.concatenate(
+        [np.asarray(values, dtype=np.float64) for values in combo_data["inhibitions"]]
+        + [np.empty(0)]
+    )
+
+    # sums propagate missing values, as np.mean and np.std do
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.bincount(blocks, weights=inhibitions, minlength=number_of_blocks) / lengths
+        squared_deviations = (inhibitions - mean[blocks]) ** 2
+        std = np.sqrt(
+            np.bincount(blocks, weights=squared_deviations, minlength=number_of_blocks)
+            / lengths
+        )
+
+    minimum = np.full(number_of_blocks, np.nan)
+    maximum = np.full(number_of_blocks, np.nan)
+    measured = lengths > 0
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])[measured]
+    if len(starts) > 0:
+        minimum[measured] = np.minimum.reduceat(inhibitions, starts)
+        maximum[measured] = np.maximum.reduceat(inhibitions, starts)
+
+    # number of distinct concentrations of each drug in the combination matrix
+    pair_lengths = combo_data["concentration_pairs"].apply(len).to_numpy(dtype=np.int64)
+    pairs = np.concatenate(
+        [
+            np.asarray(values, dtype=np.float64).reshape(-1, 2)
+            for values in combo_data["concentration_pairs"]
+        ]
+        + [np.empty((0, 2))]
+    )
+    pair_blocks = np.repeat(np.arange(number_of_blocks), pair_lengths)
+
+    def distinct_concentrations(concentrations):
+        distinct = pd.DataFrame(
+            {"block": pair_blocks, "concentration": concentrations}
+        ).drop_duplicates()
+        return np.bincount(distinct["block"].to_numpy(), minlength=number_of_blocks)
+
+    return pd.DataFrame(
+        {
+            "block_id": combo_data["block_id"].to_numpy(),
+            "inhibition_mean": mean,
+            "inhibition_std": std,
+            "inhibition_min": minimum,
+            "inhibition_max": maximum,
+            "combo_measurements": lengths,
+            "row_concentrations": distinct_concentrations(pairs[:, 0]),
+            "col_concentrations": distinct_concentrations(pairs[:, 1]),
+        }
+    )
+
+
+def qc_thresholds(qc_filtering="high", **thresholds):
+    """ Thresholds of a preset, overridden by the ones that are not None
+
+    mean_range is returned as a tuple of floats, so that thresholds given as a list or
+    array compare equal to the preset they match
+    """
+
+    if qc_filtering not in QC_PRESETS:
+        raise ValueError(
+            f"Unknown qc_filtering {qc_filtering}, use one of {list(QC_PRESETS)}"
+        )
+
+    preset = dict(QC_PRESETS[qc_filtering])
+    preset.update({name: value for name, value in thresholds.items() if value is not None})
+
+    if "mean_range" in preset:
+        low, high = preset["mean_range"]
+        preset["mean_range"] = (float(low), float(high))
+
+    return preset
+
+
+def block_mask(
+    block_stats,
+    min_std=None,
+    mean_range=None,
+    min_grid=None,
+    min_combo_measurements=None,
+):
+    """ Evaluates the quality control thresholds on the block statistics
+
+    Args:
+        block_stats: dataframe returned by compute_block_stats
+        min_std: the inhibitions need a standard deviation above this
+        mean_range: (low, high), the mean inhibition needs to be at least low and below high
+        min_grid: both drugs need at least this many distinct concentrations in the
+            combination matrix
+        min_combo_measurements: the combination matrix needs at least this many measurements
+
+    Returns:
+        dataframe with block_id and mask
+    """
+
+    mask = np.ones(len(block_stats), dtype=bool)
+
+    if min_std is not None:
+        mask &= (block_stats["inhibition_std"] > min_std).to_numpy()
+
+    if mean_range is not None:
+        low, high = mean_range
+        mask &= (
+            (block_stats["inhibition_mean"] >= low) & (block_stats["inhibition_mean"] < high)
+        ).to_numpy()
+
+    if min_grid is not None:
+        mask &= (
+            (block_stats["row_concentrations"] >= min_grid)
+            & (block_stats["col_concentrations"] >= min_grid)
+        ).to_numpy()
+
+    if min_combo_measurements is not None:
+        mask &= (block_stats["combo_measurements"] >= min_combo_measurements).to_numpy()
+
+    return pd.DataFrame({"block_id": block_stats["block_id"].to_numpy(), "mask": mask})
@@ -1,10 +1,10 @@
 import reservoir as rsv
 import pandas as pd
-from multiprocessing import Pool
 from rdkit import Chem
 from rdkit.Chem import Crippen
 from rdkit.Chem import Descriptors
-from rdkit.Chem.SaltRemover import SaltRemover
+from reservoir.parsers.drugs.smiles_normalization import normalize_smiles_many
+from reservoir.parsers.drugs.molecule_executor import map_molecules
 from rdkit.Chem import Crippen
 from rdkit.Chem import Descriptors
 
@@ -14,31 +14,14 @@ from rdkit.Chem import Descriptors
 """
 
 
-def parse_smiles(smiles):
-    """ Sanity check and normalization for drugs """
-    try:
-        # Remove salts
-        smiles = smiles.split()[0]
-        mol = Chem.MolFromSmiles(smiles)
-        remover = SaltRemover()
-        mol = remover.StripMol(mol)
-        parsed_smiles = Chem.MolToSmiles(mol)
-        return parsed_smiles
-
-    except Exception as e:
-        pass
-
-    return smiles
-
-
 def add_parsed_smiles(all_drugs_with_smiles):
     """ Add the parsed smiles in multiprocessing fashion
     """
 
-    # identify all unique smiles and run parsed on them
-    unique_smiles = set(all_drugs_with_smiles["canonical_smiles"].unique())
-    with Pool(7) as p:
-        parsed_smiles = p.map(parse_smiles, unique_smiles)
+    # identify all unique smiles and run parsed on them, the ones parsed by a previous
+    # build come from the smiles cache
+    unique_smiles = list(all_drugs_with_smiles["canonical_smiles"].unique())
+    parsed_smiles = normalize_smiles_many(unique_smiles)
     canonical_to_parsed = dict(zip(unique_smiles, parsed_smiles))
 
     # add parsed version
@@ -115,12 +98,9 @@ for i, row in drug_salt.iterrows():
 
 
 def compute_mw(smiles):
-    try:
-        smiles = smiles.split()[0]
-        mol = Chem.MolFromSmiles(smiles)
-        return Descriptors.ExactMolWt(mol)
-    except:
-        return None
+    smiles = smiles.split()[0]
+    mol = Chem.MolFromSmiles(smiles)
+    return Descriptors.ExactMolWt(mol)
 
 
 # each connected component in the graph becomes one recover id
@@ -139,9 +119,10 @@ all_drugs_with_smiles["recover_id"] = all_drugs_with_smiles["molregno"].apply(
 
 # add mw to molecules. in a group of molecules, the one with lowest mw becomes the representative
 unique_smiles = all_drugs_with_smiles["parsed_smiles"].unique()
-with Pool(7) as p:
-    mws = p.map(compute_mw, unique_smiles)
-smiles_to_mw = dict(zip(unique_smiles, mws))
+mws = map_molecules(compute_mw, unique_smiles)
+if len(mws.errors) > 0:
+    print(f"Could not compute the mw of {len(mws.errors)} smiles, e.g. {mws.errors[0]}")
+smiles_to_mw = dict(zip(unique_smiles, mws.values))
 all_drugs_with_smiles["mw"] = all_drugs_with_smiles["parsed_smiles"].apply(
     lambda smiles: smiles_to_mw[smiles]
 )
@@ -0,0 +1,193 @@
+import json
+import hashlib
+import functools
+import numpy as np
+import pandas as pd
+import rdkit
+from rdkit import Chem
+from rdkit.Chem import Descriptors, MACCSkeys, rdFingerprintGenerator
+from reservoir import api
+from reservoir.disk_cache import DiskCache
+from reservoir.parsers.drugs.molecule_executor import map_molecules
+
+"""
+Features of the drugs (fingerprints, RDKit descriptors) for models.
+
+Each molecule is featurised once: the features are stored in a disk cache with keys made
+of the featuriser, its parameters, the RDKit version, the recover id and its SMILES, so a
+new RDKit or a drug whose SMILES changed are featurised again.
+"""
+
+# bump when the output of a featuriser changes
+FEATURES_VERSION = 1
+
+
+@functools.lru_cache(maxsize=None)
+def _morgan_generator(radius, bits):
+    return rdFingerprintGenerator.GetMorganGenerator(radius=radius, fpSize=bits)
+
+
+@functools.lru_cache(maxsize=None)
+def _descriptor_functions():
+    return dict(Descriptors._descList)
+
+
+def morgan_features(mol, radius=2, bits=1024):
+    return _morgan_generator(radius, bits).GetFingerprintAsNumPy(mol).astype(np.uint8)
+
+
+def maccs_features(mol):
+    return np.array(list(MACCSkeys.GenMACCSKeys(mol)), dtype=np.uint8)
+
+
+def rdkit_descriptor_features(mol, names=None):
+    names = descriptor_names() if names is None else names
+    functions = _descriptor_functions()
+    return np.array([functions[name](mol) for name in names], dtype=np.float32)
+
+
+def descriptor_names():
+    return [name for name, _ in Descriptors._descList]
+
+
+# name: (function of a mol, whether it returns bits, default parameters, column names)
+FEATURISERS = {
+    "morgan": (
+        morgan_features,
+        True,
+        {"radius": 2, "bits": 1024},
+        lambda params: [f"morgan_{i}" for i in range(params["bits"])],
+    ),
+    "maccs": (
+        maccs_features,
+        True,
+        {},
+        lambda params: [f"maccs_{i}" for i in range(167)],
+    ),
+    "rdkit_descriptors": (
+        rdkit_descriptor_features,
+        False,
+        {"names": None},
+        lambda params: [
+            f"rdkit_{name}" for name in (params["names"] or descriptor_names())
+        ],
+    ),
+}
+
+
+def featurise(kind, params, smiles):
+    """ Features of one SMILES, raises an exception if it can't be parsed
+    """
+
+    mol = Chem.MolFromSmiles(smiles.split()[0])
+    if mol is None:
+        raise Exception(f"Could not parse {smiles}")
+
+    return FEATURISERS[kind][0](mol, **params)
+
+
+def feature_key(kind, params, recover_id, smiles):
+    """ Disk cache key of the features of a drug
+    """
+
+    description = json.dumps([kind, params, FEATURES_VERSION, rdkit.__version__], sort_keys=True)
+    smiles_hash = hashlib.sha1(smiles.encode()).hexdigest()
+    return f"{description}:{recover_id}:{smiles_hash}"
+
+
+@functools.lru_cache(maxsize=None)
+def _feature_cache():
+    return DiskCache("drug_features")
+
+
+def _features_of_kind(drugs, kind, params, workers, use_cache):
+    """ Features of unique drugs (recover_id and smiles), None for the ones that failed
+    """
+
+    keys = [
+        feature_key(kind, params, recover_id, smiles)
+        for recover_id, smiles in zip(drugs["recover_id"], drugs["smiles"])
+    ]
+    cached = _feature_cache().get_many(keys) if use_cache else {}
+    missing = [i for i, key in enumerate(keys) if key not in cached]
+
+    results = map_molecules(
+        functools.partial(featurise, kind, params),
+        drugs["smiles"].iloc[missing],
+        workers=workers,
+    )
+    computed = dict(zip((keys[i] for i in missing), results.values))
+
+    # failures are stored too, so that they aren't tried again
+    if use_cache and len(computed) > 0:
+        _feature_cache().set_many(computed)
+
+    return [cached[key] if key in cached else computed[key] for key in keys]
+
+
+def get_drug_features(
+        recover_ids,
+        kind=("morgan", "rdkit_descriptors", "maccs"),
+        params=None,
+        workers=None,
+        use_cache=True,
+):
+    """ Features of drugs, computed once per molecule and kept in a disk cache
+
+    Args:
+        recover_ids: list of recover ids, can contain duplicates (e.g. the drug_row_recover_id
+            column of the combos)
+        kind: featuriser or list of featurisers among "morgan", "maccs" and "rdkit_descriptors"
+        params: dictionary with the parameters of each featuriser that differ from the
+            defaults, e.g. {"morgan": {"radius": 3, "bits": 2048}}
+        workers: number of worker processes for the molecules that aren't cached yet
+        use_cache: read and write the disk cache
+
+    Returns:
+        dataframe with one row per recover id, in the same order and indexed by recover id,
+        and the features of each kind side by side. The values are uint8 when all kinds are
+        bits, float32 otherwise. The rows of drugs whose SMILES can't be featurised are NaN
+        (and the values float32)
+    """
+
+    kinds = [kind] if isinstance(kind, str) else list(kind)
+    for name in kinds:
+        if name not in FEATURISERS:
+            raise ValueError(f"Unknown featuriser {name}, the options are {list(FEATURISERS)}")
+    params = params or {}
+
+    recover_ids = pd.Index(recover_ids, dtype=object, name="recover_id")
+    unique_ids = recover_ids.drop_duplicates()
+    drugs = api.get_drugs(list(unique_ids), columns=["recover_id", "smiles"])
+    drugs = drugs.drop_duplicates("recover_id").set_index("recover_id").reindex(unique_ids)
+    unknown = drugs["smiles"].isnull()
+    if unknown.any():
+        raise Exception(f"Unknown recover ids: {list(drugs.index[unknown][:10])}")
+    drugs = drugs.reset_index()
+
+    blocks = []
+    columns = []
+    all_bits = True
+    for name in kinds:
+        function, bits, defaults, column_names = FEATURISERS[name]
+        kind_params = dict(defaults, **params.get(name, {}))
+        names = column_names(kind_params)
+
+        features = _features_of_kind(drugs, name, kind_params, workers, use_cache)
+        block = np.full((len(features), len(names)), np.nan, dtype=np.float32)
+        for i, values in enumerate(features):
+            if values is not None:
+                block[i] = values
+            else:
+                all_bits = False
+
+        blocks.append(block)
+        columns += names
+        all_bits = all_bits and bits
+
+    matrix = np.concatenate(blocks, axis=1).astype(np.uint8 if all_bits else np.float32)
+
+    # back to the order and duplicates of the input
+    return pd.DataFrame(
+        matrix[unique_ids.get_indexer(recover_ids)], index=recover_ids, columns=columns
+    )
@@ -0,0 +1,275 @@
+import os
+import json
+import random
+import asyncio
+import argparse
+import threading
+import http.client
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+
+"""
+Downloads the dose response data of the DrugComb blocks (/response/<block_id>).
+
+Every block is stored in its own file as soon as it arrives, so an interrupted or
+failed run can be started again and only fetches the blocks that are missing.
+Requests go through a small pool of keep-alive connections with bounded concurrency,
+an optional rate limit, and retries with exponential backoff.
+"""
+
+DRUGCOMB_API = "https://api.drugcomb.org"
+
+# blocks per cache folder, to keep folders small
+SHARD_SIZE = 1000
+
+# responses worth retrying, anything else (e.g. 404) fails the block straight away
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+
+class DownloadError(Exception):
+    """ A block could not be downloaded, retry tells if trying again can help
+    """
+
+    def __init__(self, message, retry=True, retry_after=None):
+        super().__init__(message)
+        self.retry = retry
+        self.retry_after = retry_after
+
+
+class BlockCache:
+    """ One json file per block, grouped in folders of SHARD_SIZE blocks
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def path(self, block_id):
+        block_id = int(block_id)
+        return os.path.join(self.folder, str(block_id // SHARD_SIZE), f"{block_id}.json")
+
+    def has(self, block_id):
+        return os.path.exists(self.path(block_id))
+
+    def read(self, block_id):
+        with open(self.path(block_id), "rb") as f:
+            return json.loads(f.read())
+
+    def write(self, block_id, payload):
+        """ Stores the raw response of a block, atomically so that partial files are never read
+        """
+
+        path = self.path(block_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+
+
+class ConnectionPool:
+    """ Keep-alive connections to the api, one per worker thread
+    """
+
+    def __init__(self, base_url, timeout):
+        parts = urlsplit(base_url)
+        self.connection_class = (
+            http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        )
+        self.host = parts.netloc
+        self.base_path = parts.path.rstrip("/")
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self.connection_class(self.host, timeout=self.timeout)
+            self._local.connection = connection
+        return connection
+
+    def _reset(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+        self._local.connection = None
+
+    def get(self, path):
+        """ Returns the status, headers and body of a GET request
+        """
+
+        connection = self._connection()
+        try:
+            connection.request("GET", self.base_path + path, headers={"Accept": "application/json"})
+            response = connection.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            # the server closed the connection or the network failed, reconnect next time
+            self._reset()
+            raise DownloadError(f"{type(e).__name__}: {str(e)}")
+
+        if response.will_close:
+            self._reset()
+
+        return response.status, response.headers, body
+
+
+class RateLimiter:
+    """ Spaces the requests so that at most rate requests are started per second
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_time = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        if self.interval == 0:
+            return
+
+        async with self.lock:
+            now = asyncio.get_running_loop().time()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+def fetch_block(pool, block_id):
+    """ Downloads one block, returns the raw json payload
+    """
+
+    status, headers, body = pool.get(f"/response/{block_id}")
+
+    if status != 200:
+        retry_after = headers.get("Retry-After")
+        raise DownloadError(
+            f"HTTP {status}",
+            retry=status in RETRY_STATUSES,
+            retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None,
+        )
+
+    try:
+        records = json.loads(body)
+    except ValueError as e:
+        raise DownloadError(f"Invalid json: {str(e)}")
+
+    if not isinstance(records, list):
+        raise DownloadError("Expected a list of measurements", retry=False)
+
+    return body
+
+
+async def download_blocks(
+    block_ids,
+    cache_folder,
+    base_url=DRUGCOMB_API,
+    concurrency=16,
+    retries=5,
+    backoff=1.0,
+    max_backoff=60.0,
+    rate_limit=None,
+    timeout=60,
+):
+    """ Downloads the blocks that are not in the cache yet
+
+    Args:
+        block_ids: blocks to download
+        cache_folder: folder where each block is stored as it arrives
+        base_url: address of the DrugComb api, or of a local stand-in
+        concurrency: maximum number of requests in flight
+        retries: attempts per block after the first one
+        backoff: seconds to wait before the first retry, doubled after each attempt
+        max_backoff: maximum seconds between attempts
+        rate_limit: maximum requests started per second, None for no limit
+        timeout: seconds to wait for a response
+
+    Returns:
+        dictionary with the number of blocks downloaded, already cached, and the
+        error of every block that failed
+    """
+
+    cache = BlockCache(cache_folder)
+    block_ids = list(dict.fromkeys(int(block_id) for block_id in block_ids))
+    missing_block_ids = [block_id for block_id in block_ids if not cache.has(block_id)]
+
+    pool = ConnectionPool(base_url, timeout)
+    rate_limiter = RateLimiter(rate_limit)
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+    failed = {}
+
+    async def download(block_id, executor):
+        async with semaphore:
+            for attempt in range(retries + 1):
+                await rate_limiter.wait()
+                try:
+                    payload = await loop.run_in_executor(executor, fetch_block, pool, block_id)
+                    await loop.run_in_executor(executor, cache.write, block_id, payload)
+                    return True
+                except DownloadError as e:
+                    if not e.retry or attempt == retries:
+                        failed[block_id] = str(e)
+                        return False
+                    # jitter so that failed requests don't all come back at once
+                    delay = min(max_backoff, backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+                    if e.retry_after is not None:
+                        delay = max(delay, e.retry_after)
+                    await asyncio.sleep(delay)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = await asyncio.gather(
+            *[download(block_id, executor) for block_id in missing_block_ids]
+        )
+
+    return {
+        "downloaded": sum(results),
+        "cached": len(block_ids) - len(missing_block_ids),
+        "failed": failed,
+    }
+
+
+def fetch_blocks(block_ids, cache_folder, **kwargs):
+    """ Synchronous version of download_blocks
+    """
+
+    return asyncio.run(download_blocks(block_ids, cache_folder, **kwargs))
+
+
+def read_blocks(block_ids, cache_folder):
+    """ Returns the measurements of the cached blocks as one dataframe, in the order of block_ids
+    """
+
+    cache = BlockCache(cache_folder)
+    records = []
+    for block_id in dict.fromkeys(int(block_id) for block_id in block_ids):
+        if cache.has(block_id):
+            records.extend(cache.read(block_id))
+
+    return pd.DataFrame(records)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download the DrugComb blocks of a summary file")
+    parser.add_argument("summary_file", help="csv file with a block_id column")
+    parser.add_argument("cache_folder", help="folder where the blocks are stored")
+    parser.add_argument("--base-url", default=DRUGCOMB_API)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--retries", type=int, default=5)
+    parser.add_argument("--rate-limit", type=float, default=None)
+    args = parser.parse_args()
+
+    summary_data = pd.read_csv(args.summary_file, usecols=["block_id"])
+    result = fetch_blocks(
+        summary_data["block_id"],
+        args.cache_folder,
+        base_url=args.base_url,
+        concurrency=args.concurrency,
+        retries=args.retries,
+        rate_limit=args.rate_limit,
+    )
+    print(
+        f"Downloaded {result['downloaded']} blocks, {result['cached']} were already cached, "
+        f"{len(result['failed'])} failed"
+    )
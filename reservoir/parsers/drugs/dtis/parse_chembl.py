@@ -24,9 +24,9 @@ chembl_target_to_uniprot = pd.read_csv(
 chembl_dtis = chembl_dtis.merge(
     chembl_target_to_uniprot, left_on="chembl_target_id", right_on="chembl_id"
 )
-chembl_dtis["gene_hgnc_id"] = chembl_dtis["uniprot_id"].apply(
-    protein_mapper.uniprot_to_hgnc
-)
+chembl_dtis["gene_hgnc_id"] = protein_mapper.resolve_gene_ids(
+    chembl_dtis["uniprot_id"], "uniprot"
+)["gene_hgnc_id"]
 chembl_dtis = chembl_dtis.loc[
     ~pd.isnull(chembl_dtis["gene_hgnc_id"]),
     [
@@ -43,9 +43,9 @@ chembl_dtis = chembl_dtis.loc[
 chembl_dm = chembl_dm.merge(
     chembl_target_to_uniprot, left_on="chembl_target_id", right_on="chembl_id"
 )
-chembl_dm["gene_hgnc_id"] = chembl_dm["uniprot_id"].apply(
-    protein_mapper.uniprot_to_hgnc
-)
+chembl_dm["gene_hgnc_id"] = protein_mapper.resolve_gene_ids(
+    chembl_dm["uniprot_id"], "uniprot"
+)["gene_hgnc_id"]
 chembl_dm = chembl_dm.loc[
     ~pd.isnull(chembl_dm["gene_hgnc_id"]), ["chembl_molecule_id", "gene_hgnc_id"]
 ]
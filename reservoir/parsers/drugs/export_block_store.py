@@ -0,0 +1,28 @@
+import sys
+import pandas as pd
+import reservoir as rsv
+from reservoir import block_store
+
+"""
+Writes the block store of the parsed drug combo json files, so that the api can read
+single blocks without decoding the whole json file.
+"""
+
+BLOCK_FILES = ["combos.json", "mono_therapy.json"]
+
+
+def export_block_store(json_path):
+    """ Writes the block store of a parsed json file next to it
+    """
+
+    return block_store.write_block_store(
+        pd.read_json(json_path), block_store.store_path(json_path), source_path=json_path
+    )
+
+
+if __name__ == "__main__":
+    # the parsed drug combos folder, or a specific version of it
+    folder = sys.argv[1] if len(sys.argv) > 1 else rsv.RESERVOIR_DATA_FOLDER + "/parsed/drug_combos"
+    for file in BLOCK_FILES:
+        print("Exporting", file)
+        export_block_store(f"{folder}/{file}")
@@ -0,0 +1,80 @@
+import os
+import multiprocessing
+from collections import namedtuple
+
+"""
+Runs a function over many molecules (SMILES, mols...) in worker processes.
+
+Items are sent to the workers in chunks, so the cost of pickling the function and the
+results is paid once per chunk rather than once per molecule. Results come back in
+the order of the input, and an exception raised for one item is recorded with its
+position instead of stopping the whole run.
+"""
+
+MoleculeResults = namedtuple("MoleculeResults", ["values", "errors"])
+MoleculeError = namedtuple("MoleculeError", ["position", "item", "error"])
+
+DEFAULT_CHUNK_SIZE = 256
+
+
+def available_workers():
+    """ Number of cores this process is allowed to use
+    """
+
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _run_chunk(arguments):
+    function, items = arguments
+    results = []
+    for item in items:
+        try:
+            results.append((True, function(item)))
+        except Exception as e:
+            results.append((False, f"{type(e).__name__}: {str(e)}"))
+
+    return results
+
+
+def map_molecules(function, items, workers=None, chunk_size=DEFAULT_CHUNK_SIZE, default=None):
+    """ Applies a function to every item, in parallel
+
+    Inputs that fit in a single chunk, or workers=1, are processed in this process.
+
+    Args:
+        function: function of one item, has to be defined at module level to be pickled
+        items: iterable of items
+        workers: number of worker processes, all available cores if None
+        chunk_size: number of items sent to a worker at once
+        default: value of the items for which the function raised an exception
+
+    Returns:
+        MoleculeResults with the values in the order of items, and a list of
+        MoleculeError(position, item, error message) of the items that failed
+    """
+
+    items = list(items)
+    workers = available_workers() if workers is None else workers
+    chunks = [
+        (function, items[start:start + chunk_size])
+        for start in range(0, len(items), chunk_size)
+    ]
+
+    if workers > 1 and len(chunks) > 1:
+        with multiprocessing.Pool(min(workers, len(chunks))) as pool:
+            chunk_results = pool.map(_run_chunk, chunks, chunksize=1)
+    else:
+        chunk_results = [_run_chunk(chunk) for chunk in chunks]
+
+    values = []
+    errors = []
+    for chunk_result in chunk_results:
+        for succeeded, value in chunk_result:
+            if not succeeded:
+                errors.append(MoleculeError(len(values), items[len(values)], value))
+                value = default
+            values.append(value)
+
+    return MoleculeResults(values, errors)
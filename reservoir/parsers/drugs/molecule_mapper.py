@@ -1,52 +1,258 @@
+import os
+import functools
+import numpy as np
 import pandas as pd
 import reservoir as rsv
-from rdkit import Chem
-from rdkit.Chem.SaltRemover import SaltRemover
-
-# load the references for mapping
-drug_names = pd.read_csv(
-    rsv.RESERVOIR_DATA_FOLDER + "/parsed/drugs/drug_names.csv"
-).rename(columns={"name": "drug_name"})
-recover_to_drugbank = pd.read_csv(
-    rsv.RESERVOIR_DATA_FOLDER + "/parsed/drugs/recover_to_drugbank.csv"
-)
-recover_to_pubchem = pd.read_csv(
-    rsv.RESERVOIR_DATA_FOLDER + "/parsed/drugs/recover_to_pubchem.csv",
-    dtype={"pubchem_cid": "str"},
-)
-recover_to_chembl = pd.read_csv(
-    rsv.RESERVOIR_DATA_FOLDER + "/parsed/drugs/recover_to_chembl.csv"
+from reservoir import storage
+from reservoir.cache import dataset_cache, file_signature
+from reservoir.parsers.drugs.smiles_normalization import (
+    normalize_smiles,
+    normalize_smiles_many,
 )
 
-recover_drugs = pd.read_csv(
-    rsv.RESERVOIR_DATA_FOLDER + "/parsed/drugs/recover_drugs.csv"
-)
+REFERENCE_FILES = [
+    "drug_names.csv",
+    "recover_to_drugbank.csv",
+    "recover_to_pubchem.csv",
+    "recover_to_chembl.csv",
+    "recover_drugs.csv",
+]
+
+# columns of the drugs that can be mapped, in the order they are tried
+REFERENCE_COLUMNS = [
+    "pubchem_cid",
+    "drugbank_id",
+    "chembl_id",
+    "molregno",
+    "drug_name",
+    "input_smiles",
+]
+
+# part of the name of the compiled index, increase it when the IdentifierIndex changes
+INDEX_VERSION = 2
+
+
+@functools.lru_cache(maxsize=None)
+def load_references():
+    """ Reads the references for mapping, the first time they are needed
+    """
+
+    drug_names = pd.read_csv(
+        rsv.RESERVOIR_DATA_FOLDER + "/parsed/drugs/drug_names.csv"
+    ).rename(columns={"name": "drug_name"})
+    recover_to_drugbank = pd.read_csv(
+        rsv.RESERVOIR_DATA_FOLDER + "/parsed/drugs/recover_to_drugbank.csv"
+    )
+    recover_to_pubchem = pd.read_csv(
+        rsv.RESERVOIR_DATA_FOLDER + "/parsed/drugs/recover_to_pubchem.csv",
+        dtype={"pubchem_cid": "str"},
+    )
+    recover_to_chembl = pd.read_csv(
+        rsv.RESERVOIR_DATA_FOLDER + "/parsed/drugs/recover_to_chembl.csv"
+    )
+
+    recover_drugs = pd.read_csv(
+        rsv.RESERVOIR_DATA_FOLDER + "/parsed/drugs/recover_drugs.csv"
+    )
+
+    return {
+        "drug_names": drug_names,
+        "recover_to_drugbank": recover_to_drugbank,
+        "recover_to_pubchem": recover_to_pubchem,
+        "recover_to_chembl": recover_to_chembl,
+        "recover_drugs": recover_drugs,
+        "REFERENCES": {
+            "pubchem_cid": recover_to_pubchem,
+            "drugbank_id": recover_to_drugbank,
+            "chembl_id": recover_to_chembl,
+            "molregno": recover_to_chembl,
+            "drug_name": drug_names,
+            "input_smiles": recover_drugs[["smiles", "recover_id"]],
+        },
+    }
+
+
+def __getattr__(name):
+    # the reference tables used to be module attributes
+    if name in ("drug_names", "recover_to_drugbank", "recover_to_pubchem",
+                "recover_to_chembl", "recover_drugs", "REFERENCES"):
+        return load_references()[name]
+
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
 
 
-REFERENCES = {
-    "pubchem_cid": recover_to_pubchem,
-    "drugbank_id": recover_to_drugbank,
-    "chembl_id": recover_to_chembl,
-    "molregno": recover_to_chembl,
-    "drug_name": drug_names,
-    "input_smiles": recover_drugs[["smiles", "recover_id"]],
-}
+def identifier_strings(values):
+    """ Identifiers as strings, and the mask of the missing ones
 
+    Integral floats (e.g. pubchem ids read from a column with missing values) are
+    written without decimals.
+    """
+
+    values = pd.Series(values).reset_index(drop=True)
+    missing = values.isna().to_numpy()
+
+    if pd.api.types.is_float_dtype(values.dtype):
+        numbers = values.to_numpy()
+        integral = ~missing & (numbers == np.round(numbers))
+        strings = values.astype(str)
+        strings[integral] = numbers[integral].astype(np.int64).astype(str)
+    else:
+        strings = values.astype(str)
+
+    return strings.to_numpy(dtype=object), missing
+
+
+def identifier_hashes(strings):
+    """ 64 bit hashes of identifier strings
+    """
 
-def map_to_recover_id_using_reference(drugs, reference):
-    """ Map the drugs to a specified reference and split into mapped and unmapped
+    return pd.util.hash_array(strings, categorize=True)
+
+
+class IdentifierIndex:
+    """ Maps (identifier type, value) to recover ids for all of the references at once
+
+    Each identifier type is stored as sorted 64 bit hashes of the values, the values
+    themselves and the position of their recover id, so lookups are one searchsorted per
+    type. A hash only finds a candidate, a match also needs the values to be equal. A value
+    with several recover ids in a reference maps to the first one.
     """
-    # map to reference
-    drugs = drugs.merge(reference, how="left")
 
-    # extract mapped and unmapped
-    mapped_drugs = drugs.loc[~pd.isnull(drugs.recover_id)]
-    unmapped_drugs = drugs.loc[pd.isnull(drugs.recover_id)]
+    cache_shared = True
+
+    def __init__(self, recover_ids, hashes, values, codes):
+        self.recover_ids = recover_ids
+        self.hashes = hashes
+        self.values = values
+        self.codes = codes
+
+    @classmethod
+    def from_references(cls, references):
+        """ Builds the index from the REFERENCES of load_references
+        """
+
+        recover_ids = pd.Index(
+            pd.concat([reference["recover_id"] for reference in references.values()])
+            .dropna()
+            .unique()
+        )
 
-    # remove recover_id fron unmapped ones
-    del unmapped_drugs["recover_id"]
+        hashes = {}
+        strings = {}
+        codes = {}
+        for identifier_type in REFERENCE_COLUMNS:
+            reference = references[identifier_type]
+            value_column = "smiles" if identifier_type == "input_smiles" else identifier_type
+            values = reference[value_column]
+            if identifier_type == "drug_name":
+                values = values.str.lower()
 
-    return mapped_drugs, unmapped_drugs
+            value_strings, missing = identifier_strings(values)
+            value_codes = recover_ids.get_indexer(reference["recover_id"])
+            keep = ~missing & (value_codes >= 0)
+            value_strings = value_strings[keep]
+            value_codes = value_codes[keep]
+            value_hashes = identifier_hashes(value_strings)
+
+            # first recover id of each value, values are sorted by hash then by value so
+            # that values sharing a hash are all kept next to each other
+            order = np.lexsort((value_strings.astype(str), value_hashes))
+            value_hashes = value_hashes[order]
+            value_strings = value_strings[order]
+            first = np.r_[
+                True,
+                (value_hashes[1:] != value_hashes[:-1]) | (value_strings[1:] != value_strings[:-1]),
+            ]
+            hashes[identifier_type] = value_hashes[first]
+            strings[identifier_type] = value_strings[first]
+            codes[identifier_type] = value_codes[order][first].astype(np.int32)
+
+        return cls(recover_ids.to_numpy(dtype=object), hashes, strings, codes)
+
+    def lookup(self, identifier_type, values):
+        """ Positions in recover_ids of some identifiers, -1 for the ones not found
+        """
+
+        value_strings, missing = identifier_strings(values)
+        value_hashes = identifier_hashes(value_strings)
+        type_hashes = self.hashes[identifier_type]
+        type_values = self.values[identifier_type]
+        codes = np.full(len(value_hashes), -1, dtype=np.int32)
+        if len(type_hashes) == 0:
+            return codes
+
+        # a hash can be shared by several values, they are next to each other
+        start = np.searchsorted(type_hashes, value_hashes, side="left")
+        end = np.searchsorted(type_hashes, value_hashes, side="right")
+        unresolved = np.flatnonzero(~missing & (end > start))
+        offset = 0
+        while len(unresolved) > 0:
+            positions = start[unresolved] + offset
+            equal = type_values[positions] == value_strings[unresolved]
+            codes[unresolved[equal]] = self.codes[identifier_type][positions[equal]]
+            unresolved = unresolved[~equal]
+            offset += 1
+            unresolved = unresolved[start[unresolved] + offset < end[unresolved]]
+
+        return codes
+
+    def resolve(self, drugs):
+        """ Recover id of every row of a dataframe of drugs, in one pass
+
+        The identifier columns are tried in the order of REFERENCE_COLUMNS and each row
+        takes the recover id of the first one that matches. drug_name has to be lower case
+        and input_smiles is matched through the normalized smiles column.
+
+        Returns:
+            recover id of each row (None when nothing matched) and the identifier type
+            that matched (None when nothing matched)
+        """
+
+        codes = np.full(len(drugs), -1, dtype=np.int32)
+        matched = np.full(len(drugs), None, dtype=object)
+
+        for identifier_type in REFERENCE_COLUMNS:
+            if identifier_type not in drugs.columns:
+                continue
+
+            value_column = "smiles" if identifier_type == "input_smiles" else identifier_type
+            unresolved = np.flatnonzero(codes < 0)
+            if len(unresolved) == 0:
+                break
+
+            found = self.lookup(identifier_type, drugs[value_column].iloc[unresolved])
+            codes[unresolved] = found
+            matched[unresolved[found >= 0]] = identifier_type
+
+        recover_ids = np.full(len(drugs), None, dtype=object)
+        recover_ids[codes >= 0] = self.recover_ids[codes[codes >= 0]]
+
+        return recover_ids, matched
+
+
+def get_identifier_index():
+    """ Returns the identifier index of the references
+
+    It is compiled the first time it is needed, stored next to the references, and
+    rebuilt when one of them changes.
+    """
+
+    folder = rsv.RESERVOIR_DATA_FOLDER + "/parsed/drugs"
+    source_paths = [os.path.join(folder, file) for file in REFERENCE_FILES]
+
+    return dataset_cache.load(
+        source_paths[0],
+        (
+            "identifier_index",
+            INDEX_VERSION,
+            tuple(file_signature(path) for path in source_paths[1:]),
+        ),
+        lambda: storage.load_or_build(
+            os.path.join(folder, f"identifier_index_v{INDEX_VERSION}.pickle"),
+            source_paths,
+            lambda: IdentifierIndex.from_references(load_references()["REFERENCES"]),
+        ),
+    )
 
 
 def parse_smiles(smiles):
@@ -58,30 +264,12 @@ def parse_smiles(smiles):
     Args:
         smiles: a string with the smiles
 
+    Results are cached in memory and on disk, see smiles_normalization
     """
-    if type(smiles) != type(""):
-        return None
+    return normalize_smiles(smiles)
 
-    try:
-        # Copnvert to Rdkit format
-        smiles = smiles.split()[0]
-        mol = Chem.MolFromSmiles(smiles)
 
-        # remove salts
-        remover = SaltRemover()
-        mol = remover.StripMol(mol)
-
-        # get new smiles
-        parsed_smiles = Chem.MolToSmiles(mol)
-        return parsed_smiles
-
-    except Exception as e:
-        print(f"Error parsing smiles: {smiles}")
-
-    return smiles
-
-
-def map_drugs(drugs, commit_new_drugs=False):
+def map_drugs(drugs, commit_new_drugs=False, workers=None):
     """ Maps a list of drugs to a Relation id
 
     Args:
@@ -91,9 +279,11 @@ def map_drugs(drugs, commit_new_drugs=False):
                     drugbank_id
                     chembl_id
                     input_smiles
+        workers: number of processes normalizing the smiles, all available cores if None
 
     Returns:
-        Pandas DataFrame: The same dataframe with the Relation drug ID
+        Pandas DataFrame: The same dataframe, in the same order, with the Relation drug ID
+        and the identifier column it was matched with (matched_identifier)
     """
     # check if we have all the columns if commiting
     if commit_new_drugs and (
@@ -103,30 +293,25 @@ def map_drugs(drugs, commit_new_drugs=False):
             "In ordered to commit new drugs you need to supply a data frame with the drug_name and input_smiles columns"
         )
 
-    unmapped_drugs = drugs
-    mapped_drugs_list = []
+    drugs = drugs.copy()
 
     # normalize the drug name for matching. the reference will be lower case
     if "drug_name" in drugs.columns:
         drugs["drug_name"] = drugs["drug_name"].str.lower()
 
     if "input_smiles" in drugs.columns:
-        drugs["smiles"] = drugs["input_smiles"].apply(parse_smiles)
+        drugs["smiles"] = normalize_smiles_many(
+            drugs["input_smiles"], workers=workers
+        )
 
-    # go through each reference. map and continue with unmapped
-    for column in REFERENCES:
-        if column in drugs.columns:
-            # map and continue with unmapped
-            mapped_drugs, unmapped_drugs = map_to_recover_id_using_reference(
-                unmapped_drugs, REFERENCES[column]
-            )
-            mapped_drugs_list.append(mapped_drugs)
+    # all of the identifier columns are resolved in one pass, in the order of REFERENCE_COLUMNS
+    drugs["recover_id"], drugs["matched_identifier"] = get_identifier_index().resolve(drugs)
 
     if commit_new_drugs:
-        print(unmapped_drugs)
+        print(drugs.loc[pd.isnull(drugs["recover_id"])])
 
-    # return mapped and unmapped with a None in recover_id
-    return pd.concat(mapped_drugs_list + [unmapped_drugs])
+    # unmapped drugs have a None in recover_id
+    return drugs
 
 
 if __name__ == "__main__":
@@ -1,6 +1,23 @@
+import os
+import functools
+import numpy as np
+import pandas as pd
+import reservoir as rsv
 from rdkit import Chem
 from rdkit.Chem import AllChem
+from rdkit.Chem import rdFingerprintGenerator
 from rdkit import DataStructs
+from reservoir import storage
+from reservoir.cache import dataset_cache
+from reservoir.parsers.drugs.molecule_executor import map_molecules
+
+# Morgan fingerprints of fingerprint_similarity_from_smiles, packed in 64 bit words
+MORGAN_RADIUS = 2
+MORGAN_BITS = 1024
+WORDS = MORGAN_BITS // 64
+
+# bound on the (rows, columns, words) intermediate of many to many similarities
+MAX_PAIRS_PER_CHUNK = 2 ** 19
 
 
 def fingerprint_similarity_from_fingerprint(fp1, fp2):
@@ -20,6 +37,177 @@ def fingerprint_similarity_from_smiles(smiles1, smiles2):
     except Exception as e:
         print(f"Error {str(e)}")
 
+@functools.lru_cache(maxsize=None)
+def _morgan_generator():
+    # same bits as GetMorganFingerprintAsBitVect(mol, MORGAN_RADIUS, nBits=MORGAN_BITS)
+    return rdFingerprintGenerator.GetMorganGenerator(radius=MORGAN_RADIUS, fpSize=MORGAN_BITS)
+
+
+def packed_morgan_fingerprint(smiles):
+    """ Morgan fingerprint of a SMILES as WORDS uint64, raises if it can't be parsed
+    """
+
+    mol = Chem.MolFromSmiles(smiles)
+    if mol is None:
+        raise ValueError(f"Could not parse {smiles}")
+
+    bit_string = _morgan_generator().GetFingerprint(mol).ToBitString()
+    bits = np.frombuffer(bit_string.encode(), dtype=np.uint8) - ord("0")
+    return np.packbits(bits, bitorder="little").view(np.uint64)
+
+
+def packed_morgan_fingerprints(smiles, workers=None):
+    """ Packed fingerprints of many SMILES
+
+    Returns:
+        (len(smiles), WORDS) uint64 array, and the mask of the SMILES that could be
+        parsed (the others get an empty fingerprint)
+    """
+
+    results = map_molecules(packed_morgan_fingerprint, smiles, workers=workers)
+    fingerprints = np.zeros((len(results.values), WORDS), dtype=np.uint64)
+    valid = np.array([value is not None for value in results.values], dtype=bool)
+    if valid.any():
+        fingerprints[valid] = np.stack([value for value in results.values if value is not None])
+
+    return fingerprints, valid
+
+
+def popcount(fingerprints):
+    """ Number of bits set in each packed fingerprint (over the last axis)
+    """
+
+    fingerprints = np.ascontiguousarray(fingerprints, dtype=np.uint64)
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(fingerprints).sum(axis=-1, dtype=np.int32)
+
+    table = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+    as_bytes = fingerprints.view(np.uint8).reshape(fingerprints.shape[:-1] + (-1,))
+    return table[as_bytes].sum(axis=-1, dtype=np.int32)
+
+
+def _tanimoto(intersections, counts_a, counts_b):
+    unions = counts_a + counts_b - intersections
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # two empty fingerprints have a similarity of 0, as in RDKit
+        return np.where(unions > 0, intersections / unions, 0.0).astype(np.float32)
+
+
+def tanimoto_one_to_many(query, fingerprints, counts=None):
+    """ Tanimoto similarity of one packed fingerprint with many
+
+    Args:
+        query: (WORDS,) packed fingerprint
+        fingerprints: (n, WORDS) packed fingerprints
+        counts: popcount of fingerprints, computed if None
+    """
+
+    query = np.asarray(query, dtype=np.uint64)
+    counts = popcount(fingerprints) if counts is None else counts
+    intersections = popcount(fingerprints & query)
+
+    return _tanimoto(intersections, popcount(query), counts)
+
+
+def tanimoto_many_to_many(fingerprints_a, fingerprints_b, counts_a=None, counts_b=None):
+    """ (len(a), len(b)) Tanimoto similarities between two sets of packed fingerprints
+    """
+
+    counts_a = popcount(fingerprints_a) if counts_a is None else counts_a
+    counts_b = popcount(fingerprints_b) if counts_b is None else counts_b
+    similarities = np.empty((len(fingerprints_a), len(fingerprints_b)), dtype=np.float32)
+
+    rows_per_chunk = max(1, MAX_PAIRS_PER_CHUNK // max(len(fingerprints_b), 1))
+    for start in range(0, len(fingerprints_a), rows_per_chunk):
+        end = start + rows_per_chunk
+        intersections = popcount(fingerprints_a[start:end, None, :] & fingerprints_b[None, :, :])
+        similarities[start:end] = _tanimoto(
+            intersections, counts_a[start:end, None], counts_b[None, :]
+        )
+
+    return similarities
+
+
+class FingerprintStore:
+    """ Packed Morgan fingerprints of the drugs of recover_drugs.csv
+    """
+
+    cache_shared = True
+
+    def __init__(self, recover_ids, fingerprints, valid):
+        self.recover_ids = np.asarray(recover_ids, dtype=object)
+        self.fingerprints = fingerprints
+        self.valid = valid
+        self.counts = popcount(fingerprints)
+
+    def __sizeof__(self):
+        return self.fingerprints.nbytes + self.counts.nbytes + self.recover_ids.nbytes
+
+    @classmethod
+    def from_drugs(cls, drugs, workers=None):
+        """ Fingerprints of a dataframe with recover_id and smiles
+        """
+
+        fingerprints, valid = packed_morgan_fingerprints(list(drugs["smiles"]), workers=workers)
+        return cls(drugs["recover_id"].to_numpy(), fingerprints, valid)
+
+    def positions(self, recover_ids):
+        """ Rows of some drugs, -1 for the ones not in the store
+        """
+
+        return pd.Index(self.recover_ids).get_indexer(list(recover_ids))
+
+    def similarity(self, smiles):
+        """ Tanimoto similarity of a SMILES with every drug of the store
+        """
+
+        return tanimoto_one_to_many(
+            packed_morgan_fingerprint(smiles), self.fingerprints, self.counts
+        )
+
+    def similarity_matrix(self, recover_ids_a=None, recover_ids_b=None):
+        """ Similarities between some drugs of the store, all of them if None
+        """
+
+        if recover_ids_a is None:
+            rows_a = np.arange(len(self.recover_ids))
+        else:
+            rows_a = self.positions(recover_ids_a)
+        rows_b = rows_a if recover_ids_b is None else self.positions(recover_ids_b)
+        if (rows_a < 0).any() or (rows_b < 0).any():
+            raise Exception("Some recover ids are not in the fingerprint store")
+
+        return tanimoto_many_to_many(
+            self.fingerprints[rows_a],
+            self.fingerprints[rows_b],
+            self.counts[rows_a],
+            self.counts[rows_b],
+        )
+
+
+def get_fingerprint_store():
+    """ Returns the packed fingerprints of all of the drugs in recover_drugs.csv
+
+    They are computed the first time they are needed, stored next to the drugs
+    (morgan_fingerprints.pickle) and rebuilt when the drugs change.
+    """
+
+    drugs_path = f"{rsv.RESERVOIR_DATA_FOLDER}/parsed/drugs/recover_drugs.csv"
+    source_path = storage.table_path(drugs_path)
+
+    return dataset_cache.load(
+        source_path,
+        "fingerprint_store",
+        lambda: storage.load_or_build(
+            os.path.join(os.path.dirname(drugs_path), "morgan_fingerprints.pickle"),
+            [source_path],
+            lambda: FingerprintStore.from_drugs(
+                storage.read_table(drugs_path, columns=["recover_id", "smiles"])
+            ),
+        ),
+    )
+
+
 if __name__ == "__main__":
     drug1 = "CCn1cc(C(=O)[O-])c(=O)c2ccc(C)nc21"
     drug2 = "CC1COc2c(N3CCN(C)CC3)c(F)cc3c(=O)c(C(=O)O)cn1c23"
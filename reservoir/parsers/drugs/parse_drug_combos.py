@@ -1,226 +1,320 @@
 import pandas as pd
 import reservoir as rsv
+from reservoir import block_store
+from reservoir.parsers.drugs import combo_qc, drugcomb_downloader
 import numpy as np
 import json
-import urllib.request
+import argparse
 import os.path
-from multiprocessing import Pool
 
+RAW_FOLDER = rsv.RESERVOIR_DATA_FOLDER + "/raw/drug-combos/v1.5"
+PARSED_FOLDER = rsv.RESERVOIR_DATA_FOLDER + "/parsed/drug_combos/v1.5"
 
-def get_data_api(block_id):
-    """ Get assay data from drugcomb API
+
+BLOCK_COLUMNS = [
+    "drug_row_recover_id",
+    "drug_row_smiles",
+    "drug_col_recover_id",
+    "drug_col_smiles",
+    "cell_line_name",
+]
+
+
+def assemble_combo_blocks(combo_therapy):
+    """ Groups the combo measurements by block, with their concentration pairs
+    (row drug, col drug) and inhibitions as lists in measurement order.
+
+    Some blocks contain the inhibitions matrix twice (repeated concentration pairs),
+    only every other measurement is kept for those.
     """
-    url = 'https://api.drugcomb.org/response/' + str(block_id)
-    with urllib.request.urlopen(url) as response:
-        html = response.read()
-    encoding = response.headers.get_content_charset('utf-8')
-    html_text = html.decode(encoding)
-    json_text = json.loads(html_text)
-    block = pd.DataFrame(json_text)
-    return block
-
-
-def get_concentration_pairs(rows):
-    """ Function for extracting concentration pairs for each block
+
+    combo_therapy = combo_therapy.sort_values("block_id", kind="stable")
+
+    # repeated pairs, missing concentrations never match as in a python set of tuples
+    repeated = combo_therapy.duplicated(["block_id", "conc_r", "conc_c"]).to_numpy() & (
+        combo_therapy[["conc_r", "conc_c"]].notna().all(axis=1).to_numpy()
+    )
+    block_ids = combo_therapy["block_id"].to_numpy()
+    doubled_blocks = np.unique(block_ids[repeated])
+    positions = combo_therapy.groupby("block_id", sort=False).cumcount().to_numpy()
+    keep = ~np.isin(block_ids, doubled_blocks) | (positions % 2 == 0)
+    combo_therapy = combo_therapy.loc[keep]
+
+    # one slice of the measurements per block
+    _, starts = np.unique(combo_therapy["block_id"].to_numpy(), return_index=True)
+    ends = np.append(starts[1:], len(combo_therapy))
+
+    pairs = list(zip(combo_therapy["conc_r"].tolist(), combo_therapy["conc_c"].tolist()))
+    inhibitions = combo_therapy["inhibition"].tolist()
+
+    combo_blocks = combo_therapy.iloc[starts][["block_id"] + BLOCK_COLUMNS].reset_index(drop=True)
+    combo_blocks["pairs"] = [pairs[start:end] for start, end in zip(starts, ends)]
+    combo_blocks["inhibitions"] = [inhibitions[start:end] for start, end in zip(starts, ends)]
+
+    return combo_blocks
+
+
+def get_blocks(block_ids):
+    """ Measurements of some blocks. Blocks missing from blocks_data.csv are downloaded
+    and added to it
     """
-    pairs = list(rows.apply(lambda row: tuple([row["conc_r"], row["conc_c"]]), axis=1))
-    inhibitions = list(rows["inhibition"])
 
-    return pd.DataFrame(
-        [
-            {
-                "drug_row_RESERVOIR_id": rows.iloc[0]["drug_row_RESERVOIR_id"],
-                "drug_row_smiles": rows.iloc[0]["drug_row_smiles"],
-                "drug_col_RESERVOIR_id": rows.iloc[0]["drug_col_RESERVOIR_id"],
-                "drug_col_smiles": rows.iloc[0]["drug_col_smiles"],
-                "cell_line_name": rows.iloc[0]["cell_line_name"],
-                "pairs": pairs,
-                "inhibitions": inhibitions,
-            }
-        ]
+    fname = RAW_FOLDER + "/blocks_data.csv"
+
+    blocks = pd.read_csv(fname) if os.path.isfile(fname) else pd.DataFrame({"block_id": []})
+    missing_block_ids = sorted(set(block_ids).difference(blocks["block_id"]))
+
+    if len(missing_block_ids) > 0:
+        # each block is kept as it is downloaded, running again only fetches the missing ones
+        blocks_folder = RAW_FOLDER + "/blocks"
+        download = drugcomb_downloader.fetch_blocks(missing_block_ids, blocks_folder)
+        if len(download['failed']) > 0:
+            raise Exception(
+                f"{len(download['failed'])} blocks could not be downloaded, run the parser again to retry them"
+            )
+        new_blocks = drugcomb_downloader.read_blocks(missing_block_ids, blocks_folder)
+        blocks = pd.concat([blocks, new_blocks], ignore_index=True) if len(blocks) > 0 else new_blocks
+        write_atomically(fname, lambda path: blocks.to_csv(path, index=False))
+
+    return blocks
+
+
+def block_hashes(summary_data, blocks):
+    """ Hash of the content of every block, its summary row and all of its measurements
+    in order. Used to find the blocks that changed between releases
+    """
+
+    summary_hashes = pd.Series(
+        pd.util.hash_pandas_object(summary_data, index=False).to_numpy(),
+        index=summary_data["block_id"].to_numpy(),
     )
 
+    # the position of each measurement is part of its hash, so reordering is a change
+    positions = blocks.groupby("block_id").cumcount()
+    row_hashes = pd.util.hash_pandas_object(blocks.assign(position=positions), index=False)
+    measurement_hashes = pd.Series(
+        row_hashes.to_numpy(), index=blocks["block_id"].to_numpy()
+    ).groupby(level=0).sum()
 
-chunksize = 10000 # For multiprocessing
-
-summary_data = pd.read_csv(rsv.RESERVOIR_DATA_FOLDER + "/raw/drug-combos/v1.5/summary_v_1_5.csv")
-
-fname = rsv.RESERVOIR_DATA_FOLDER + "/raw/drug-combos/v1.5/blocks_data.csv"
-
-if not os.path.isfile(fname):
-    with Pool(100) as p:
-        summary_data['block_data'] = p.map(get_data_api, summary_data['block_id'], chunksize)
-    blocks = pd.concat(summary_data['block_data'].values)
-    blocks.to_csv(fname, index=False)
-    summary_data = summary_data.drop(columns='block_data')
-else:
-    blocks = pd.read_csv(fname)
-
-
-# Get all unique drugs
-row_drugs = (
-    summary_data[["drug_row"]]
-    .drop_duplicates()
-    .rename(columns={"drug_row": "drug_name"})
-)
-col_drugs = (
-    summary_data[["drug_col"]]
-    .drop_duplicates()
-    .rename(columns={"drug_col": "drug_name"})
-)
-unique_drugs = pd.concat([row_drugs, col_drugs]).drop_duplicates()
-unique_drugs = unique_drugs.loc[~unique_drugs["drug_name"].isna()]
-
-# Add drug information
-# drugs file from https://api.drugcomb.org/drugs
-drug_json = open(rsv.RESERVOIR_DATA_FOLDER + "/raw/drug-combos/v1.5/drugs")
-drug_json_data = json.load(drug_json)
-drug_info = pd.DataFrame(drug_json_data)
-drug_info = drug_info.rename(columns={'dname': 'drug_name',
-                                      'smiles': 'inputs_smiles',
-                                      'cid': 'pubchem_cid'})
-
-unique_drugs = unique_drugs.merge(drug_info, on=['drug_name'])
-unique_drugs = unique_drugs.drop_duplicates(subset=['drug_name'])
-
-# Map drugs to RESERVOIR IDs
-unique_drugs['pubchem_cid'] = unique_drugs['pubchem_cid'].astype(object) # map_drugs fails if pubchem cid is float
-mapped_drugs = rsv.map_drugs(unique_drugs)
-mapped_drugs = mapped_drugs.loc[~pd.isna(mapped_drugs["RESERVOIR_id"])]
-mapped_drug_data = rsv.get_drugs(filter=set(mapped_drugs["RESERVOIR_id"]))
-mapped_drugs = mapped_drugs.merge(mapped_drug_data[["RESERVOIR_id", "smiles"]])
-
-# Drug name to lower case to allow merging with mapped drugs
-summary_data['drug_col'] = summary_data['drug_col'].str.lower()
-summary_data['drug_row'] = summary_data['drug_row'].str.lower()
-
-# Connect to dose data
-drug_combos = summary_data.merge(
-    mapped_drugs[["RESERVOIR_id", "smiles", "drug_name"]].rename(
-        columns={"RESERVOIR_id": "drug_row_RESERVOIR_id", "smiles": "drug_row_smiles"}
-    ),
-    left_on="drug_row",
-    right_on="drug_name",
-)
-
-drug_combos = drug_combos.merge(
-    mapped_drugs[["RESERVOIR_id", "smiles", "drug_name"]].rename(
-        columns={"RESERVOIR_id": "drug_col_RESERVOIR_id", "smiles": "drug_col_smiles"}
-    ),
-    left_on="drug_col",
-    right_on="drug_name",
-)
-
-# Add block info to drug combos
-drug_combos = drug_combos.rename(columns={'synergy_zip': 'synergy_zip_summary',
-                                          'synergy_loewe': 'synergy_loewe_summary',
-                                          'synergy_hsa': 'synergy_hsa_summary',
-                                          'synergy_bliss': 'synergy_bliss_summary'})
-
-drug_combos = drug_combos.merge(blocks, on='block_id')
-
-# Extract monotherapy for the row side
-mono_therapy_row = drug_combos.loc[
-    drug_combos["conc_c"] == 0.0,
-    [
-        "block_id",
-        "drug_row_RESERVOIR_id",
-        "drug_row_smiles",
-        "cell_line_name",
-        "conc_r",
-        "inhibition",
-    ],
-]
-mono_therapy_row_by_block = (
-    mono_therapy_row.groupby("block_id")
-    .agg(
+    hashes = pd.DataFrame(
         {
-            "drug_row_RESERVOIR_id": "first",
-            "drug_row_smiles": "first",
-            "cell_line_name": "first",
-            "conc_r": list,
-            "inhibition": list,
+            "summary_hash": summary_hashes,
+            "measurement_hash": measurement_hashes.reindex(summary_hashes.index, fill_value=0),
         }
     )
-    .reset_index()
-)
-mono_therapy_row_by_block = mono_therapy_row_by_block.rename(
-    columns={"inhibition": "inhibition_r"}
-)
-mono_therapy_row_by_block["conc_r"] = mono_therapy_row_by_block["conc_r"].apply(
-    np.array
-)
-mono_therapy_row_by_block["inhibition_r"] = mono_therapy_row_by_block[
-    "inhibition_r"
-].apply(np.array)
-
-# Extract monotherapy for the col side
-mono_therapy_col = drug_combos.loc[
-    drug_combos["conc_r"] == 0.0,
-    [
-        "block_id",
-        "drug_col_RESERVOIR_id",
-        "drug_col_smiles",
-        "cell_line_name",
-        "conc_c",
-        "inhibition",
-    ],
-]
-mono_therapy_col_by_block = (
-    mono_therapy_col.groupby("block_id")
-    .agg(
+
+    return pd.DataFrame(
         {
-            "drug_col_RESERVOIR_id": "first",
-            "drug_col_smiles": "first",
-            "cell_line_name": "first",
-            "conc_c": list,
-            "inhibition": list,
+            "block_id": summary_hashes.index,
+            "content_hash": pd.util.hash_pandas_object(hashes, index=False).to_numpy(),
         }
     )
-    .reset_index()
-)
-mono_therapy_col_by_block = mono_therapy_col_by_block.rename(
-    columns={"inhibition": "inhibition_c"}
-)
-mono_therapy_col_by_block["conc_c"] = mono_therapy_col_by_block["conc_c"].apply(
-    np.array
-)
-mono_therapy_col_by_block["inhibition_c"] = mono_therapy_col_by_block[
-    "inhibition_c"
-].apply(np.array)
-
-# combine row and col monotherapy data
-mono_therapy_combined = mono_therapy_row_by_block.merge(mono_therapy_col_by_block)
-mono_therapy_combined = mono_therapy_combined[
-    [
-        "block_id",
-        "cell_line_name",
-        "drug_row_RESERVOIR_id",
-        "drug_row_smiles",
-        "conc_r",
-        "inhibition_r",
-        "drug_col_RESERVOIR_id",
-        "drug_col_smiles",
-        "conc_c",
-        "inhibition_c",
+
+
+def map_combo_drugs(summary_data):
+    """ Maps the drugs of the summary to recover ids
+    """
+
+    # Get all unique drugs
+    row_drugs = (
+        summary_data[["drug_row"]]
+        .drop_duplicates()
+        .rename(columns={"drug_row": "drug_name"})
+    )
+    col_drugs = (
+        summary_data[["drug_col"]]
+        .drop_duplicates()
+        .rename(columns={"drug_col": "drug_name"})
+    )
+    unique_drugs = pd.concat([row_drugs, col_drugs]).drop_duplicates()
+    unique_drugs = unique_drugs.loc[~unique_drugs["drug_name"].isna()]
+
+    # Add drug information
+    # drugs file from https://api.drugcomb.org/drugs
+    with open(RAW_FOLDER + "/drugs") as drug_json:
+        drug_json_data = json.load(drug_json)
+    drug_info = pd.DataFrame(drug_json_data)
+    drug_info = drug_info.rename(columns={'dname': 'drug_name',
+                                          'smiles': 'inputs_smiles',
+                                          'cid': 'pubchem_cid'})
+
+    unique_drugs = unique_drugs.merge(drug_info, on=['drug_name'])
+    unique_drugs = unique_drugs.drop_duplicates(subset=['drug_name'])
+
+    # Map drugs to recover ids
+    unique_drugs['pubchem_cid'] = unique_drugs['pubchem_cid'].astype(object) # map_drugs fails if pubchem cid is float
+    mapped_drugs = rsv.map_drugs(unique_drugs)
+    mapped_drugs = mapped_drugs.loc[~pd.isna(mapped_drugs["recover_id"])]
+    mapped_drug_data = rsv.get_drugs(filter=set(mapped_drugs["recover_id"]))
+    mapped_drugs = mapped_drugs.merge(mapped_drug_data[["recover_id", "smiles"]])
+
+    return mapped_drugs
+
+
+def parse_blocks(summary_data, blocks):
+    """ Parses some blocks into the combo, mono therapy, summary and statistics tables
+    """
+
+    mapped_drugs = map_combo_drugs(summary_data)
+
+    # Drug name to lower case to allow merging with mapped drugs
+    summary_data = summary_data.copy()
+    summary_data['drug_col'] = summary_data['drug_col'].str.lower()
+    summary_data['drug_row'] = summary_data['drug_row'].str.lower()
+
+    # Connect to dose data
+    drug_combos = summary_data.merge(
+        mapped_drugs[["recover_id", "smiles", "drug_name"]].rename(
+            columns={"recover_id": "drug_row_recover_id", "smiles": "drug_row_smiles"}
+        ),
+        left_on="drug_row",
+        right_on="drug_name",
+    )
+
+    drug_combos = drug_combos.merge(
+        mapped_drugs[["recover_id", "smiles", "drug_name"]].rename(
+            columns={"recover_id": "drug_col_recover_id", "smiles": "drug_col_smiles"}
+        ),
+        left_on="drug_col",
+        right_on="drug_name",
+    )
+
+    # Add block info to drug combos
+    drug_combos = drug_combos.rename(columns={'synergy_zip': 'synergy_zip_summary',
+                                              'synergy_loewe': 'synergy_loewe_summary',
+                                              'synergy_hsa': 'synergy_hsa_summary',
+                                              'synergy_bliss': 'synergy_bliss_summary'})
+
+    drug_combos = drug_combos.merge(blocks, on='block_id')
+
+    # Extract monotherapy for the row side
+    mono_therapy_row = drug_combos.loc[
+        drug_combos["conc_c"] == 0.0,
+        [
+            "block_id",
+            "drug_row_recover_id",
+            "drug_row_smiles",
+            "cell_line_name",
+            "conc_r",
+            "inhibition",
+        ],
     ]
-]
+    mono_therapy_row_by_block = (
+        mono_therapy_row.groupby("block_id")
+        .agg(
+            {
+                "drug_row_recover_id": "first",
+                "drug_row_smiles": "first",
+                "cell_line_name": "first",
+                "conc_r": list,
+                "inhibition": list,
+            }
+        )
+        .reset_index()
+    )
+    mono_therapy_row_by_block = mono_therapy_row_by_block.rename(
+        columns={"inhibition": "inhibition_r"}
+    )
+    mono_therapy_row_by_block["conc_r"] = mono_therapy_row_by_block["conc_r"].apply(
+        np.array
+    )
+    mono_therapy_row_by_block["inhibition_r"] = mono_therapy_row_by_block[
+        "inhibition_r"
+    ].apply(np.array)
 
+    # Extract monotherapy for the col side
+    mono_therapy_col = drug_combos.loc[
+        drug_combos["conc_r"] == 0.0,
+        [
+            "block_id",
+            "drug_col_recover_id",
+            "drug_col_smiles",
+            "cell_line_name",
+            "conc_c",
+            "inhibition",
+        ],
+    ]
+    mono_therapy_col_by_block = (
+        mono_therapy_col.groupby("block_id")
+        .agg(
+            {
+                "drug_col_recover_id": "first",
+                "drug_col_smiles": "first",
+                "cell_line_name": "first",
+                "conc_c": list,
+                "inhibition": list,
+            }
+        )
+        .reset_index()
+    )
+    mono_therapy_col_by_block = mono_therapy_col_by_block.rename(
+        columns={"inhibition": "inhibition_c"}
+    )
+    mono_therapy_col_by_block["conc_c"] = mono_therapy_col_by_block["conc_c"].apply(
+        np.array
+    )
+    mono_therapy_col_by_block["inhibition_c"] = mono_therapy_col_by_block[
+        "inhibition_c"
+    ].apply(np.array)
 
-# Extract combos and groupby block
-combo_therapy = drug_combos.loc[
-    (drug_combos["conc_c"] != 0.0) & (drug_combos["conc_r"] != 0.0)
-]
-combo_therapy_by_block = combo_therapy.groupby("block_id").apply(
-    get_concentration_pairs
-)
-combo_therapy_by_block = combo_therapy_by_block.reset_index()
-
-# Connect with synergy scores
-combo_therapy_by_block = combo_therapy_by_block.merge(
-    summary_data[
+    # combine row and col monotherapy data
+    mono_therapy_combined = mono_therapy_row_by_block.merge(mono_therapy_col_by_block)
+    mono_therapy_combined = mono_therapy_combined[
+        [
+            "block_id",
+            "cell_line_name",
+            "drug_row_recover_id",
+            "drug_row_smiles",
+            "conc_r",
+            "inhibition_r",
+            "drug_col_recover_id",
+            "drug_col_smiles",
+            "conc_c",
+            "inhibition_c",
+        ]
+    ]
+
+    # Extract combos and groupby block
+    combo_therapy = drug_combos.loc[
+        (drug_combos["conc_c"] != 0.0) & (drug_combos["conc_r"] != 0.0)
+    ]
+    combo_therapy_by_block = assemble_combo_blocks(combo_therapy)
+
+    # Connect with synergy scores
+    combo_therapy_by_block = combo_therapy_by_block.merge(
+        summary_data[
+            [
+                "block_id",
+                "ic50_row",
+                "ic50_col",
+                "ri_row",
+                "ri_col",
+                "css_row",
+                "css_col",
+                "css_ri",
+                "S_sum", "S_mean", "S_max",
+                "synergy_zip",
+                "synergy_bliss",
+                "synergy_loewe",
+                "synergy_hsa",
+                "drug_row_clinical_phase",
+                "drug_col_clinical_phase",
+                "drug_row_target_name",
+                "drug_col_target_name"
+            ]
+        ]
+    )
+
+    combo_therapy_by_block = combo_therapy_by_block[
         [
             "block_id",
+            "cell_line_name",
+            "drug_row_recover_id",
+            "drug_row_smiles",
+            "drug_col_recover_id",
+            "drug_col_smiles",
+            "pairs",
+            "inhibitions",
             "ic50_row",
             "ic50_col",
             "ri_row",
@@ -235,197 +329,212 @@ combo_therapy_by_block = combo_therapy_by_block.merge(
             "synergy_hsa",
             "drug_row_clinical_phase",
             "drug_col_clinical_phase",
-            "drug_row_target_name",
-            "drug_col_target_name"
         ]
     ]
-)
-
-combo_therapy_by_block = combo_therapy_by_block[
-    [
-        "block_id",
-        "cell_line_name",
-        "drug_row_RESERVOIR_id",
-        "drug_row_smiles",
-        "drug_col_RESERVOIR_id",
-        "drug_col_smiles",
-        "pairs",
-        "inhibitions",
-        "ic50_row",
-        "ic50_col",
-        "ri_row",
-        "ri_col",
-        "css_row",
-        "css_col",
-        "css_ri",
-        "S_sum", "S_mean", "S_max",
-        "synergy_zip",
-        "synergy_bliss",
-        "synergy_loewe",
-        "synergy_hsa",
-        "drug_row_clinical_phase",
-        "drug_col_clinical_phase",
-    ]
-]
 
-combo_therapy_by_block = combo_therapy_by_block.rename(
-    columns={"pairs": "concentration_pairs"}
-)
-
-# Add min and max synergy scores
-min_synergy = drug_combos[["block_id",
-                           "synergy_zip", 
-                           "synergy_bliss",
-                           "synergy_loewe",
-                           "synergy_hsa"]].groupby('block_id').agg('min').reset_index()
-
-new_col_names = list()
-for col in min_synergy.columns:
-    if col != 'block_id':
-        col = col + '_min'
-    new_col_names.append(col)
-
-min_synergy.columns = new_col_names
-
-max_synergy = drug_combos[["block_id",
-                           "synergy_zip",
-                           "synergy_bliss",
-                           "synergy_loewe",
-                           "synergy_hsa"]].groupby('block_id').agg('max').reset_index()
-
-new_col_names = list()
-for col in max_synergy.columns:
-    if col != 'block_id':
-        col = col + '_max'
-    new_col_names.append(col)
-    
-max_synergy.columns = new_col_names
-
-combo_therapy_by_block = combo_therapy_by_block.merge(min_synergy, on='block_id')
-combo_therapy_by_block = combo_therapy_by_block.merge(max_synergy, on='block_id')
-
-# Some blocks contain the inhibitions matrix twice. We need to clean that up.
-doubled = combo_therapy_by_block.concentration_pairs.apply(
-    lambda cp: len(set(tuple(p) for p in cp)) != len(cp) )
-    
-combo_therapy_by_block.loc[doubled,'concentration_pairs'] = combo_therapy_by_block.loc[
-    doubled,'concentration_pairs'].apply(lambda c: c[::2])
-combo_therapy_by_block.loc[doubled,'inhibitions'] = combo_therapy_by_block.loc[
-    doubled,'inhibitions'].apply(lambda c: c[::2])
-
-
-#%%export
-
-combo_therapy_by_block.to_json(
-    rsv.RESERVOIR_DATA_FOLDER + "/parsed/drug_combos/v1.5/combos.json"
-)
-
-mono_therapy_combined.to_json(
-    rsv.RESERVOIR_DATA_FOLDER + "/parsed/drug_combos/v1.5/mono_therapy.json"
-)
-#%%
-
-# add number of measurements from mono and combo therapies
-mono_therapy_combined["mono_row_measurements"] = mono_therapy_combined[
-    "inhibition_r"
-].apply(len)
-mono_therapy_combined["mono_col_measurements"] = mono_therapy_combined[
-    "inhibition_c"
-].apply(len)
-combo_therapy_by_block["combo_measurements"] = combo_therapy_by_block[
-    "inhibitions"
-].apply(len)
-
-# clean summary data
-summary_data = summary_data[
-        ["block_id", "study_name"]
-]
+    combo_therapy_by_block = combo_therapy_by_block.rename(
+        columns={"pairs": "concentration_pairs"}
+    )
 
-summary_data = summary_data.merge(
-    combo_therapy_by_block[["block_id", "cell_line_name"]]
-)
+    # Add min and max synergy scores
+    min_synergy = drug_combos[["block_id",
+                               "synergy_zip",
+                               "synergy_bliss",
+                               "synergy_loewe",
+                               "synergy_hsa"]].groupby('block_id').agg('min').reset_index()
 
-summary_data = summary_data.merge(
-    mono_therapy_combined[
-        ["block_id", "mono_row_measurements", "mono_col_measurements"]
-    ]
-)
-summary_data = summary_data.merge(
-    combo_therapy_by_block[["block_id", "combo_measurements"]]
-)
-
-#%%export
-
-summary_data.to_csv(
-    rsv.RESERVOIR_DATA_FOLDER + "/parsed/drug_combos/v1.5/summary_data.csv", 
-    index=False
-)
-
-#%%Quality control
-
-#filter out failed/low quality experiments
-with Pool(100) as p:
-    combo_therapy_by_block['inhibi_mean'] = p.map(np.mean, combo_therapy_by_block.inhibitions)
-
-with Pool(100) as p:
-    combo_therapy_by_block['inhibi_std'] = p.map(np.std, combo_therapy_by_block.inhibitions)
-
-block_mask = \
-    ( combo_therapy_by_block['inhibi_std'] > 0.05 ) & \
-    ( combo_therapy_by_block["combo_measurements"] >= 9 ) & \
-    ( combo_therapy_by_block['inhibi_mean'] >= -15 ) & \
-    ( combo_therapy_by_block['inhibi_mean'] < 100 )
-
-three_by_three_mask = list()
-for c in combo_therapy_by_block['concentration_pairs']:
-    col = pd.DataFrame(c)[0].drop_duplicates()
-    row = pd.DataFrame(c)[1].drop_duplicates()
-    if len(col) > 2 and len(row) > 2:
-        three_by_three_mask.append(True)
-    else:
-        three_by_three_mask.append(False)
+    new_col_names = list()
+    for col in min_synergy.columns:
+        if col != 'block_id':
+            col = col + '_min'
+        new_col_names.append(col)
+
+    min_synergy.columns = new_col_names
+
+    max_synergy = drug_combos[["block_id",
+                               "synergy_zip",
+                               "synergy_bliss",
+                               "synergy_loewe",
+                               "synergy_hsa"]].groupby('block_id').agg('max').reset_index()
+
+    new_col_names = list()
+    for col in max_synergy.columns:
+        if col != 'block_id':
+            col = col + '_max'
+        new_col_names.append(col)
+
+    max_synergy.columns = new_col_names
 
-three_by_three_mask = pd.Series(three_by_three_mask)
+    combo_therapy_by_block = combo_therapy_by_block.merge(min_synergy, on='block_id')
+    combo_therapy_by_block = combo_therapy_by_block.merge(max_synergy, on='block_id')
 
-block_mask = block_mask & three_by_three_mask
-block_mask.index = combo_therapy_by_block.block_id
+    # clean summary data
+    block_summary = summarize_blocks(summary_data, combo_therapy_by_block, mono_therapy_combined)
 
-block_mask = block_mask.reset_index()
-block_mask.columns = ['block_id', 'mask']
+    # statistics used to filter out failed/low quality experiments
+    block_stats = combo_qc.compute_block_stats(combo_therapy_by_block)
 
-#%%export
-block_mask[['block_id', 'mask']].to_csv(
-    rsv.RESERVOIR_DATA_FOLDER + "/parsed/drug_combos/v1.5/block_mask.csv",
-    index=False
+    return {
+        "combos": combo_therapy_by_block,
+        "mono_therapy": mono_therapy_combined,
+        "summary_data": block_summary,
+        "block_stats": block_stats,
+    }
+
+
+def summarize_blocks(summary_data, combo_therapy_by_block, mono_therapy_combined):
+    """ Study, cell line and number of measurements from mono and combo therapies of each block
+    """
+
+    mono_measurements = pd.DataFrame(
+        {
+            "block_id": mono_therapy_combined["block_id"],
+            "mono_row_measurements": mono_therapy_combined["inhibition_r"].apply(len),
+            "mono_col_measurements": mono_therapy_combined["inhibition_c"].apply(len),
+        }
     )
+    combo_measurements = pd.DataFrame(
+        {
+            "block_id": combo_therapy_by_block["block_id"],
+            "combo_measurements": combo_therapy_by_block["inhibitions"].apply(len),
+        }
+    )
+
+    block_summary = summary_data[["block_id", "study_name"]]
+    block_summary = block_summary.merge(
+        combo_therapy_by_block[["block_id", "cell_line_name"]]
+    )
+    block_summary = block_summary.merge(mono_measurements)
+    block_summary = block_summary.merge(combo_measurements)
 
-#%%filter again with stricter thresholds
-block_mask = \
-    ( combo_therapy_by_block['inhibi_std'] > 0.05 ) & \
-    ( combo_therapy_by_block["combo_measurements"] >= 9 ) & \
-    ( combo_therapy_by_block['inhibi_mean'] >= -5 ) & \
-    ( combo_therapy_by_block['inhibi_mean'] < 95 )
+    return block_summary
 
 
-three_by_three_mask = list()
-for c in combo_therapy_by_block['concentration_pairs']:
-    col = pd.DataFrame(c)[0].drop_duplicates()
-    row = pd.DataFrame(c)[1].drop_duplicates()
-    if len(col) > 2 and len(row) > 2:
-        three_by_three_mask.append(True)
-    else:
-        three_by_three_mask.append(False)
+def read_parsed_tables():
+    """ Reads the tables written by a previous run
+    """
+
+    # floats are read back exactly, so that unchanged blocks are written unchanged
+    return {
+        "combos": pd.read_json(PARSED_FOLDER + "/combos.json", precise_float=True),
+        "mono_therapy": pd.read_json(PARSED_FOLDER + "/mono_therapy.json", precise_float=True),
+        "summary_data": pd.read_csv(
+            PARSED_FOLDER + "/summary_data.csv", low_memory=False, float_precision="round_trip"
+        ),
+        "block_stats": pd.read_csv(
+            PARSED_FOLDER + "/block_stats.csv", float_precision="round_trip"
+        ),
+    }
+
+
+def update_tables(parsed_tables, new_tables, replaced_block_ids):
+    """ Drops the blocks that changed or were removed, adds the newly parsed ones, keeping block order
+    """
+
+    updated_tables = {}
+    for name, table in parsed_tables.items():
+        table = table.loc[~table["block_id"].isin(replaced_block_ids)]
+        table = pd.concat([table, new_tables[name]], ignore_index=True)
+        updated_tables[name] = table.sort_values("block_id", kind="stable").reset_index(drop=True)
 
-three_by_three_mask = pd.Series(three_by_three_mask)
-block_mask = block_mask & three_by_three_mask
+    return updated_tables
 
-block_mask.index = combo_therapy_by_block.block_id
 
-block_mask = block_mask.reset_index()
-block_mask.columns = ['block_id', 'mask']
+def write_atomically(path, write):
+    """ Writes a file next to its final location and swaps it in when complete
+    """
+
+    tmp_path = path + ".tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def write_tables(tables, hashes):
+    """ Writes the parsed tables, the block stores and the QC masks
+    """
+
+    combos_file = PARSED_FOLDER + "/combos.json"
+    mono_file = PARSED_FOLDER + "/mono_therapy.json"
 
-#%%export2
-block_mask[['block_id', 'mask']].to_csv(
-    rsv.RESERVOIR_DATA_FOLDER + "/parsed/drug_combos/v1.5/block_mask_hq.csv",
-    index=False
+    write_atomically(combos_file, lambda path: tables["combos"].to_json(path))
+    write_atomically(mono_file, lambda path: tables["mono_therapy"].to_json(path))
+
+    # memory mapped copies for reading single blocks
+    block_store.write_block_store(
+        tables["combos"], block_store.store_path(combos_file), source_path=combos_file
+    )
+    block_store.write_block_store(
+        tables["mono_therapy"], block_store.store_path(mono_file), source_path=mono_file
     )
+
+    write_atomically(
+        PARSED_FOLDER + "/summary_data.csv",
+        lambda path: tables["summary_data"].to_csv(path, index=False),
+    )
+
+    write_atomically(
+        PARSED_FOLDER + "/block_stats.csv",
+        lambda path: tables["block_stats"].to_csv(path, index=False),
+    )
+
+    # masks of the presets, for older versions of the api
+    for file, preset in [("block_mask.csv", "medium"), ("block_mask_hq.csv", "high")]:
+        block_mask = combo_qc.block_mask(tables["block_stats"], **combo_qc.QC_PRESETS[preset])
+        write_atomically(
+            PARSED_FOLDER + "/" + file, lambda path: block_mask.to_csv(path, index=False)
+        )
+
+    # written last, an interrupted run is parsed again
+    write_atomically(
+        PARSED_FOLDER + "/block_hashes.csv", lambda path: hashes.to_csv(path, index=False)
+    )
+
+
+def main(incremental=False):
+    summary_data = pd.read_csv(RAW_FOLDER + "/summary_v_1_5.csv")
+    blocks = get_blocks(summary_data["block_id"])
+    hashes = block_hashes(summary_data, blocks)
+
+    hashes_file = PARSED_FOLDER + "/block_hashes.csv"
+    if incremental and os.path.isfile(hashes_file):
+        previous_hashes = pd.read_csv(hashes_file, dtype={"content_hash": "uint64"})
+        previous_hashes = dict(zip(previous_hashes["block_id"], previous_hashes["content_hash"]))
+
+        # blocks that are new or whose content changed since the last run
+        changed_block_ids = set(
+            block_id
+            for block_id, content_hash in zip(hashes["block_id"], hashes["content_hash"])
+            if previous_hashes.get(block_id) != content_hash
+        )
+        removed_block_ids = set(previous_hashes).difference(hashes["block_id"])
+        print(
+            f"{len(changed_block_ids)} new or changed blocks, {len(removed_block_ids)} removed blocks"
+        )
+
+        if len(changed_block_ids) == 0 and len(removed_block_ids) == 0:
+            return
+
+        new_tables = parse_blocks(
+            summary_data.loc[summary_data["block_id"].isin(changed_block_ids)],
+            blocks.loc[blocks["block_id"].isin(changed_block_ids)],
+        )
+        tables = update_tables(
+            read_parsed_tables(), new_tables, changed_block_ids.union(removed_block_ids)
+        )
+    else:
+        tables = parse_blocks(summary_data, blocks)
+
+    write_tables(tables, hashes)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parse the DrugComb blocks")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only parse the blocks that are new or changed since the last run. "
+        "Run without it when the drugs database changes",
+    )
+    args = parser.parse_args()
+
+    main(incremental=args.incremental)
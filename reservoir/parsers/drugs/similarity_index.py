@@ -0,0 +1,175 @@
+import numpy as np
+import pandas as pd
+import reservoir as rsv
+from concurrent.futures import ThreadPoolExecutor
+from reservoir import storage
+from reservoir.cache import dataset_cache
+from reservoir.parsers.drugs import molecule_tools
+from reservoir.parsers.drugs.molecule_executor import available_workers
+
+"""
+Nearest neighbours of molecules in the drug library by Tanimoto similarity.
+
+The fingerprints of the library are sorted by number of bits set. A fingerprint with
+a bits can't have a similarity above min(a, b) / max(a, b) with one of b bits (BitBound,
+Swamidass and Baldi 2007), so a query scans the groups of fingerprints in decreasing
+order of that bound and stops as soon as the bound falls below min_tanimoto or the
+k-th best similarity found so far.
+"""
+
+# minimum number of fingerprints compared at once, groups are merged up to this size
+BLOCK_ROWS = 4096
+
+
+class SimilarityIndex:
+    """ Top k Tanimoto search over the fingerprints of a FingerprintStore
+    """
+
+    cache_shared = True
+
+    def __init__(self, store):
+        # empty fingerprints (e.g. unparseable smiles) are never similar to anything
+        rows = np.flatnonzero(store.valid & (store.counts > 0))
+        order = rows[np.argsort(store.counts[rows], kind="stable")]
+
+        self.recover_ids = store.recover_ids[order]
+        self.fingerprints = np.ascontiguousarray(store.fingerprints[order])
+        self.counts = store.counts[order]
+
+        # the rows of the fingerprints with group_counts[i] bits are group_edges[i]:group_edges[i + 1]
+        self.group_counts, starts = np.unique(self.counts, return_index=True)
+        self.group_edges = np.r_[starts, len(self.counts)].astype(np.int64)
+
+    def __sizeof__(self):
+        return self.fingerprints.nbytes + self.counts.nbytes + self.recover_ids.nbytes
+
+    def search(self, query, k=10, min_tanimoto=0.0):
+        """ Most similar fingerprints of the index to a packed fingerprint
+
+        Args:
+            query: packed fingerprint, see molecule_tools.packed_morgan_fingerprint
+            k: maximum number of results, None for all of the ones above min_tanimoto
+            min_tanimoto: minimum similarity of the results
+
+        Returns:
+            positions in the index and similarities, sorted by decreasing similarity
+        """
+
+        query = np.asarray(query, dtype=np.uint64)
+        query_count = int(molecule_tools.popcount(query))
+        if query_count == 0 or len(self.counts) == 0 or k == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        bounds = np.minimum(self.group_counts, query_count) / np.maximum(
+            self.group_counts, query_count
+        )
+
+        # the bound decreases on both sides of the query count, so the groups scanned so
+        # far are always the contiguous range [left, right) and so are their rows
+        left = right = int(np.searchsorted(self.group_counts, query_count))
+        best_rows = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype=np.float32)
+        threshold = min_tanimoto
+
+        while True:
+            # widen the range with the groups of highest bound, until a block is large enough
+            new_left, new_right = left, right
+            while self.group_edges[new_right] - self.group_edges[new_left] < (
+                self.group_edges[right] - self.group_edges[left] + BLOCK_ROWS
+            ):
+                left_bound = bounds[new_left - 1] if new_left > 0 else -1.0
+                right_bound = bounds[new_right] if new_right < len(bounds) else -1.0
+                if max(left_bound, right_bound) < max(threshold, 0.0):
+                    break
+                if right_bound >= left_bound:
+                    new_right += 1
+                else:
+                    new_left -= 1
+            if new_left == left and new_right == right:
+                break
+
+            for start, end in [
+                (self.group_edges[new_left], self.group_edges[left]),
+                (self.group_edges[right], self.group_edges[new_right]),
+            ]:
+                if start == end:
+                    continue
+                scores = molecule_tools.tanimoto_one_to_many(
+                    query, self.fingerprints[start:end], self.counts[start:end]
+                )
+                keep = np.flatnonzero(scores >= min_tanimoto)
+                best_rows = np.concatenate([best_rows, start + keep])
+                best_scores = np.concatenate([best_scores, scores[keep]])
+            left, right = new_left, new_right
+
+            if k is not None and len(best_scores) >= k:
+                top = np.argpartition(-best_scores, k - 1)[:k]
+                best_rows = best_rows[top]
+                best_scores = best_scores[top]
+                threshold = max(min_tanimoto, float(best_scores.min()))
+
+        order = np.lexsort((best_rows, -best_scores))
+        return best_rows[order], best_scores[order]
+
+    def top_k(self, smiles, k=10, min_tanimoto=0.0):
+        """ Drugs most similar to a SMILES
+
+        Returns:
+            dataframe with recover_id and tanimoto, sorted by decreasing similarity
+        """
+
+        rows, scores = self.search(
+            molecule_tools.packed_morgan_fingerprint(smiles), k=k, min_tanimoto=min_tanimoto
+        )
+        return pd.DataFrame({"recover_id": self.recover_ids[rows], "tanimoto": scores})
+
+    def top_k_batch(self, smiles, k=10, min_tanimoto=0.0, workers=None):
+        """ Drugs most similar to each of many SMILES
+
+        Queries are spread over threads, the numpy operations of the scans release the GIL.
+        SMILES that can't be parsed have no results.
+
+        Args:
+            smiles: list of SMILES
+            k: maximum number of results per query, None for all above min_tanimoto
+            min_tanimoto: minimum similarity of the results
+            workers: number of threads, all available cores if None
+
+        Returns:
+            dataframe with query (position in smiles), recover_id and tanimoto, sorted by
+            query and decreasing similarity
+        """
+
+        workers = available_workers() if workers is None else workers
+        fingerprints, valid = molecule_tools.packed_morgan_fingerprints(list(smiles), workers=workers)
+        queries = np.flatnonzero(valid)
+
+        def search(query):
+            return self.search(fingerprints[query], k=k, min_tanimoto=min_tanimoto)
+
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            results = list(executor.map(search, queries))
+
+        rows = [result[0] for result in results]
+        return pd.DataFrame(
+            {
+                "query": np.repeat(queries, [len(r) for r in rows]).astype(np.int64),
+                "recover_id": self.recover_ids[np.concatenate(rows + [np.empty(0, dtype=np.int64)])],
+                "tanimoto": np.concatenate(
+                    [result[1] for result in results] + [np.empty(0, dtype=np.float32)]
+                ),
+            }
+        )
+
+
+def get_similarity_index():
+    """ Returns the similarity index of the drugs in recover_drugs.csv, see get_fingerprint_store
+    """
+
+    drugs_path = f"{rsv.RESERVOIR_DATA_FOLDER}/parsed/drugs/recover_drugs.csv"
+
+    return dataset_cache.load(
+        storage.table_path(drugs_path),
+        "similarity_index",
+        lambda: SimilarityIndex(molecule_tools.get_fingerprint_store()),
+    )
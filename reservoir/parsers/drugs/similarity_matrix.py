@@ -0,0 +1,275 @@
+import os
+import json
+import hashlib
+import shutil
+import multiprocessing
+import numpy as np
+import pandas as pd
+from reservoir.parsers.drugs import molecule_tools
+from reservoir.parsers.drugs.molecule_executor import available_workers
+
+"""
+Pairwise Tanimoto similarities of many drugs, written to disk tile by tile.
+
+The matrix is split in square tiles and only the tiles on and above the diagonal are
+computed, over a process pool. Each worker writes its tiles straight into the output:
+
+    dense: a memory mapped matrix.npy (float16 or float32), a tile and its transpose
+           at a time
+    sparse: one tiles/<i>_<j>.npz per tile with the pairs above the threshold
+
+A tile is only marked as done once it is on disk, so an interrupted build picks up
+where it stopped when it is called again with the same drugs and options.
+"""
+
+LAYOUT_FILE = "layout.json"
+DONE_FILE = "tiles_done.npy"
+DEFAULT_TILE_SIZE = 2048
+DTYPES = ["float16", "float32"]
+
+# set in each worker by _init_worker
+_worker = {}
+
+
+def _init_worker(path, fingerprints, counts, dtype, tile_size, threshold):
+    _worker.clear()
+    _worker.update(
+        path=path,
+        dtype=dtype,
+        fingerprints=fingerprints,
+        counts=counts,
+        tile_size=tile_size,
+        threshold=threshold,
+        matrix=None,
+    )
+
+
+def _compute_tile(tile):
+    """ Computes and writes one tile of the matrix, returns it once it is on disk
+    """
+
+    i, j = tile
+    size = _worker["tile_size"]
+    rows = slice(i * size, (i + 1) * size)
+    cols = slice(j * size, (j + 1) * size)
+    fingerprints = _worker["fingerprints"]
+    counts = _worker["counts"]
+
+    similarities = molecule_tools.tanimoto_many_to_many(
+        fingerprints[rows], fingerprints[cols], counts[rows], counts[cols]
+    )
+
+    if _worker["threshold"] is None:
+        if _worker["matrix"] is None:
+            _worker["matrix"] = np.load(os.path.join(_worker["path"], "matrix.npy"), mmap_mode="r+")
+        matrix = _worker["matrix"]
+        matrix[rows, cols] = similarities
+        matrix[cols, rows] = similarities.T
+        matrix.flush()
+    else:
+        # pairs above the threshold, each one once (row < col)
+        tile_rows, tile_cols = np.nonzero(similarities >= _worker["threshold"])
+        tile_rows = tile_rows + i * size
+        tile_cols = tile_cols + j * size
+        upper = tile_rows < tile_cols
+        values = similarities[tile_rows[upper] - i * size, tile_cols[upper] - j * size]
+        tile_path = os.path.join(_worker["path"], "tiles", f"{i}_{j}.npz")
+        with open(tile_path + ".tmp", "wb") as f:
+            np.savez(
+                f,
+                rows=tile_rows[upper].astype(np.int32),
+                cols=tile_cols[upper].astype(np.int32),
+                values=values.astype(_worker["dtype"]),
+            )
+        os.replace(tile_path + ".tmp", tile_path)
+
+    return tile
+
+
+def _layout(fingerprints, dtype, tile_size, threshold):
+    return {
+        "size": len(fingerprints),
+        "dtype": dtype,
+        "tile_size": tile_size,
+        "threshold": threshold,
+        # a drug whose smiles changed can't reuse the tiles it is in
+        "fingerprints": hashlib.sha1(fingerprints.tobytes()).hexdigest(),
+    }
+
+
+def _can_resume(path, recover_ids, layout):
+    """ A previous build can be resumed if it was started with the same drugs and options
+    """
+
+    if not os.path.exists(os.path.join(path, LAYOUT_FILE)):
+        return False
+
+    with open(os.path.join(path, LAYOUT_FILE)) as f:
+        if json.load(f) != layout:
+            return False
+
+    previous_ids = np.load(os.path.join(path, "recover_ids.npy"), allow_pickle=True)
+    return np.array_equal(previous_ids, recover_ids)
+
+
+def build_similarity_matrix(
+        path,
+        recover_ids=None,
+        dtype="float16",
+        threshold=None,
+        tile_size=DEFAULT_TILE_SIZE,
+        workers=None,
+):
+    """ Computes the Tanimoto similarities between drugs and writes them in a folder
+
+    Args:
+        path: output folder
+        recover_ids: drugs of the matrix, in order and without duplicates. All of the
+            drugs in recover_drugs.csv if None. Unknown recover ids raise an exception
+        dtype: "float16" or "float32", the type of the stored similarities
+        threshold: if given, only the pairs with a similarity of at least threshold are
+            stored, as a sparse matrix
+        tile_size: number of drugs per side of a tile
+        workers: number of worker processes, all available cores if None
+
+    Returns:
+        the SimilarityMatrix of the folder
+    """
+
+    if dtype not in DTYPES:
+        raise ValueError(f"dtype should be one of {DTYPES}, not {dtype}")
+
+    store = molecule_tools.get_fingerprint_store()
+    if recover_ids is None:
+        positions = np.arange(len(store.recover_ids))
+    else:
+        positions = store.positions(pd.unique(np.asarray(recover_ids, dtype=object)))
+        if (positions < 0).any():
+            unknown = np.asarray(recover_ids, dtype=object)[positions < 0]
+            raise Exception(f"Unknown recover ids: {list(unknown[:10])}")
+
+    recover_ids = store.recover_ids[positions]
+    fingerprints = np.ascontiguousarray(store.fingerprints[positions])
+    counts = store.counts[positions]
+    layout = _layout(fingerprints, dtype, tile_size, threshold)
+    n_tiles = -(-len(recover_ids) // tile_size)
+
+    if not _can_resume(path, recover_ids, layout):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.makedirs(os.path.join(path, "tiles"))
+
+        np.save(os.path.join(path, "recover_ids.npy"), recover_ids)
+        np.save(os.path.join(path, "valid.npy"), store.valid[positions])
+        np.save(os.path.join(path, DONE_FILE), np.zeros((n_tiles, n_tiles), dtype=bool))
+        if threshold is None:
+            np.lib.format.open_memmap(
+                os.path.join(path, "matrix.npy"),
+                mode="w+",
+                dtype=dtype,
+                shape=(len(recover_ids), len(recover_ids)),
+            ).flush()
+
+        # the layout is written last, a folder without one is never resumed
+        with open(os.path.join(path, LAYOUT_FILE), "w") as f:
+            json.dump(layout, f)
+
+    done = np.load(os.path.join(path, DONE_FILE), mmap_mode="r+")
+    tiles = [(i, j) for i in range(n_tiles) for j in range(i, n_tiles) if not done[i, j]]
+    arguments = (path, fingerprints, counts, dtype, tile_size, threshold)
+
+    workers = available_workers() if workers is None else workers
+    if workers > 1 and len(tiles) > 1:
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=arguments) as pool:
+            for i, j in pool.imap_unordered(_compute_tile, tiles):
+                done[i, j] = True
+                done.flush()
+    else:
+        _init_worker(*arguments)
+        for tile in tiles:
+            i, j = _compute_tile(tile)
+            done[i, j] = True
+            done.flush()
+        _worker.clear()
+
+    return SimilarityMatrix(path)
+
+
+class SimilarityMatrix:
+    """ Drug similarities written by build_similarity_matrix
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(os.path.join(path, LAYOUT_FILE)) as f:
+            self.layout = json.load(f)
+        self.recover_ids = np.load(os.path.join(path, "recover_ids.npy"), allow_pickle=True)
+        self.valid = np.load(os.path.join(path, "valid.npy"))
+        self.index = pd.Series(np.arange(len(self.recover_ids)), index=self.recover_ids)
+
+    @property
+    def is_sparse(self):
+        return self.layout["threshold"] is not None
+
+    @property
+    def complete(self):
+        done = np.load(os.path.join(self.path, DONE_FILE))
+        return bool(np.triu(done).sum() == len(done) * (len(done) + 1) // 2)
+
+    def positions(self, recover_ids):
+        """ Rows of the recover ids in the matrix, -1 for the ones that aren't in it
+        """
+
+        return self.index.reindex(recover_ids).fillna(-1).to_numpy(dtype=np.int64)
+
+    def dense(self):
+        """ The memory mapped N x N matrix, rows and columns follow self.recover_ids
+        """
+
+        if self.is_sparse:
+            raise Exception("The matrix was built with a threshold, use sparse()")
+
+        return np.load(os.path.join(self.path, "matrix.npy"), mmap_mode="r")
+
+    def pairs(self):
+        """ Dataframe with recover_id_a, recover_id_b and tanimoto (float32, rounded to
+        the dtype of the build) of the stored pairs, each pair once and without the diagonal
+        """
+
+        if not self.is_sparse:
+            raise Exception("The matrix was built without a threshold, use dense()")
+
+        tiles = [
+            np.load(os.path.join(self.path, "tiles", name))
+            for name in sorted(os.listdir(os.path.join(self.path, "tiles")))
+            if name.endswith(".npz")
+        ]
+        rows = np.concatenate([t["rows"] for t in tiles] + [np.empty(0, dtype=np.int32)])
+        cols = np.concatenate([t["cols"] for t in tiles] + [np.empty(0, dtype=np.int32)])
+        values = np.concatenate([t["values"] for t in tiles] + [np.empty(0, dtype=np.float32)])
+
+        return pd.DataFrame(
+            {
+                "recover_id_a": self.recover_ids[rows],
+                "recover_id_b": self.recover_ids[cols],
+                "tanimoto": values.astype(np.float32),
+            }
+        )
+
+    def sparse(self):
+        """ Symmetric scipy csr_matrix of the stored pairs, rows and columns follow
+        self.recover_ids. The diagonal is left out
+        """
+
+        from scipy import sparse
+
+        pairs = self.pairs()
+        rows = self.positions(pairs["recover_id_a"])
+        cols = self.positions(pairs["recover_id_b"])
+        values = pairs["tanimoto"].to_numpy()
+
+        return sparse.csr_matrix(
+            (np.r_[values, values], (np.r_[rows, cols], np.r_[cols, rows])),
+            shape=(len(self.recover_ids), len(self.recover_ids)),
+        )
@@ -0,0 +1,123 @@
+import rdkit
+from rdkit import Chem
+from rdkit.Chem.SaltRemover import SaltRemover
+from reservoir.disk_cache import DiskCache
+from reservoir.parsers.drugs.molecule_executor import map_molecules
+
+"""
+Normalization of SMILES strings shared by the drug mapper and the ChEMBL db builder.
+
+Normalizing a SMILES (parsing it, removing the salts and writing it back) is slow and
+the same molecules are normalized over and over, so results are kept in memory and in a
+disk cache keyed by the input SMILES and the RDKit version.
+"""
+
+_memo = {}
+_salt_remover = None
+_disk_cache = None
+
+
+def _get_salt_remover():
+    global _salt_remover
+    if _salt_remover is None:
+        _salt_remover = SaltRemover()
+    return _salt_remover
+
+
+def _get_disk_cache():
+    global _disk_cache
+    if _disk_cache is None:
+        _disk_cache = DiskCache("smiles")
+    return _disk_cache
+
+
+def cache_key(smiles):
+    return f"{rdkit.__version__}:{smiles}"
+
+
+def compute_normalized_smiles(smiles):
+    """ Normalizes a SMILES with RDKit, without any cache
+
+    Only the first word of the string is used. Raises an exception if it can't be parsed.
+    """
+
+    mol = Chem.MolFromSmiles(_first_word(smiles))
+    if mol is None:
+        raise Exception(f"Could not parse {smiles}")
+
+    mol = _get_salt_remover().StripMol(mol)
+    return Chem.MolToSmiles(mol)
+
+
+def _first_word(smiles):
+    words = smiles.split()
+    return words[0] if len(words) > 0 else smiles
+
+
+def normalize_smiles_many(smiles, use_disk_cache=True, workers=None):
+    """ Normalizes many SMILES, each distinct one is only computed once
+
+    Args:
+        smiles: iterable of SMILES, values that are not strings (e.g. None, nan) give None
+        use_disk_cache: whether to read and store the results in the disk cache
+        workers: number of processes computing the SMILES missing from the caches, all
+            available cores if None
+
+    Returns:
+        list of normalized SMILES in the order of smiles. SMILES that can't be parsed are
+        returned back (their first word) and reported, they are not cached so that they
+        are reported every time
+    """
+
+    smiles = list(smiles)
+    distinct = set(s for s in smiles if isinstance(s, str))
+    missing = [s for s in distinct if s not in _memo]
+
+    if len(missing) > 0 and use_disk_cache:
+        cached = _get_disk_cache().get_many(cache_key(s) for s in missing)
+        for s in missing:
+            if cache_key(s) in cached:
+                _memo[s] = cached[cache_key(s)]
+        missing = [s for s in missing if s not in _memo]
+
+    failed = {}
+    if len(missing) > 0:
+        results = map_molecules(compute_normalized_smiles, missing, workers=workers)
+        if len(results.errors) > 0:
+            print(
+                f"Could not normalize {len(results.errors)} smiles, e.g. {results.errors[0]}"
+            )
+        failed = {error.item: _first_word(error.item) for error in results.errors}
+
+        normalized = {
+            s: n for s, n in zip(missing, results.values) if s not in failed
+        }
+        _memo.update(normalized)
+        if use_disk_cache:
+            _get_disk_cache().set_many({cache_key(s): n for s, n in normalized.items()})
+
+    return [
+        (failed[s] if s in failed else _memo[s]) if isinstance(s, str) else None
+        for s in smiles
+    ]
+
+
+def normalize_smiles(smiles, use_disk_cache=True):
+    """ Sanity check and normalization for drugs
+
+    If a string is not provided (e.g. None, nan) None is returned back
+    If a string is provided and can't be parsed it is returned back
+
+    Args:
+        smiles: a string with the smiles
+        use_disk_cache: whether to read and store the result in the disk cache
+    """
+
+    return normalize_smiles_many([smiles], use_disk_cache=use_disk_cache)[0]
+
+
+def clear_memo():
+    """ Empties the in-memory results, the disk cache is kept
+    """
+
+    _memo.clear()
@@ -0,0 +1,77 @@
+import os
+import pandas as pd
+import reservoir as rsv
+from reservoir import storage
+
+"""
+Writes a parquet copy of every parsed csv file. The api reads the parquet copy when
+it exists (and pyarrow is installed) and falls back to the csv otherwise.
+
+Tables are sorted by the columns the api filters on so that row group statistics let
+a scan skip most of the file, and large tables are split in hive style partitions. The
+gene and drug ids of the PPI, DTI and GO tables are stored as integer codes, see
+reservoir.identifiers, so the proteins and drugs have to be exported first.
+"""
+
+# layout per parsed folder, or per file when it needs its own
+LAYOUTS = {
+    "ppi": {
+        "sort_by": ["gene_1_hgnc_id", "gene_2_hgnc_id", "covid_protein"],
+        "encode_ids": True,
+    },
+    "dti": {"sort_by": ["recover_id", "gene_hgnc_id"], "encode_ids": True},
+    "drugs": {"sort_by": ["recover_id"]},
+    "proteins": {"sort_by": ["gene_hgnc_id"]},
+    "proteins/gene_ontology.csv": {
+        "partition_cols": ["aspect"],
+        "sort_by": ["gene_hgnc_id", "distance_from_root", "go_id"],
+        "encode_ids": True,
+    },
+    "proteins/gene_ontology_leaf.csv": {
+        "sort_by": ["gene_hgnc_id", "go_id"],
+        "encode_ids": True,
+    },
+    "drug_combos": {"sort_by": ["block_id"]},
+    "drug_combos/summary_data.csv": {
+        "partition_cols": ["study_name"],
+        "sort_by": ["cell_line_name", "block_id"],
+    },
+    "cell_lines": {"sort_by": ["cell_line_id"]},
+}
+
+# the tables the id dictionaries are read from
+DICTIONARY_FILES = ["proteins/human_proteins.csv", "drugs/recover_drugs.csv"]
+
+# read options for files that need them
+CSV_OPTIONS = {
+    "drug_combos/summary_data.csv": {"low_memory": False},
+    "drugs/recover_to_pubchem.csv": {"dtype": {"pubchem_cid": "str"}},
+}
+
+
+def export_parquet(relative_path):
+    """ Writes the parquet copy of a file in the parsed folder
+    """
+
+    csv_path = f"{rsv.RESERVOIR_DATA_FOLDER}/parsed/{relative_path}"
+    folder = relative_path.split("/")[0]
+    layout = LAYOUTS.get(relative_path, LAYOUTS.get(folder, {}))
+
+    table = pd.read_csv(csv_path, **CSV_OPTIONS.get(relative_path, {}))
+    return storage.write_table(table, csv_path, **layout)
+
+
+if __name__ == "__main__":
+    parsed_folder = f"{rsv.RESERVOIR_DATA_FOLDER}/parsed"
+    relative_paths = [
+        os.path.relpath(os.path.join(root, file), parsed_folder)
+        for root, _, files in os.walk(parsed_folder)
+        for file in sorted(files)
+        if file.endswith(".csv")
+    ]
+
+    # the id dictionaries are read from the proteins and drugs, they go first
+    relative_paths = sorted(relative_paths, key=lambda path: path not in DICTIONARY_FILES)
+    for relative_path in relative_paths:
+        print("Exporting", relative_path)
+        export_parquet(relative_path)
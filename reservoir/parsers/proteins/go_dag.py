@@ -0,0 +1,344 @@
+import os
+import numpy as np
+import pandas as pd
+import reservoir as rsv
+from reservoir import storage
+from reservoir.cache import dataset_cache
+from reservoir.array_tools import csr_positions, csr_from_lists
+
+GO_OBO_FILE = "/raw/gene_ontology/go.obo"
+GO_DAG_FILE = "/parsed/proteins/go_dag.pickle"
+
+# edges used to propagate annotations and their roots
+RELATIONSHIPS = ["is_a", "part_of"]
+ROOTS = {
+    "biological_process": "GO:0008150",
+    "molecular_function": "GO:0003674",
+    "cellular_component": "GO:0005575",
+}
+
+
+class GeneOntologyDAG:
+    """ The gene ontology compiled into integer arrays
+
+    Terms are numbered in topological order, so every term comes after its parents.
+    Direct parents and the full ancestor closure (without the term itself) are
+    stored as CSR arrays. Each term also has its aspect and its distance from the
+    root of its aspect, -1 when it is not connected to it.
+    """
+
+    cache_shared = True
+
+    def __init__(
+        self,
+        terms,
+        namespaces,
+        parent_indptr,
+        parent_indices,
+        ancestor_indptr,
+        ancestor_indices,
+        distance_from_root,
+        aspects,
+    ):
+        self.terms = terms
+        self.term_index = pd.Index(terms)
+        self.namespaces = namespaces
+        self.parent_indptr = parent_indptr
+        self.parent_indices = parent_indices
+        self.ancestor_indptr = ancestor_indptr
+        self.ancestor_indices = ancestor_indices
+        self.distance_from_root = distance_from_root
+        self.aspects = aspects
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["term_index"]
+        return state
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __sizeof__(self):
+        return sum(
+            array.nbytes for array in self.__getstate__().values()
+        ) + self.term_index.memory_usage(deep=True)
+
+    @property
+    def number_of_terms(self):
+        return len(self.terms)
+
+    def term_ids(self, go_ids):
+        """ Integer ids of some GO terms, -1 for terms that are not in the ontology
+        """
+
+        return self.term_index.get_indexer(go_ids)
+
+    def ancestors(self, go_id):
+        """ Returns the GO ids of all of the ancestors of a term
+        """
+
+        term_id = self.term_index.get_loc(go_id)
+        start, end = self.ancestor_indptr[term_id], self.ancestor_indptr[term_id + 1]
+        return list(self.terms[self.ancestor_indices[start:end]])
+
+    def expand(self, term_ids):
+        """ Ancestors of many terms at once
+
+        Returns:
+            for each ancestor found the position of the term it comes from in
+            term_ids, and the ancestor term id
+        """
+
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        counts = self.ancestor_indptr[term_ids + 1] - self.ancestor_indptr[term_ids]
+        sources = np.repeat(np.arange(len(term_ids)), counts)
+        ancestors = self.ancestor_indices[csr_positions(self.ancestor_indptr, term_ids)]
+
+        return sources, ancestors
+
+    def distance_frame(self):
+        """ Distance from the root and aspect of every connected term
+        """
+
+        connected = self.distance_from_root >= 0
+        return pd.DataFrame(
+            {
+                "go_id": self.terms[connected],
+                "distance_from_root": self.distance_from_root[connected],
+                "aspect": self.aspects[connected],
+            }
+        )
+
+
+def children_csr(children, parents, number_of_terms):
+    """ CSR arrays going from each term to its children
+    """
+
+    order = np.argsort(parents, kind="stable")
+    indptr = np.concatenate(
+        [[0], np.cumsum(np.bincount(parents, minlength=number_of_terms))]
+    )
+
+    return indptr, children[order]
+
+
+def read_go_graph(obo_path):
+    """ Reads the ontology keeping only is_a and part_of edges
+    """
+
+    import obonet
+
+    go_graph = obonet.read_obo(obo_path)
+
+    for (a, b, t) in list(go_graph.edges):
+        if t not in RELATIONSHIPS:
+            go_graph.remove_edge(a, b, t)
+
+    return go_graph
+
+
+def compile_go_dag(go_graph):
+    """ Compiles the ontology graph (edges going from child to parent) into a GeneOntologyDAG
+    """
+
+    nodes = list(go_graph.nodes)
+    node_index = pd.Index(nodes)
+
+    # unique child -> parent pairs
+    edges = pd.DataFrame(
+        [(child, parent) for (child, parent, _) in go_graph.edges], columns=["child", "parent"]
+    ).drop_duplicates()
+    children = node_index.get_indexer(edges["child"])
+    parents = node_index.get_indexer(edges["parent"])
+
+    # topological order, parents before their children
+    number_of_parents = np.bincount(children, minlength=len(nodes))
+    child_indptr, child_indices = children_csr(children, parents, len(nodes))
+
+    order = []
+    frontier = np.flatnonzero(number_of_parents == 0)
+    remaining_parents = number_of_parents.copy()
+    while len(frontier) > 0:
+        order.append(frontier)
+        reached = child_indices[csr_positions(child_indptr, frontier)]
+        np.subtract.at(remaining_parents, reached, 1)
+        frontier = np.unique(reached[remaining_parents[reached] == 0])
+    order = np.concatenate(order) if len(order) > 0 else np.array([], dtype=np.int64)
+
+    if len(order) != len(nodes):
+        raise Exception("The gene ontology has cycles on is_a/part_of edges")
+
+    # renumber terms in topological order
+    new_ids = np.empty(len(nodes), dtype=np.int64)
+    new_ids[order] = np.arange(len(nodes))
+    terms = np.array(nodes, dtype=object)[order]
+    namespaces = np.array(
+        [go_graph.nodes[term].get("namespace") for term in terms], dtype=object
+    )
+    children = new_ids[children]
+    parents = new_ids[parents]
+
+    parent_lists = [[] for _ in range(len(terms))]
+    for child, parent in zip(children, parents):
+        parent_lists[child].append(parent)
+    parent_indptr, parent_indices = csr_from_lists(parent_lists)
+
+    # ancestor closure, parents are always complete before their children
+    ancestor_sets = []
+    for term_parents in parent_lists:
+        ancestors = set(term_parents)
+        for parent in term_parents:
+            ancestors |= ancestor_sets[parent]
+        ancestor_sets.append(ancestors)
+    ancestor_indptr, ancestor_indices = csr_from_lists(
+        [sorted(ancestors) for ancestors in ancestor_sets]
+    )
+
+    # shortest distance to the root of the aspect, going down from each root
+    child_indptr, child_indices = children_csr(children, parents, len(terms))
+
+    distance_from_root = np.full(len(terms), -1, dtype=np.int32)
+    aspects = np.full(len(terms), None, dtype=object)
+    term_index = pd.Index(terms)
+    for aspect, root in ROOTS.items():
+        if root not in term_index:
+            continue
+        distances = np.full(len(terms), -1, dtype=np.int32)
+        frontier = np.array([term_index.get_loc(root)])
+        distance = 0
+        while len(frontier) > 0:
+            distances[frontier] = distance
+            reached = np.unique(child_indices[csr_positions(child_indptr, frontier)])
+            frontier = reached[distances[reached] < 0]
+            distance += 1
+
+        in_aspect = (distances >= 0) & (namespaces == aspect)
+        distance_from_root[in_aspect] = distances[in_aspect]
+        aspects[in_aspect] = aspect
+
+    return GeneOntologyDAG(
+        terms=terms,
+        namespaces=namespaces,
+        parent_indptr=parent_indptr,
+        parent_indices=parent_indices,
+        ancestor_indptr=ancestor_indptr,
+        ancestor_indices=ancestor_indices,
+        distance_from_root=distance_from_root,
+        aspects=aspects,
+    )
+
+
+def load_go_dag():
+    """ Returns the compiled gene ontology
+
+    It is compiled from go.obo the first time and stored in the parsed folder, so that
+    later runs don't need to read the obo file again. Without the raw obo file the
+    stored version is used as is.
+    """
+
+    obo_path = rsv.RESERVOIR_DATA_FOLDER + GO_OBO_FILE
+    dag_path = rsv.RESERVOIR_DATA_FOLDER + GO_DAG_FILE
+
+    if not os.path.exists(obo_path) and os.path.exists(dag_path):
+        return dataset_cache.load(
+            dag_path, "go_dag", lambda: storage.load_artifact(dag_path)
+        )
+
+    return dataset_cache.load(
+        obo_path,
+        "go_dag",
+        lambda: storage.load_or_build(
+            dag_path, [obo_path], lambda: compile_go_dag(read_go_graph(obo_path))
+        ),
+    )
+
+
+def propagate_annotations(go_annotations, dag):
+    """ Adds the annotations implied by the ontology, plus distances and aspects
+
+    Each leaf annotation is copied to all of the ancestors of its term. Annotations
+    for terms that are not in the ontology are kept but not propagated.
+
+    Args:
+        go_annotations: dataframe with gene_hgnc_id, go_id, evidence and evidence_category
+        dag: the compiled ontology
+    """
+
+    term_ids = dag.term_ids(go_annotations["go_id"])
+    in_ontology = term_ids >= 0
+    leaf_annotations = go_annotations.loc[in_ontology]
+
+    # one row per (leaf annotation, ancestor)
+    sources, ancestors = dag.expand(term_ids[in_ontology])
+    descendant_annotations = leaf_annotations.iloc[sources].reset_index(drop=True)
+    descendant_annotations["go_id"] = dag.terms[ancestors]
+
+    # combine with leaf annotations
+    full_annotations = pd.concat(
+        [go_annotations, descendant_annotations], ignore_index=True
+    ).drop_duplicates()
+
+    # add distances and aspects
+    term_ids = dag.term_ids(full_annotations["go_id"])
+    connected = term_ids >= 0
+    full_annotations["distance_from_root"] = np.where(
+        connected, dag.distance_from_root[np.maximum(term_ids, 0)], -1
+    ).astype("int32")
+    full_annotations["aspect"] = np.where(
+        connected, dag.aspects[np.maximum(term_ids, 0)], None
+    )
+
+    return full_annotations
+
+
+def expand_annotations(
+    leaf_annotations, dag, go_ids=None, aspect=None, max_distance_from_root=None
+):
+    """ Propagates some leaf annotations only to the terms a query asks for
+
+    Gives the same rows as propagate_annotations followed by the filters of
+    get_gene_ontology, without building the full propagated table.
+
+    Args:
+        leaf_annotations: dataframe with gene_hgnc_id, go_id, evidence and evidence_category
+        dag: the compiled ontology
+        go_ids: keep only these terms
+        aspect: keep only terms of this aspect
+        max_distance_from_root: keep only terms at most this far from the root
+    """
+
+    # terms the query can return, roots and disconnected terms are never returned
+    allowed = dag.distance_from_root > 0
+    if aspect is not None:
+        allowed &= dag.aspects == aspect
+    if max_distance_from_root is not None:
+        allowed &= dag.distance_from_root <= max_distance_from_root
+    if go_ids is not None and len(go_ids) > 0:
+        in_query = np.zeros(dag.number_of_terms, dtype=bool)
+        term_ids = dag.term_ids(list(go_ids))
+        in_query[term_ids[term_ids >= 0]] = True
+        allowed &= in_query
+
+    leaf_annotations = leaf_annotations.reset_index(drop=True)
+    term_ids = dag.term_ids(leaf_annotations["go_id"])
+    in_ontology = np.flatnonzero(term_ids >= 0)
+
+    # leaf annotations and their ancestors, filtered before building any rows
+    sources, ancestors = dag.expand(term_ids[in_ontology])
+    keep = allowed[ancestors]
+    rows = np.concatenate([in_ontology, in_ontology[sources[keep]]])
+    annotation_terms = np.concatenate([term_ids[in_ontology], ancestors[keep]])
+    keep = allowed[annotation_terms]
+    rows, annotation_terms = rows[keep], annotation_terms[keep]
+
+    annotations = leaf_annotations.iloc[rows].reset_index(drop=True)
+    annotations["go_id"] = dag.terms[annotation_terms]
+    annotations = annotations.drop_duplicates()
+
+    annotation_terms = dag.term_ids(annotations["go_id"])
+    annotations["distance_from_root"] = dag.distance_from_root[annotation_terms].astype(
+        "int64"
+    )
+    annotations["aspect"] = dag.aspects[annotation_terms]
+
+    return annotations.reset_index(drop=True)
@@ -22,22 +22,22 @@ biogrid_mv = biogrid_mv.loc[
 ]
 
 # normalize protein ids and keep only valid ones
-biogrid["gene_1_hgnc_id"] = biogrid["SWISS-PROT Accessions Interactor A"].apply(
-    protein_mapper.uniprot_to_hgnc
-)
-biogrid["gene_2_hgnc_id"] = biogrid["SWISS-PROT Accessions Interactor B"].apply(
-    protein_mapper.uniprot_to_hgnc
-)
+biogrid["gene_1_hgnc_id"] = protein_mapper.resolve_gene_ids(
+    biogrid["SWISS-PROT Accessions Interactor A"], "uniprot"
+)["gene_hgnc_id"]
+biogrid["gene_2_hgnc_id"] = protein_mapper.resolve_gene_ids(
+    biogrid["SWISS-PROT Accessions Interactor B"], "uniprot"
+)["gene_hgnc_id"]
 biogrid = biogrid.loc[
     ~pd.isnull(biogrid["gene_1_hgnc_id"]) & ~pd.isnull(biogrid["gene_2_hgnc_id"])
 ]
 
-biogrid_mv["gene_1_hgnc_id"] = biogrid["SWISS-PROT Accessions Interactor A"].apply(
-    protein_mapper.uniprot_to_hgnc
-)
-biogrid_mv["gene_2_hgnc_id"] = biogrid["SWISS-PROT Accessions Interactor B"].apply(
-    protein_mapper.uniprot_to_hgnc
-)
+biogrid_mv["gene_1_hgnc_id"] = protein_mapper.resolve_gene_ids(
+    biogrid_mv["SWISS-PROT Accessions Interactor A"], "uniprot"
+)["gene_hgnc_id"]
+biogrid_mv["gene_2_hgnc_id"] = protein_mapper.resolve_gene_ids(
+    biogrid_mv["SWISS-PROT Accessions Interactor B"], "uniprot"
+)["gene_hgnc_id"]
 biogrid_mv = biogrid_mv.loc[
     ~pd.isnull(biogrid_mv["gene_1_hgnc_id"]) & ~pd.isnull(biogrid_mv["gene_2_hgnc_id"])
 ]
@@ -1,5 +1,6 @@
 import reservoir as rsv
 import pandas as pd
+from reservoir.parsers.proteins import protein_mapper
 
 """
 Gordon Krogan
@@ -9,7 +10,9 @@ krogan_data = pd.read_csv(
 )
 
 # normalize protein ids
-krogan_data["human_gene_hgnc_id"] = krogan_data["PreyGene"].apply(rsv.hgnc_normalize)
+krogan_data["human_gene_hgnc_id"] = protein_mapper.resolve_gene_ids(
+    krogan_data["PreyGene"], "symbol"
+)["gene_hgnc_id"]
 krogan_data = krogan_data[["Bait", "human_gene_hgnc_id"]].rename(
     columns={"Bait": "covid_protein"}
 )
@@ -37,7 +40,9 @@ Li Liang
 liang_data = pd.read_csv(rsv.RESERVOIR_DATA_FOLDER + "/raw/ppi/covid_li_liang_ppi.csv")
 
 # normalize human names
-liang_data["human_gene_hgnc_id"] = liang_data["Gene name"].apply(rsv.hgnc_normalize)
+liang_data["human_gene_hgnc_id"] = protein_mapper.resolve_gene_ids(
+    liang_data["Gene name"], "symbol"
+)["gene_hgnc_id"]
 liang_data = liang_data.loc[~liang_data["human_gene_hgnc_id"].isna()]
 
 # fix covid proteins
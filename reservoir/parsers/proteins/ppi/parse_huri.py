@@ -1,6 +1,6 @@
 import pandas as pd
-import reservoir_data_lake as rsv
-from reservoir_data_lake.parsers.proteins import protein_mapper
+import reservoir as rsv
+from reservoir.parsers.proteins import protein_mapper
 import ppi_helper
 
 # read in data and map protein id
@@ -11,12 +11,12 @@ huri_original = pd.read_csv(
 )
 
 # normalize gene ids and keep only valid ones
-huri_original["gene_1_hgnc_id"] = huri_original["protein_1_ensembl"].apply(
-    protein_mapper.ensembl_to_hgnc
-)
-huri_original["gene_2_hgnc_id"] = huri_original["protein_2_ensembl"].apply(
-    protein_mapper.ensembl_to_hgnc
-)
+huri_original["gene_1_hgnc_id"] = protein_mapper.resolve_gene_ids(
+    huri_original["protein_1_ensembl"], "ensembl_gene"
+)["gene_hgnc_id"]
+huri_original["gene_2_hgnc_id"] = protein_mapper.resolve_gene_ids(
+    huri_original["protein_2_ensembl"], "ensembl_gene"
+)["gene_hgnc_id"]
 huri_original = huri_original.loc[
     ~pd.isnull(huri_original.gene_1_hgnc_id) & ~pd.isnull(huri_original.gene_2_hgnc_id)
 ]
@@ -7,16 +7,12 @@ import ppi_helper
 snap = pd.read_csv(rsv.RESERVOIR + "/raw/ppi/snap-msi.tsv", sep="\t")
 
 # Node names are hgnc symbols. Update to latest version
-snap["gene_1_hgnc_id"] = snap["node_1_name"].apply(protein_mapper.hgnc_normalize)
-snap["gene_2_hgnc_id"] = snap["node_2_name"].apply(protein_mapper.hgnc_normalize)
-
-# some nodes are missing a name but have the ensembl id
-snap.loc[pd.isnull(snap["gene_1_hgnc_id"]), "gene_1_hgnc_id"] = snap.loc[
-    pd.isnull(snap["gene_1_hgnc_id"]), "node_1"
-].apply(lambda eid: protein_mapper.ensembl_to_hgnc(f"ENSG{eid:011}"))
-snap.loc[pd.isnull(snap["gene_2_hgnc_id"]), "gene_2_hgnc_id"] = snap.loc[
-    pd.isnull(snap["gene_2_hgnc_id"]), "node_2"
-].apply(lambda eid: protein_mapper.ensembl_to_hgnc(f"ENSG{eid:011}"))
+# some nodes are missing a name but have the ensembl id, its numeric part
+for node in ["1", "2"]:
+    snap[f"gene_{node}_hgnc_id"] = (
+        protein_mapper.resolve_gene_ids(snap[f"node_{node}_name"], "symbol")["gene_hgnc_id"]
+        .fillna(protein_mapper.resolve_gene_ids(snap[f"node_{node}"], "ensembl_gene")["gene_hgnc_id"])
+    )
 
 # remove duplicates
 snap = ppi_helper.remove_duplicate_edges(snap[["gene_1_hgnc_id", "gene_2_hgnc_id"]])
@@ -7,16 +7,10 @@ import ppi_helper
 string_protein_ids = pd.read_csv(
     rsv.RESERVOIR_DATA_FOLDER + "/raw/ppi/string_human_v11_protein_ids.txt", sep="\t"
 )
-string_protein_ids["gene_hgnc_id"] = string_protein_ids["preferred_name"].apply(
-    protein_mapper.hgnc_normalize
-)
-string_protein_ids.loc[
-    pd.isnull(string_protein_ids["gene_hgnc_id"]), "gene_hgnc_id"
-] = string_protein_ids.loc[
-    pd.isnull(string_protein_ids["gene_hgnc_id"]), "preferred_name"
-].apply(
-    protein_mapper.ensembl_to_hgnc
-)
+# the preferred name is a symbol, or an ensembl gene id when there is none
+string_protein_ids["gene_hgnc_id"] = protein_mapper.resolve_gene_ids(
+    string_protein_ids["preferred_name"], ["symbol", "ensembl_gene"]
+)["gene_hgnc_id"]
 string_protein_ids = string_protein_ids.loc[
     ~pd.isnull(string_protein_ids["gene_hgnc_id"])
 ]
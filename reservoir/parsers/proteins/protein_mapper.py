@@ -1,26 +1,59 @@
+import functools
+import numpy as np
 import pandas as pd
 import pickle
 import reservoir as rsv
 
-# load human proteins and alias mapper
-human_proteins = pd.read_csv(
-    rsv.RESERVOIR_DATA_FOLDER + "/parsed/proteins/human_proteins.csv"
-)
-approved_human_proteins = set(human_proteins["gene_hgnc_id"])
-with open(
-    rsv.RESERVOIR_DATA_FOLDER + "/parsed/proteins/gene_alias_dictionary.pickle", "rb"
-) as f:
-    gene_alias_dictionary = pickle.load(f)
-
-# create mappings from different type of IDs to HGNC
-uniprot_to_hgnc_map = human_proteins.set_index("uniprot_id").to_dict()["gene_hgnc_id"]
-ensembl_to_hgnc_map = human_proteins.set_index("gene_ensembl_id").to_dict()[
-    "gene_hgnc_id"
-]
-with open(
-    rsv.RESERVOIR_DATA_FOLDER + "/parsed/proteins/covid_protein_mapper.pickle", "rb"
-) as f:
-    covid_protein_mapper = pickle.load(f)
+
+@functools.lru_cache(maxsize=None)
+def load_references():
+    """ Reads the human proteins and the alias and covid protein mappers, the first time
+    they are needed
+    """
+
+    # load human proteins and alias mapper
+    human_proteins = pd.read_csv(
+        rsv.RESERVOIR_DATA_FOLDER + "/parsed/proteins/human_proteins.csv"
+    )
+    approved_human_proteins = set(human_proteins["gene_hgnc_id"])
+    with open(
+        rsv.RESERVOIR_DATA_FOLDER + "/parsed/proteins/gene_alias_dictionary.pickle", "rb"
+    ) as f:
+        gene_alias_dictionary = pickle.load(f)
+
+    # create mappings from different type of IDs to HGNC
+    uniprot_to_hgnc_map = human_proteins.set_index("uniprot_id").to_dict()["gene_hgnc_id"]
+    ensembl_to_hgnc_map = human_proteins.set_index("gene_ensembl_id").to_dict()[
+        "gene_hgnc_id"
+    ]
+
+    return {
+        "human_proteins": human_proteins,
+        "approved_human_proteins": approved_human_proteins,
+        "gene_alias_dictionary": gene_alias_dictionary,
+        "uniprot_to_hgnc_map": uniprot_to_hgnc_map,
+        "ensembl_to_hgnc_map": ensembl_to_hgnc_map,
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def load_covid_protein_mapper():
+    with open(
+        rsv.RESERVOIR_DATA_FOLDER + "/parsed/proteins/covid_protein_mapper.pickle", "rb"
+    ) as f:
+        return pickle.load(f)
+
+
+def __getattr__(name):
+    # the reference tables used to be module attributes
+    if name == "covid_protein_mapper":
+        return load_covid_protein_mapper()
+
+    if name in ("human_proteins", "approved_human_proteins", "gene_alias_dictionary",
+                "uniprot_to_hgnc_map", "ensembl_to_hgnc_map"):
+        return load_references()[name]
+
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
 
 
 def map_covid_protein(protein_id):
@@ -28,6 +61,7 @@ def map_covid_protein(protein_id):
     """
 
     protein_id = protein_id.lower()
+    covid_protein_mapper = load_covid_protein_mapper()
 
     if protein_id in covid_protein_mapper:
         return covid_protein_mapper[protein_id]
@@ -43,11 +77,12 @@ def hgnc_normalize(hgnc_symbol):
         hgnc_symbol
     """
     hgnc_symbol = str(hgnc_symbol).upper()
+    references = load_references()
 
-    if hgnc_symbol in gene_alias_dictionary:
-        hgnc_symbol = gene_alias_dictionary[hgnc_symbol]
+    if hgnc_symbol in references["gene_alias_dictionary"]:
+        hgnc_symbol = references["gene_alias_dictionary"][hgnc_symbol]
 
-    if hgnc_symbol in approved_human_proteins:
+    if hgnc_symbol in references["approved_human_proteins"]:
         return hgnc_symbol
     else:
         return None
@@ -57,6 +92,7 @@ def uniprot_to_hgnc(uniprot_id):
     """ Maps a uniprot id to the HGCN gene symbol
     """
 
+    uniprot_to_hgnc_map = load_references()["uniprot_to_hgnc_map"]
     if uniprot_id in uniprot_to_hgnc_map:
         return uniprot_to_hgnc_map[uniprot_id]
     else:
@@ -67,7 +103,198 @@ def ensembl_to_hgnc(ensembl_id):
     """ Maps an ensembl gene id to the HGCN gene symbol
     """
 
+    ensembl_to_hgnc_map = load_references()["ensembl_to_hgnc_map"]
     if ensembl_id in ensembl_to_hgnc_map:
         return ensembl_to_hgnc_map[ensembl_id]
     else:
         return None
+
+
+ID_TYPES = ["symbol", "uniprot", "ensembl_gene", "ensembl_protein"]
+
+# how an id was resolved, "alias" covers the alias and previous symbols
+RESOLUTION_SOURCES = ["symbol", "alias", "uniprot", "ensembl_gene", "ensembl_protein"]
+
+# shapes of the ids, used to detect their type
+ID_PATTERNS = {
+    "ensembl_gene": r"^ENSG\d{11}(\.\d+)?$",
+    "ensembl_protein": r"^(\d+\.)?ENSP\d{11}(\.\d+)?$",
+    "uniprot": r"^([OPQ][0-9][A-Z0-9]{3}[0-9]|[A-NR-Z][0-9]([A-Z][A-Z0-9]{2}[0-9]){1,2})$",
+}
+
+
+@functools.lru_cache(maxsize=None)
+def load_gene_indexes():
+    """ Hash indexes of the identifiers of the human proteins, for resolve_gene_ids
+    """
+
+    references = load_references()
+    human_proteins = references["human_proteins"]
+    aliases = pd.Series(references["gene_alias_dictionary"], dtype=object)
+
+    # the last protein wins for duplicated ids, as in uniprot_to_hgnc and ensembl_to_hgnc
+    uniprot = human_proteins.drop_duplicates("uniprot_id", keep="last")
+    ensembl = human_proteins.drop_duplicates("gene_ensembl_id", keep="last")
+
+    return {
+        "approved": pd.Index(human_proteins["gene_hgnc_id"].drop_duplicates()),
+        "alias": pd.Index(aliases.index),
+        "alias_targets": aliases.to_numpy(),
+        "uniprot": pd.Index(uniprot["uniprot_id"]),
+        "uniprot_targets": uniprot["gene_hgnc_id"].to_numpy(dtype=object),
+        "ensembl_gene": pd.Index(ensembl["gene_ensembl_id"]),
+        "ensembl_gene_targets": ensembl["gene_hgnc_id"].to_numpy(dtype=object),
+    }
+
+
+def _lookup(index, targets, values):
+    """ Targets of the values found in index, None for the others
+    """
+
+    positions = index.get_indexer(values)
+    found = positions >= 0
+    resolved = np.full(len(values), None, dtype=object)
+    resolved[found] = targets[positions[found]]
+
+    return resolved, found
+
+
+def _resolve_symbols(values):
+    # same rules as hgnc_normalize: upper case, alias or previous symbol, then approved
+    indexes = load_gene_indexes()
+    symbols = pd.Series(values, dtype=object).astype(str).str.upper().to_numpy(dtype=object)
+    renamed, is_alias = _lookup(indexes["alias"], indexes["alias_targets"], symbols)
+    symbols = np.where(is_alias, renamed, symbols)
+    approved = indexes["approved"].get_indexer(symbols) >= 0
+
+    resolved = np.where(approved, symbols, None)
+    sources = np.where(approved, np.where(is_alias, "alias", "symbol"), None)
+    return resolved, sources
+
+
+def _resolve_uniprot(values):
+    indexes = load_gene_indexes()
+    resolved, found = _lookup(indexes["uniprot"], indexes["uniprot_targets"], values)
+    return resolved, np.where(found, "uniprot", None)
+
+
+def _resolve_ensembl_gene(values):
+    # integers are the numeric part of the ids, versions are dropped
+    indexes = load_gene_indexes()
+    ids = pd.Series(values, dtype=object)
+    numeric = ids.map(
+        lambda value: isinstance(value, (int, np.integer))
+        or (isinstance(value, (float, np.floating)) and float(value).is_integer())
+    ).astype(bool)
+    ids[numeric] = "ENSG" + ids[numeric].astype(np.int64).astype(str).str.zfill(11)
+    ids = ids.astype(str).str.replace(r"\.\d+$", "", regex=True).to_numpy(dtype=object)
+
+    resolved, found = _lookup(indexes["ensembl_gene"], indexes["ensembl_gene_targets"], ids)
+    return resolved, np.where(found, "ensembl_gene", None)
+
+
+def _resolver_of_ensembl_proteins(ensembl_protein_map):
+    """ Resolves ensembl protein ids with a mapping to gene ids of any other type
+    """
+
+    mapping = pd.Series(ensembl_protein_map, dtype=object)
+    mapping.index = mapping.index.astype(str).str.replace(r"^\d+\.", "", regex=True)
+    mapping = mapping[~mapping.index.duplicated(keep="last")]
+
+    def resolve(values):
+        ids = pd.Series(values, dtype=object).astype(str).str.replace(r"^\d+\.", "", regex=True)
+        genes, found = _lookup(mapping.index, mapping.to_numpy(dtype=object), ids.to_numpy())
+        resolved = np.full(len(values), None, dtype=object)
+        if found.any():
+            resolved[found] = resolve_gene_ids(genes[found])["gene_hgnc_id"].to_numpy(dtype=object)
+        return resolved, np.where(pd.notnull(resolved), "ensembl_protein", None)
+
+    return resolve
+
+
+def detect_id_types(ids):
+    """ Type of each id from its shape, "symbol" for the ones that don't look like any other type
+    """
+
+    ids = pd.Series(ids, dtype=object).astype(str)
+    types = np.full(len(ids), "symbol", dtype=object)
+    for id_type, pattern in ID_PATTERNS.items():
+        types[ids.str.match(pattern).to_numpy(dtype=bool) & (types == "symbol")] = id_type
+
+    return types
+
+
+def resolve_gene_ids(ids, id_types=None, ensembl_protein_map=None):
+    """ Maps many gene or protein identifiers to HGNC symbols at once
+
+    Every distinct id is resolved once, with hash lookups in the human protein tables. The
+    symbols follow the rules of hgnc_normalize, and the uniprot and ensembl gene ids the ones
+    of uniprot_to_hgnc and ensembl_to_hgnc. Ensembl gene ids can also be integers (the numeric
+    part of the id) or have a version.
+
+    Args:
+        ids: series or list of ids
+        id_types: type or list of types among ID_TYPES. The ids are tried with each type in
+            order, the ones that aren't resolved by a type fall back to the next one. If None,
+            the type of every id is detected from its shape (detect_id_types), and the ids
+            that aren't resolved that way are tried as symbols
+        ensembl_protein_map: dictionary or series from ensembl protein ids (with or without
+            the taxon prefix, e.g. 9606.ENSP...) to gene ids of another type. Needed for the
+            ensembl_protein type, the human protein tables don't have them
+
+    Returns:
+        dataframe with the index of ids, gene_hgnc_id (None if unresolved) and
+        resolution_source, the type of id that resolved it
+    """
+
+    index = ids.index if isinstance(ids, pd.Series) else pd.RangeIndex(len(ids))
+    codes, uniques = pd.factorize(pd.Series(ids, dtype=object), use_na_sentinel=True)
+    uniques = np.asarray(uniques, dtype=object)
+
+    resolvers = {
+        "symbol": _resolve_symbols,
+        "uniprot": _resolve_uniprot,
+        "ensembl_gene": _resolve_ensembl_gene,
+    }
+    if ensembl_protein_map is not None:
+        resolvers["ensembl_protein"] = _resolver_of_ensembl_proteins(ensembl_protein_map)
+
+    if isinstance(id_types, str):
+        id_types = [id_types]
+    for id_type in id_types or []:
+        if id_type not in ID_TYPES:
+            raise ValueError(f"Unknown id type {id_type}, the options are {ID_TYPES}")
+        if id_type not in resolvers:
+            raise Exception("Resolving ensembl protein ids needs an ensembl_protein_map")
+
+    resolved = np.full(len(uniques), None, dtype=object)
+    sources = np.full(len(uniques), None, dtype=object)
+
+    def resolve(id_type, positions):
+        if len(positions) == 0 or id_type not in resolvers:
+            return
+        genes, found_by = resolvers[id_type](uniques[positions])
+        found = pd.notnull(genes)
+        resolved[positions[found]] = genes[found]
+        sources[positions[found]] = found_by[found]
+
+    if id_types is None:
+        detected = detect_id_types(uniques)
+        for id_type in ID_TYPES:
+            resolve(id_type, np.flatnonzero(detected == id_type))
+        resolve("symbol", np.flatnonzero(pd.isnull(resolved) & (detected != "symbol")))
+    else:
+        for id_type in id_types:
+            resolve(id_type, np.flatnonzero(pd.isnull(resolved)))
+
+    # missing ids have the code -1
+    resolved = np.append(resolved, None)[codes]
+    sources = np.append(sources, None)[codes]
+
+    return pd.DataFrame(
+        {
+            "gene_hgnc_id": resolved,
+            "resolution_source": pd.Categorical(sources, categories=RESOLUTION_SOURCES),
+        },
+        index=index,
+    )
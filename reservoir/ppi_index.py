@@ -0,0 +1,229 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import reservoir as rsv
+from reservoir import storage
+from reservoir.cache import dataset_cache, file_signature
+from reservoir.array_tools import csr_positions
+
+GENE_COLUMNS = ["gene_1_hgnc_id", "gene_2_hgnc_id"]
+
+
+class PPIIndex:
+    """ CSR adjacency of a PPI file for fast neighbourhood queries
+
+    Node ids follow the order of get_proteins(), genes that are not in the human
+    proteins are appended at the end. Every edge is stored in both directions and
+    points back to its row in the PPI file, whose columns are kept as arrays so that
+    queries return the same dataframe get_ppis does.
+    """
+
+    cache_shared = True
+
+    def __init__(self, nodes, sources, targets, edge_columns, edge_attributes):
+        self.nodes = nodes
+        self.node_index = pd.Index(nodes)
+        self.sources = sources
+        self.targets = targets
+        self.edge_columns = edge_columns
+        self.edge_attributes = edge_attributes
+
+        # undirected graph, each edge goes in both directions
+        rows = np.concatenate([sources, targets])
+        columns = np.concatenate([targets, sources])
+        edge_ids = np.concatenate([np.arange(len(sources))] * 2)
+
+        order = np.argsort(rows, kind="stable")
+        self.indptr = np.concatenate(
+            [[0], np.cumsum(np.bincount(rows, minlength=len(nodes)))]
+        ).astype(np.int64)
+        self.indices = columns[order]
+        self.edge_ids = edge_ids[order]
+
+        for array in [self.nodes, self.sources, self.targets, self.indptr, self.indices, self.edge_ids]:
+            array.flags.writeable = False
+
+    @classmethod
+    def from_edges(cls, edges, proteins):
+        """ Compiles an index from a PPI dataframe and the list of human proteins
+        """
+
+        if not set(GENE_COLUMNS).issubset(edges.columns):
+            raise Exception(f"PPI index needs the {GENE_COLUMNS} columns")
+
+        # align node ids with the proteins, append unknown genes
+        known_genes = pd.Index(proteins)
+        extra_genes = pd.Index(
+            pd.unique(edges[GENE_COLUMNS].to_numpy().ravel())
+        ).difference(known_genes)
+        nodes = np.array(list(known_genes) + list(extra_genes.sort_values()), dtype=object)
+        node_index = pd.Index(nodes)
+
+        sources = node_index.get_indexer(edges["gene_1_hgnc_id"]).astype(np.int64)
+        targets = node_index.get_indexer(edges["gene_2_hgnc_id"]).astype(np.int64)
+
+        edge_attributes = {
+            column: edges[column].to_numpy()
+            for column in edges.columns
+            if column not in GENE_COLUMNS
+        }
+
+        return cls(nodes, sources, targets, list(edges.columns), edge_attributes)
+
+    def __getstate__(self):
+        return {
+            "nodes": self.nodes,
+            "sources": self.sources,
+            "targets": self.targets,
+            "edge_columns": self.edge_columns,
+            "edge_attributes": self.edge_attributes,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __sizeof__(self):
+        arrays = [self.nodes, self.sources, self.targets, self.indptr, self.indices, self.edge_ids]
+        arrays += list(self.edge_attributes.values())
+        return sys.getsizeof(self.__dict__) + sum(array.nbytes for array in arrays)
+
+    @property
+    def number_of_nodes(self):
+        return len(self.nodes)
+
+    @property
+    def number_of_edges(self):
+        return len(self.sources)
+
+    def node_ids(self, genes):
+        """ Integer ids of some genes, genes not in the graph are ignored
+        """
+
+        ids = self.node_index.get_indexer(list(genes))
+        return np.unique(ids[ids >= 0])
+
+    def degree(self, genes):
+        """ Number of interactions per gene, as a series
+        """
+
+        genes = list(genes)
+        ids = self.node_index.get_indexer(genes)
+        degrees = np.where(
+            ids >= 0, self.indptr[np.maximum(ids, 0) + 1] - self.indptr[np.maximum(ids, 0)], 0
+        )
+        return pd.Series(degrees, index=genes)
+
+    def edges(self, edge_ids, columns=None):
+        """ Returns some rows of the PPI file, with the same columns as get_ppis
+        """
+
+        edge_ids = np.asarray(edge_ids, dtype=np.int64)
+        columns = self.edge_columns if columns is None else list(columns)
+
+        data = {}
+        for column in columns:
+            if column == "gene_1_hgnc_id":
+                data[column] = self.nodes[self.sources[edge_ids]]
+            elif column == "gene_2_hgnc_id":
+                data[column] = self.nodes[self.targets[edge_ids]]
+            else:
+                data[column] = self.edge_attributes[column][edge_ids]
+
+        return pd.DataFrame(data, index=edge_ids, columns=columns)
+
+    def _neighbor_ids(self, node_ids):
+        """ Integer ids of the neighbors of some nodes
+        """
+
+        return np.unique(self.indices[csr_positions(self.indptr, node_ids)])
+
+    def _incident_edge_ids(self, node_ids):
+        """ Ids of the edges touching some nodes, in file order
+        """
+
+        return np.unique(self.edge_ids[csr_positions(self.indptr, node_ids)])
+
+    def _induced_edge_ids(self, node_ids):
+        """ Ids of the edges with both ends in some nodes, in file order
+        """
+
+        in_set = np.zeros(self.number_of_nodes, dtype=bool)
+        in_set[node_ids] = True
+        positions = csr_positions(self.indptr, node_ids)
+        positions = positions[in_set[self.indices[positions]]]
+
+        return np.unique(self.edge_ids[positions])
+
+    def _k_hop_ids(self, node_ids, k):
+        """ Integer ids of the nodes at most k hops away from some nodes
+        """
+
+        visited = np.zeros(self.number_of_nodes, dtype=bool)
+        visited[node_ids] = True
+        frontier = node_ids
+        for _ in range(k):
+            if len(frontier) == 0:
+                break
+            neighbors = self._neighbor_ids(frontier)
+            frontier = neighbors[~visited[neighbors]]
+            visited[frontier] = True
+
+        return np.flatnonzero(visited)
+
+    def neighbors(self, genes):
+        """ Returns the genes interacting with any of the given genes
+        """
+
+        return list(self.nodes[self._neighbor_ids(self.node_ids(genes))])
+
+    def incident_edges(self, genes, columns=None):
+        """ Returns the interactions involving any of the given genes
+        """
+
+        return self.edges(self._incident_edge_ids(self.node_ids(genes)), columns)
+
+    def induced_subgraph(self, genes, columns=None):
+        """ Returns the interactions between the given genes
+        """
+
+        return self.edges(self._induced_edge_ids(self.node_ids(genes)), columns)
+
+    def k_hop_nodes(self, genes, k):
+        """ Returns the genes at most k hops away from the given genes, including them
+        """
+
+        return list(self.nodes[self._k_hop_ids(self.node_ids(genes), k)])
+
+    def k_hop_subgraph(self, genes, k, columns=None):
+        """ Returns the interactions between the genes at most k hops away from the given genes
+        """
+
+        return self.edges(
+            self._induced_edge_ids(self._k_hop_ids(self.node_ids(genes), k)), columns
+        )
+
+
+def get_ppi_index(ppi_file):
+    """ Returns the compiled index of a PPI file
+
+    The index is compiled the first time it is needed and stored next to the PPI file.
+    It is rebuilt when the PPI file or the human proteins change.
+    """
+
+    ppi_path = f"{rsv.RESERVOIR_DATA_FOLDER}/parsed/ppi/{ppi_file}"
+    proteins_path = f"{rsv.RESERVOIR_DATA_FOLDER}/parsed/proteins/human_proteins.csv"
+    source_paths = [storage.table_path(ppi_path), storage.table_path(proteins_path)]
+    index_path = os.path.splitext(ppi_path)[0] + ".index.pickle"
+
+    def build():
+        return PPIIndex.from_edges(
+            storage.read_table(ppi_path),
+            storage.read_table(proteins_path, columns=["gene_hgnc_id"])["gene_hgnc_id"],
+        )
+
+    return dataset_cache.load(
+        source_paths[0],
+        ("ppi_index", file_signature(source_paths[1])),
+        lambda: storage.load_or_build(index_path, source_paths, build),
+    )
@@ -0,0 +1,410 @@
+import os
+import importlib.util
+import json
+import pickle
+import shutil
+from urllib.parse import quote
+import numpy as np
+import pandas as pd
+from reservoir.cache import dataset_cache, file_signature, copy_of
+
+# row groups are kept small so that min/max statistics can prune most of a file
+ROW_GROUP_SIZE = 65536
+HIVE_NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+COLUMN_ORDER_KEY = b"reservoir_columns"
+ENCODED_IDS_KEY = b"reservoir_encoded_ids"
+
+OPERATORS = {
+    "==": lambda column, value: column == value,
+    "=": lambda column, value: column == value,
+    "!=": lambda column, value: column != value,
+    "<": lambda column, value: column < value,
+    "<=": lambda column, value: column <= value,
+    ">": lambda column, value: column > value,
+    ">=": lambda column, value: column >= value,
+    "in": lambda column, value: column.isin(value),
+    "not in": lambda column, value: ~column.isin(value),
+}
+
+
+def parquet_path(csv_path):
+    """ Returns the location of the parquet copy of a parsed csv file
+    """
+
+    return os.path.splitext(csv_path)[0] + ".parquet"
+
+
+def has_parquet_support():
+    """ Parquet is optional, everything falls back to csv without pyarrow
+    """
+
+    # only checks that the modules are there, they are imported where they are used
+    try:
+        return all(
+            importlib.util.find_spec(module) is not None
+            for module in ["pyarrow.dataset", "pyarrow.parquet"]
+        )
+    except ImportError:
+        return False
+
+
+def normalize_filters(filters):
+    """ Puts filters in disjunctive normal form, a list of lists of (column, op, value)
+
+    A flat list of tuples is a single conjunction, as in pyarrow
+    """
+
+    if not filters:
+        return None
+
+    if isinstance(filters[0], tuple):
+        filters = [filters]
+
+    normalized = []
+    for conjunction in filters:
+        normalized_conjunction = []
+        for column, op, value in conjunction:
+            if op not in OPERATORS:
+                raise ValueError(f"Unsupported filter operation {op}")
+            if op in ["in", "not in"]:
+                value = list(value)
+            normalized_conjunction.append((column, op, value))
+        normalized.append(normalized_conjunction)
+
+    return normalized
+
+
+def filter_columns(filters):
+    """ Returns the columns used by some filters
+    """
+
+    if not filters:
+        return []
+
+    columns = []
+    for conjunction in normalize_filters(filters):
+        for column, _, _ in conjunction:
+            if column not in columns:
+                columns.append(column)
+
+    return columns
+
+
+def apply_filters(frame, filters):
+    """ Applies filters in pandas, used when the data can't be filtered while scanning
+    """
+
+    filters = normalize_filters(filters)
+    if not filters:
+        return frame
+
+    mask = np.zeros(len(frame), dtype=bool)
+    for conjunction in filters:
+        conjunction_mask = np.ones(len(frame), dtype=bool)
+        for column, op, value in conjunction:
+            conjunction_mask &= OPERATORS[op](frame[column], value).to_numpy(dtype=bool)
+        mask |= conjunction_mask
+
+    return frame.loc[mask]
+
+
+def read_columns(csv_path):
+    """ Returns the column names of a parsed table without reading the rows
+    """
+
+    pq_path = parquet_path(csv_path)
+    if os.path.exists(pq_path) and has_parquet_support():
+        import pyarrow.dataset as ds
+
+        dataset = ds.dataset(pq_path, format="parquet", partitioning="hive")
+        return _stored_column_order(dataset.schema)
+
+    return list(pd.read_csv(csv_path, nrows=0).columns)
+
+
+def table_path(csv_path):
+    """ Returns the file read_table actually reads for a parsed csv file
+    """
+
+    pq_path = parquet_path(csv_path)
+    if os.path.exists(pq_path) and has_parquet_support():
+        return pq_path
+
+    return csv_path
+
+
+def load_artifact(artifact_path):
+    """ Loads a compiled artifact without checking its sources, e.g. when they are not shipped
+    """
+
+    with open(artifact_path, "rb") as f:
+        return pickle.load(f)["data"]
+
+
+def load_or_build(artifact_path, source_paths, build):
+    """ Loads a compiled artifact from disk, building it again when its sources changed
+
+    Args:
+        artifact_path: pickle file where the artifact is stored
+        source_paths: files the artifact is built from
+        build: function without arguments building the artifact
+    """
+
+    signature = tuple(file_signature(path) for path in source_paths)
+
+    if os.path.exists(artifact_path):
+        try:
+            with open(artifact_path, "rb") as f:
+                artifact = pickle.load(f)
+            if artifact["signature"] == signature:
+                return artifact["data"]
+        except Exception as e:
+            print(f"Rebuilding {artifact_path}: {str(e)}")
+
+    data = build()
+
+    # the data folder can be read only, in which case the artifact is rebuilt every time
+    try:
+        tmp_path = artifact_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(
+                {"signature": signature, "data": data}, f, protocol=pickle.HIGHEST_PROTOCOL
+            )
+        os.replace(tmp_path, artifact_path)
+    except OSError as e:
+        print(f"Could not store {artifact_path}: {str(e)}")
+
+    return data
+
+
+def read_table(csv_path, columns=None, filters=None, id_format="string", **csv_kwargs):
+    """ Reads a parsed table, from parquet if available and otherwise from the csv
+
+    Args:
+        csv_path: path to the parsed csv file. The parquet copy lives next to it
+        columns: list of columns to return, all of them if None
+        filters: list of (column, op, value) tuples, or a list of lists of them for
+            an OR of ANDs. They are pushed down into the parquet scan
+        id_format: "string", "categorical" or "codes", how the gene and drug id columns
+            are returned, see reservoir.identifiers
+        csv_kwargs: extra arguments for pd.read_csv when falling back to csv
+
+    Parquet results are cached in memory until the file changes, the csv is parsed once
+    and filtered on each call. A copy is returned.
+    """
+
+    from reservoir import identifiers
+
+    identifiers.check_id_format(id_format)
+    filters = normalize_filters(filters)
+    if columns is not None:
+        columns = list(columns)
+
+    key = (
+        "table",
+        None if columns is None else tuple(columns),
+        _freeze_filters(filters),
+        id_format,
+        repr(sorted(csv_kwargs.items())),
+        # the ids are decoded or encoded with the current dictionaries
+        identifiers.dictionary_signatures(csv_path),
+    )
+
+    pq_path = parquet_path(csv_path)
+    if os.path.exists(pq_path) and has_parquet_support():
+        return dataset_cache.load(
+            pq_path, key, lambda: _read_parquet(pq_path, columns, filters, id_format)
+        )
+
+    return identifiers.format_id_columns(
+        _filter_csv(csv_path, columns, filters, **csv_kwargs), id_format
+    )
+
+
+def _freeze_filters(filters):
+    """ Hashable version of some normalized filters, used as part of cache keys
+    """
+
+    if not filters:
+        return None
+
+    return tuple(
+        tuple(
+            (column, op, frozenset(value) if op in ["in", "not in"] else value)
+            for column, op, value in conjunction
+        )
+        for conjunction in filters
+    )
+
+
+def _read_csv(csv_path, columns, **csv_kwargs):
+    """ Reads the csv only parsing some columns, cached unfiltered so that every filter
+    on the same columns shares one parse of the file
+    """
+
+    if columns is not None:
+        csv_kwargs["usecols"] = columns
+
+    return dataset_cache.load(
+        csv_path,
+        (
+            "csv",
+            None if columns is None else tuple(columns),
+            repr(sorted(csv_kwargs.items())),
+        ),
+        lambda: pd.read_csv(csv_path, **csv_kwargs),
+        copy=False,
+    )
+
+
+def _filter_csv(csv_path, columns, filters, **csv_kwargs):
+    """ Filters the csv in pandas, reading only the columns needed for projection and filtering
+
+    Only the selected rows are copied out of the cached table
+    """
+
+    needed_columns = None
+    if columns is not None:
+        needed_columns = columns + [
+            column for column in filter_columns(filters) if column not in columns
+        ]
+
+    table = apply_filters(_read_csv(csv_path, needed_columns, **csv_kwargs), filters)
+
+    if columns is not None:
+        table = table[columns]
+
+    return copy_of(table)
+
+
+def _stored_column_order(schema):
+    """ Partition columns are appended at the end by arrow. Recover the original order
+    """
+
+    metadata = schema.metadata or {}
+    if COLUMN_ORDER_KEY in metadata:
+        return json.loads(metadata[COLUMN_ORDER_KEY])
+
+    return list(schema.names)
+
+
+def _encoded_ids(schema):
+    """ Id columns stored as codes, see identifiers.encode_id_columns
+    """
+
+    metadata = schema.metadata or {}
+    if ENCODED_IDS_KEY in metadata:
+        return json.loads(metadata[ENCODED_IDS_KEY])
+
+    return {}
+
+
+def _read_parquet(pq_path, columns, filters, id_format="string"):
+    """ Reads a parquet file or hive partitioned folder pushing down projection and filters
+    """
+
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+    from reservoir import identifiers
+
+    dataset = ds.dataset(pq_path, format="parquet", partitioning="hive")
+
+    # filters on the encoded id columns are applied on their codes
+    encoded = _encoded_ids(dataset.schema)
+    identifiers.check_signatures(encoded, pq_path)
+    filters = identifiers.encode_filters(filters, encoded)
+
+    expression = pq.filters_to_expression(filters) if filters else None
+    table = dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+    if columns is None:
+        table = table[
+            [c for c in _stored_column_order(dataset.schema) if c in table.columns]
+        ]
+
+    return identifiers.format_id_columns(
+        table, id_format, [c for c in encoded if c in table.columns]
+    )
+
+
+def write_table(table, csv_path, partition_cols=None, sort_by=None, encode_ids=False):
+    """ Writes the parquet copy of a parsed table
+
+    Args:
+        table: the dataframe to write
+        csv_path: path of the parsed csv the copy belongs to
+        partition_cols: columns used to split the data in hive style folders
+        sort_by: columns used to sort the rows so row group statistics can prune scans
+        encode_ids: store the gene and drug id columns as integer codes, see
+            reservoir.identifiers
+    """
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from reservoir import identifiers
+
+    encoded = {}
+    if encode_ids:
+        table, encoded = identifiers.encode_id_columns(table)
+
+    partition_cols = [c for c in (partition_cols or []) if c in table.columns]
+    sort_by = [c for c in (sort_by or []) if c in table.columns]
+
+    if len(sort_by) > 0:
+        table = table.sort_values(sort_by, kind="stable")
+    table = table.reset_index(drop=True)
+
+    metadata = {COLUMN_ORDER_KEY: json.dumps(list(table.columns)).encode()}
+    if len(encoded) > 0:
+        metadata[ENCODED_IDS_KEY] = json.dumps(encoded).encode()
+
+    # write next to the final location and swap when done
+    pq_path = parquet_path(csv_path)
+    tmp_path = pq_path + ".tmp"
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+
+    if len(partition_cols) == 0:
+        arrow_table = pa.Table.from_pandas(table, preserve_index=False)
+        arrow_table = arrow_table.replace_schema_metadata(metadata)
+        pq.write_table(arrow_table, tmp_path, row_group_size=ROW_GROUP_SIZE)
+    else:
+        os.makedirs(tmp_path)
+        groups = table.groupby(partition_cols, dropna=False, sort=True)
+        for key, rows in groups:
+            key = key if isinstance(key, tuple) else (key,)
+            folder = os.path.join(
+                tmp_path,
+                *[
+                    f"{column}={_partition_value(value)}"
+                    for column, value in zip(partition_cols, key)
+                ],
+            )
+            os.makedirs(folder, exist_ok=True)
+            arrow_table = pa.Table.from_pandas(
+                rows.drop(columns=partition_cols), preserve_index=False
+            )
+            arrow_table = arrow_table.replace_schema_metadata(metadata)
+            pq.write_table(
+                arrow_table,
+                os.path.join(folder, "part-0.parquet"),
+                row_group_size=ROW_GROUP_SIZE,
+            )
+
+    if os.path.isdir(pq_path):
+        shutil.rmtree(pq_path)
+    elif os.path.exists(pq_path):
+        os.remove(pq_path)
+    os.replace(tmp_path, pq_path)
+
+    return pq_path
+
+
+def _partition_value(value):
+    """ Hive folder name for a partition value
+    """
+
+    if pd.isnull(value):
+        return HIVE_NULL_PARTITION
+
+    return quote(str(value), safe="")
@@ -0,0 +1,347 @@
+import hashlib
+import multiprocessing
+import numpy as np
+import pandas as pd
+from reservoir import dose_response
+
+"""
+Synergy scores of drug combo blocks computed from their dose response matrices.
+
+All of the blocks of a batch are scored at once with array operations on the padded
+matrices of dose_response. Scores follow DrugComb / SynergyFinder: the mean, over the
+measured combination cells, of the observed (or fitted, for ZIP) inhibition minus the
+inhibition expected without interaction.
+
+    bliss: y1 + y2 - y1 * y2 / 100 with the observed mono therapies
+    hsa: max(y1, y2) with the observed mono therapies
+    loewe: the y for which x1 / X1(y) + x2 / X2(y) = 1 with 4 parameter logistic fits
+        of the mono therapies, max(y1, y2) of the fits when the curves can't be inverted
+    zip: Bliss of the fitted mono therapies against a surface obtained by fitting each
+        row and each column of the matrix with its bottom fixed at the mono therapy of
+        the other drug and its top at 100, averaged over both directions
+"""
+
+METHODS = ["bliss", "hsa", "loewe", "zip"]
+
+# part of the cache keys, increase it when a change modifies the scores
+SYNERGY_VERSION = 1
+
+# blocks scored together, bounds the memory of the fits
+DEFAULT_CHUNK_SIZE = 2000
+
+
+def _check_methods(methods):
+    unknown = set(methods).difference(METHODS)
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown synergy methods {sorted(unknown)}, use some of {METHODS}")
+
+
+def _mean_of_cells(values, cells):
+    """ Mean of the values of some cells of every block, NaN for blocks without cells
+    """
+
+    counts = cells.sum(axis=(1, 2))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(cells, values, 0.0).sum(axis=(1, 2)) / counts
+
+
+def fit_mono_therapies(doses):
+    """ 4 parameter logistic fits of the mono therapies of the row and col drugs
+
+    Returns:
+        (blocks, 4) parameters of the row drug and of the col drug
+    """
+
+    matrices = doses.matrices.astype(np.float64)
+    row_parameters, _ = dose_response.fit_logistic(
+        doses.row_concentrations, matrices[:, :, 0], doses.mask[:, :, 0]
+    )
+    col_parameters, _ = dose_response.fit_logistic(
+        doses.col_concentrations, matrices[:, 0, :], doses.mask[:, 0, :]
+    )
+
+    return row_parameters, col_parameters
+
+
+def _combination_cells(doses):
+    cells = doses.mask.copy()
+    cells[:, 0, :] = False
+    cells[:, :, 0] = False
+    return cells
+
+
+def bliss_hsa_scores(doses, methods):
+    """ Bliss and HSA scores with the observed mono therapies
+    """
+
+    matrices = doses.matrices.astype(np.float64)
+    row_monos = matrices[:, :, [0]]
+    col_monos = matrices[:, [0], :]
+    cells = (
+        _combination_cells(doses) & doses.mask[:, :, [0]] & doses.mask[:, [0], :]
+    )
+
+    scores = {}
+    if "bliss" in methods:
+        expected = row_monos + col_monos - row_monos * col_monos / 100
+        scores["bliss"] = _mean_of_cells(matrices - expected, cells)
+    if "hsa" in methods:
+        expected = np.maximum(row_monos, col_monos)
+        scores["hsa"] = _mean_of_cells(matrices - expected, cells)
+
+    return scores
+
+
+def _loewe_terms(doses, responses, parameters):
+    """ dose / X(response) of a drug, X being the inverse of its fitted curve
+
+    responses above the top of the curve can't be reached, their term is 0, and
+    responses below the bottom are reached without the drug, their term is infinite.
+    """
+
+    shape = responses.shape
+    flat_doses = doses.reshape(shape[0], -1)
+    flat_responses = responses.reshape(shape[0], -1)
+    bottom = parameters[:, [0]]
+    top = parameters[:, [1]]
+
+    concentrations = dose_response.inverse_logistic(flat_responses, parameters)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        terms = flat_doses / concentrations
+    terms = np.where(flat_responses >= top, 0.0, terms)
+    terms = np.where(flat_responses <= bottom, np.inf, terms)
+
+    return terms.reshape(shape)
+
+
+def loewe_scores(doses, row_parameters, col_parameters, iterations=60):
+    """ Loewe scores, the expected responses are found by bisection for all cells at once
+
+    For increasing curves, x1 / X1(y) + x2 / X2(y) decreases from infinity to 0 between
+    the highest bottom and the highest top, so it equals 1 exactly once in that range.
+    """
+
+    matrices = doses.matrices.astype(np.float64)
+    row_doses = np.broadcast_to(doses.row_concentrations[:, :, None], matrices.shape)
+    col_doses = np.broadcast_to(doses.col_concentrations[:, None, :], matrices.shape)
+
+    bottom = np.maximum(row_parameters[:, 0], col_parameters[:, 0])
+    top = np.maximum(row_parameters[:, 1], col_parameters[:, 1])
+    low = np.broadcast_to(bottom[:, None, None], matrices.shape).copy()
+    high = np.broadcast_to(top[:, None, None], matrices.shape).copy()
+
+    for _ in range(iterations):
+        middle = (low + high) / 2
+        total = _loewe_terms(row_doses, middle, row_parameters) + _loewe_terms(
+            col_doses, middle, col_parameters
+        )
+        above = total > 1
+        low = np.where(above, middle, low)
+        high = np.where(above, high, middle)
+    expected = (low + high) / 2
+
+    # curves going down or flat can't be inverted, fall back to HSA of the fits
+    increasing = (row_parameters[:, 1] > row_parameters[:, 0]) & (
+        col_parameters[:, 1] > col_parameters[:, 0]
+    )
+    fitted_hsa = np.maximum(
+        _fitted_monos(doses.row_concentrations, row_parameters)[:, :, None],
+        _fitted_monos(doses.col_concentrations, col_parameters)[:, None, :],
+    )
+    expected = np.where(increasing[:, None, None] & np.isfinite(expected), expected, fitted_hsa)
+
+    return _mean_of_cells(matrices - expected, _combination_cells(doses))
+
+
+def _fitted_monos(concentrations, parameters):
+    return dose_response.logistic(
+        np.nan_to_num(concentrations.astype(np.float64)), parameters
+    )
+
+
+def zip_scores(doses, row_parameters, col_parameters):
+    """ ZIP delta scores (Yadav et al. 2015)
+    """
+
+    matrices = doses.matrices.astype(np.float64)
+    row_concentrations = np.nan_to_num(doses.row_concentrations.astype(np.float64))
+    col_concentrations = np.nan_to_num(doses.col_concentrations.astype(np.float64))
+    row_monos = _fitted_monos(row_concentrations, row_parameters)
+    col_monos = _fitted_monos(col_concentrations, col_parameters)
+
+    def fit_direction(concentrations, responses, mask, bottoms, parameters):
+        """ Fits every line of the matrices along one axis
+        """
+
+        lines = responses.shape[1]
+        points = responses.shape[2]
+        concentrations = np.repeat(concentrations, lines, axis=0)
+        responses = responses.reshape(-1, points).copy()
+        mask = mask.reshape(-1, points).copy()
+
+        # the zero dose of each line is the fitted mono therapy of the other drug
+        responses[:, 0] = bottoms.reshape(-1)
+        mask[:, 0] = True
+
+        initial = np.repeat(parameters, lines, axis=0)
+        initial[:, 0] = bottoms.reshape(-1)
+        initial[:, 1] = 100
+        fixed = np.zeros(initial.shape, dtype=bool)
+        fixed[:, :2] = True
+
+        fitted, _ = dose_response.fit_logistic(
+            concentrations, responses, mask, initial=initial, fixed=fixed
+        )
+        return dose_response.logistic(concentrations, fitted).reshape(-1, lines, points)
+
+    # each row fitted along the col drug doses, and each column along the row drug doses
+    along_cols = fit_direction(
+        col_concentrations, matrices, doses.mask, row_monos, col_parameters
+    )
+    along_rows = fit_direction(
+        row_concentrations,
+        matrices.transpose(0, 2, 1),
+        doses.mask.transpose(0, 2, 1),
+        col_monos,
+        row_parameters,
+    ).transpose(0, 2, 1)
+
+    expected = (
+        row_monos[:, :, None]
+        + col_monos[:, None, :]
+        - row_monos[:, :, None] * col_monos[:, None, :] / 100
+    )
+
+    return _mean_of_cells((along_cols + along_rows) / 2 - expected, _combination_cells(doses))
+
+
+def score_blocks(doses, methods=METHODS):
+    """ Synergy scores of the blocks of some dose response matrices
+
+    Returns:
+        dataframe with block_id and a synergy_<method> column per method
+    """
+
+    _check_methods(methods)
+    scores = bliss_hsa_scores(doses, methods)
+
+    if "loewe" in methods or "zip" in methods:
+        row_parameters, col_parameters = fit_mono_therapies(doses)
+        if "loewe" in methods:
+            scores["loewe"] = loewe_scores(doses, row_parameters, col_parameters)
+        if "zip" in methods:
+            scores["zip"] = zip_scores(doses, row_parameters, col_parameters)
+
+    frame = pd.DataFrame({"block_id": doses.block_ids})
+    for method in methods:
+        frame["synergy_" + method] = scores[method]
+
+    return frame
+
+
+def subset(doses, positions):
+    """ Some blocks of dose response matrices, with the padding trimmed
+    """
+
+    # the axes are NaN padded after the last concentration of each block
+    rows = int((~np.isnan(doses.row_concentrations[positions])).sum(axis=1).max(initial=1))
+    cols = int((~np.isnan(doses.col_concentrations[positions])).sum(axis=1).max(initial=1))
+
+    return dose_response.DoseResponseMatrices(
+        block_ids=doses.block_ids[positions],
+        matrices=doses.matrices[positions, :rows, :cols],
+        row_concentrations=doses.row_concentrations[positions, :rows],
+        col_concentrations=doses.col_concentrations[positions, :cols],
+        mask=doses.mask[positions, :rows, :cols],
+    )
+
+
+def block_keys(doses, methods):
+    """ Cache keys of every block and method, from the content of the blocks
+    """
+
+    keys = []
+    for i in range(len(doses.block_ids)):
+        mask = doses.mask[i]
+        content = hashlib.sha1()
+        content.update(doses.row_concentrations[i].tobytes())
+        content.update(doses.col_concentrations[i].tobytes())
+        content.update(np.packbits(mask).tobytes())
+        content.update(np.where(mask, doses.matrices[i], 0).astype(np.float32).tobytes())
+        digest = content.hexdigest()
+        keys.append([f"{digest}:{method}:{SYNERGY_VERSION}" for method in methods])
+
+    return keys
+
+
+def _score_chunk(arguments):
+    doses, methods = arguments
+    return score_blocks(doses, methods)
+
+
+def compute_synergy(
+    doses,
+    methods=METHODS,
+    processes=1,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    cache=None,
+):
+    """ Synergy scores of many blocks
+
+    Args:
+        doses: DoseResponseMatrices, e.g. from get_dose_response_matrices or
+            dose_response_matrices_from_frame
+        methods: list of methods, some of METHODS
+        processes: number of worker processes for the fits, 1 to score in this process
+        chunk_size: number of blocks scored together
+        cache: DiskCache of the scores, or None to compute everything
+
+    Returns:
+        dataframe with block_id and a synergy_<method> column per method, in the order
+        of the blocks of doses
+    """
+
+    methods = list(methods)
+    _check_methods(methods)
+    number_of_blocks = len(doses.block_ids)
+    scores = np.full((number_of_blocks, len(methods)), np.nan)
+
+    if cache is not None:
+        keys = block_keys(doses, methods)
+        cached = cache.get_many(key for block in keys for key in block)
+        found = np.array([all(key in cached for key in block) for block in keys], dtype=bool)
+        for i in np.flatnonzero(found):
+            scores[i] = [cached[key] for key in keys[i]]
+        missing = np.flatnonzero(~found)
+    else:
+        missing = np.arange(number_of_blocks)
+
+    # blocks of similar shapes together, so that chunks have little padding
+    sizes = doses.mask[missing].sum(axis=(1, 2))
+    missing = missing[np.argsort(sizes, kind="stable")]
+    chunks = [missing[start:start + chunk_size] for start in range(0, len(missing), chunk_size)]
+    arguments = [(subset(doses, chunk), methods) for chunk in chunks]
+
+    if processes > 1 and len(chunks) > 1:
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.map(_score_chunk, arguments)
+    else:
+        results = [_score_chunk(argument) for argument in arguments]
+
+    for chunk, result in zip(chunks, results):
+        scores[chunk] = result[["synergy_" + method for method in methods]].to_numpy()
+
+    if cache is not None and len(missing) > 0:
+        cache.set_many(
+            {
+                key: float(scores[i, j])
+                for i in missing
+                for j, key in enumerate(keys[i])
+            }
+        )
+
+    frame = pd.DataFrame({"block_id": doses.block_ids})
+    for j, method in enumerate(methods):
+        frame["synergy_" + method] = scores[:, j]
+
+    return frame